@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+"""
+Compares payload size against CPU cost of the compression algorithms supported by ``TASKHAWK_COMPRESSION``, for
+generated message payloads of a few sizes.
+
+Usage: python scripts/benchmark_compression.py [--iterations N]
+"""
+import argparse
+import json
+import random
+import string
+import sys
+import time
+import uuid
+
+sys.path.insert(0, '.')
+
+from taskhawk.compression import HAVE_ZSTD, ZLIB, ZSTD, compress_payload, decompress_payload  # noqa: E402
+
+
+_WORDS = [''.join(random.Random(i).choices(string.ascii_lowercase, k=3 + i % 7)) for i in range(2000)]
+
+
+def _payload(num_items: int) -> str:
+    rng = random.Random(num_items)
+    return json.dumps(
+        {
+            'id': str(uuid.UUID(int=rng.getrandbits(128))),
+            'metadata': {'priority': 'default', 'timestamp': 1700000000000, 'version': '1.0'},
+            'headers': {'request_id': str(uuid.UUID(int=rng.getrandbits(128)))},
+            'task': 'tasks.index_documents',
+            'args': [
+                {
+                    'id': rng.randint(1, 10**9),
+                    'title': ' '.join(rng.choice(('report', 'invoice', 'user', 'order', 'note')) for _ in range(4)),
+                    'body': ' '.join(rng.choice(_WORDS) for _ in range(40)),
+                    'tags': rng.sample(['a', 'b', 'c', 'd', 'e', 'f'], 3),
+                }
+                for _ in range(num_items)
+            ],
+            'kwargs': {},
+        }
+    )
+
+
+def _time_us(fn, iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=200)
+    iterations = parser.parse_args().iterations
+
+    configs = [(ZLIB, 1), (ZLIB, 6), (ZLIB, 9)]
+    if HAVE_ZSTD:
+        configs += [(ZSTD, 1), (ZSTD, 3), (ZSTD, 9)]
+    else:
+        print('zstandard is not installed, skipping zstd\n')
+
+    print(f'{"payload":>9} {"algorithm":>10} {"level":>5} {"size":>9} {"ratio":>6} {"compress":>12} {"decompress":>12}')
+    for num_items in (10, 100, 400):
+        payload = _payload(num_items)
+        print(f'{len(payload):>9} {"none":>10} {"":>5} {len(payload):>9} {1:>6.2f} {"":>12} {"":>12}')
+        for algorithm, level in configs:
+            config = {'algorithm': algorithm, 'level': level, 'min_bytes': 0}
+            compressed, encoding = compress_payload(payload, config)
+            attributes = {'taskhawk-encoding': encoding}
+            compress_us = _time_us(lambda: compress_payload(payload, config), iterations)
+            decompress_us = _time_us(lambda: decompress_payload(compressed, attributes), iterations)
+            print(
+                f'{len(payload):>9} {algorithm:>10} {level:>5} {len(compressed):>9} '
+                f'{len(payload) / len(compressed):>6.2f} {compress_us:>10.0f}us {decompress_us:>10.0f}us'
+            )
+
+
+if __name__ == '__main__':
+    main()
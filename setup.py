@@ -96,6 +96,8 @@ setup(
             'opentelemetry-api>=1.19; python_version >= "3.8"',
             'opentelemetry-api<=1.12; python_version < "3.8"',
         ],
+        'gcs': ['google-cloud-storage'],
+        'zstd': ['zstandard'],
     },
     include_package_data=True,
 )
@@ -17,9 +17,17 @@ try:
     from .backends.gcp import GoogleMetadata  # noqa
 except ImportError:
     pass
+from .claim_check import BlobStore  # noqa
 from .commands import requeue_dead_letter  # noqa
-from .consumer import listen_for_messages, process_messages_for_lambda_consumer  # noqa
+from .consumer import (  # noqa
+    listen_for_messages,
+    listen_for_messages_async,
+    listen_for_messages_weighted,
+    process_messages_for_lambda_consumer,
+)
 from .exceptions import *  # noqa
 from .models import Metadata, Priority  # noqa
-from .publisher import publish  # noqa
-from .task_manager import AsyncInvocation, task, Task  # noqa
+from .prefork import listen_for_messages_prefork  # noqa
+from .publisher import DispatchResult, publish  # noqa
+from .retry import Backoff  # noqa
+from .task_manager import AsyncInvocation, BatchItem, task, Task  # noqa
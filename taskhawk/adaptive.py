@@ -0,0 +1,132 @@
+import math
+import threading
+from typing import Optional
+
+
+EWMA_WEIGHT = 0.2
+"""
+Weight of the latest observation in moving averages
+"""
+
+VISIBILITY_SAFETY_FACTOR = 0.5
+"""
+Fraction of the visibility timeout a pulled batch may take to be processed
+"""
+
+EMPTY_RATE_HIGH = 0.5
+"""
+Empty-receive rate above which the wait time is lengthened to cut down on empty pulls
+"""
+
+EMPTY_RATE_LOW = 0.1
+"""
+Empty-receive rate below which the wait time is shortened, so the consumer stays responsive
+"""
+
+
+class AdaptivePullController:
+    """
+    Sizes pulls from what the consumer observes:
+
+    - Full batches mean messages arrive at least as fast as they're consumed, so the batch size doubles, as long as
+      a batch can still be processed in half the visibility timeout at the observed per-message processing time.
+    - Partial batches mean the queue is drained, so the batch size shrinks by one towards what's actually received.
+    - A batch that takes too long to process for the visibility timeout shrinks the batch size to what fits.
+    - The wait time for empty queues doubles while most pulls come back empty, and halves while few do.
+    """
+
+    def __init__(
+        self,
+        num_messages: int,
+        min_messages: int,
+        max_messages: int,
+        min_wait_s: int,
+        max_wait_s: int,
+        visibility_timeout_s: Optional[int],
+    ) -> None:
+        if min_messages <= 0 or min_messages > max_messages:
+            raise ValueError("min_messages must be greater than zero and at most max_messages")
+        if min_wait_s < 0 or min_wait_s > max_wait_s:
+            raise ValueError("min_wait_s must not be negative and at most max_wait_s")
+        self._min_messages = min_messages
+        self._max_messages = max_messages
+        self._min_wait_s = min_wait_s
+        self._max_wait_s = max_wait_s
+        self._visibility_timeout_s = visibility_timeout_s
+        self._batch_size = min(max(num_messages, min_messages), max_messages)
+        self._wait_time_s = max_wait_s
+        self._empty_rate = 0.0
+        self._message_duration_s: Optional[float] = None
+        # with a thread pool, batches are recorded from worker threads once they're done
+        self._lock = threading.Lock()
+
+    @property
+    def batch_size(self) -> int:
+        """
+        Number of messages to request in the next pull
+        """
+        return self._batch_size
+
+    @property
+    def wait_time_s(self) -> int:
+        """
+        How long the next pull should wait for messages if there are none
+        """
+        return self._wait_time_s
+
+    @property
+    def empty_rate(self) -> float:
+        """
+        Moving average of the fraction of pulls that returned no messages
+        """
+        return self._empty_rate
+
+    @property
+    def message_duration_s(self) -> Optional[float]:
+        """
+        Moving average of how long the consumer takes per message, or None if nothing was received yet
+        """
+        return self._message_duration_s
+
+    def record(self, requested: int, received: int, duration_s: float) -> None:
+        """
+        Records the outcome of a pull.
+
+        :param requested: number of messages that were requested
+        :param received: number of messages that were received
+        :param duration_s: how long the consumer took to process the messages
+        """
+        with self._lock:
+            self._record(requested, received, duration_s)
+
+    def _record(self, requested: int, received: int, duration_s: float) -> None:
+        self._empty_rate += EWMA_WEIGHT * ((1.0 if received == 0 else 0.0) - self._empty_rate)
+        if self._empty_rate > EMPTY_RATE_HIGH:
+            self._wait_time_s = min(self._max_wait_s, max(1, self._wait_time_s * 2))
+        elif self._empty_rate < EMPTY_RATE_LOW:
+            self._wait_time_s = max(self._min_wait_s, self._wait_time_s // 2)
+
+        if received == 0:
+            return
+
+        message_duration_s = duration_s / received
+        if self._message_duration_s is None:
+            self._message_duration_s = message_duration_s
+        else:
+            self._message_duration_s += EWMA_WEIGHT * (message_duration_s - self._message_duration_s)
+
+        fits = self._fits_in_visibility_timeout()
+        if self._batch_size > fits:
+            self._batch_size = max(self._min_messages, fits)
+        elif received >= requested:
+            self._batch_size = min(self._max_messages, self._batch_size * 2, max(self._min_messages, fits))
+        else:
+            self._batch_size = max(self._min_messages, self._batch_size - 1)
+
+    def _fits_in_visibility_timeout(self) -> int:
+        """
+        Number of messages that can be processed well within the visibility timeout
+        """
+        if self._visibility_timeout_s is None or not self._message_duration_s:
+            return self._max_messages
+        return math.floor(self._visibility_timeout_s * VISIBILITY_SAFETY_FACTOR / self._message_duration_s)
@@ -1,7 +1,9 @@
+import atexit
 import json
 import logging
+import threading
 import typing
-from concurrent.futures import Future
+from concurrent.futures import Future, ThreadPoolExecutor
 from typing import Any, Dict, Optional
 from unittest import mock
 
@@ -17,7 +19,10 @@ from taskhawk.backends.base import (
     TaskhawkConsumerBaseBackend,
     TaskhawkPublisherBaseBackend,
 )
+from taskhawk.backends.batching import Batcher, log_failure
 from taskhawk.backends.exceptions import PartialFailure
+from taskhawk.claim_check import BlobStore
+from taskhawk.compression import decompress_payload
 from taskhawk.conf import settings
 from taskhawk.models import Message, Priority
 
@@ -25,14 +30,33 @@ from taskhawk.models import Message, Priority
 logger = logging.getLogger(__name__)
 
 
+MAX_BATCH_ENTRIES = 10
+"""
+Maximum number of entries in a single SQS / SNS batch request
+"""
+
+MAX_BATCH_PAYLOAD_BYTES = 256 * 1024
+"""
+Maximum total size of the messages and attributes in a single SNS batch request
+"""
+
+
 class AWSMetadata:
-    def __init__(self, receipt):
+    def __init__(self, receipt, receive_count: Optional[int] = None):
         self._receipt = receipt
+        self._receive_count = receive_count
 
     @property
     def receipt(self):
         return self._receipt
 
+    @property
+    def receive_count(self) -> Optional[int]:
+        """
+        Approximate number of times the message was received from SQS, including this time
+        """
+        return self._receive_count
+
     def __eq__(self, o: object) -> bool:
         if not isinstance(o, AWSMetadata):
             return False
@@ -51,9 +75,44 @@ class AWSMetadata:
         return hash((self._receipt,))
 
 
+class _PublishEntry:
+    """
+    A message waiting to be published in a batch
+    """
+
+    def __init__(self, message_json: str, message_attributes: typing.Mapping) -> None:
+        self.message_json = message_json
+        self.message_attributes = {
+            k: {'DataType': 'String', 'StringValue': str(v)} for k, v in message_attributes.items()
+        }
+        self.size = len(message_json.encode('utf8')) + sum(
+            len(k.encode('utf8')) + len(v['DataType']) + len(v['StringValue'].encode('utf8'))
+            for k, v in self.message_attributes.items()
+        )
+        self.message_id: Optional[str] = None
+
+
+def _chunk_entries(entries: typing.List[_PublishEntry]) -> typing.List[typing.List[_PublishEntry]]:
+    """
+    Splits entries into consecutive chunks that fit in a single batch request. An entry that's larger than a batch
+    request allows is sent in a chunk of its own.
+    """
+    chunks: typing.List[typing.List[_PublishEntry]] = []
+    size = 0
+    for entry in entries:
+        if not chunks or len(chunks[-1]) >= MAX_BATCH_ENTRIES or size + entry.size > MAX_BATCH_PAYLOAD_BYTES:
+            chunks.append([])
+            size = 0
+        chunks[-1].append(entry)
+        size += entry.size
+    return chunks
+
+
 class AWSSNSPublisherBackend(TaskhawkPublisherBaseBackend):
     def __init__(self, priority: Priority):
         self._sns_client: Optional[SNSClient] = None
+        # creating clients using the default boto3 session isn't thread-safe
+        self._client_lock = threading.Lock()
         self.topic_name = (
             f'arn:aws:sns:{settings.AWS_REGION}:{settings.AWS_ACCOUNT_ID}:taskhawk-{settings.TASKHAWK_QUEUE.lower()}'
             f'{self.get_priority_suffix(priority)}'
@@ -62,16 +121,20 @@ class AWSSNSPublisherBackend(TaskhawkPublisherBaseBackend):
     @property
     def sns_client(self):
         if self._sns_client is None:
-            config = Config(connect_timeout=settings.AWS_CONNECT_TIMEOUT_S, read_timeout=settings.AWS_READ_TIMEOUT_S)
-            self._sns_client = boto3.client(
-                'sns',
-                region_name=settings.AWS_REGION,
-                aws_access_key_id=settings.AWS_ACCESS_KEY,
-                aws_secret_access_key=settings.AWS_SECRET_KEY,
-                aws_session_token=settings.AWS_SESSION_TOKEN,
-                endpoint_url=settings.AWS_ENDPOINT_SNS,
-                config=config,
-            )
+            with self._client_lock:
+                if self._sns_client is None:
+                    config = Config(
+                        connect_timeout=settings.AWS_CONNECT_TIMEOUT_S, read_timeout=settings.AWS_READ_TIMEOUT_S
+                    )
+                    self._sns_client = boto3.client(
+                        'sns',
+                        region_name=settings.AWS_REGION,
+                        aws_access_key_id=settings.AWS_ACCESS_KEY,
+                        aws_secret_access_key=settings.AWS_SECRET_KEY,
+                        aws_session_token=settings.AWS_SESSION_TOKEN,
+                        endpoint_url=settings.AWS_ENDPOINT_SNS,
+                        config=config,
+                    )
         return self._sns_client
 
     @staticmethod
@@ -95,6 +158,8 @@ class AWSSNSPublisherBackend(TaskhawkPublisherBaseBackend):
         sqs_message = mock.Mock()
         sqs_message.body = json.dumps(message.as_dict())
         sqs_message.receipt_handle = 'test-receipt'
+        sqs_message.attributes = {}
+        sqs_message.message_attributes = {}
         return sqs_message
 
     def _publish(
@@ -105,41 +170,230 @@ class AWSSNSPublisherBackend(TaskhawkPublisherBaseBackend):
     ) -> typing.Union[str, Future]:
         return self._publish_over_sns(self.topic_name, payload, headers or {})
 
+    def _publish_many(
+        self, entries: typing.List[typing.Tuple[Message, str, typing.Mapping]]
+    ) -> typing.List[typing.Union[str, Future]]:
+        publish_entries = [_PublishEntry(payload, headers) for _, payload, headers in entries]
+        failures = self._publish_entries(publish_entries)
+        results: typing.List[typing.Union[str, Future]] = []
+        for index, entry in enumerate(publish_entries):
+            error = failures.get(index)
+            if error is not None:
+                future: Future = Future()
+                future.set_exception(error)
+                results.append(future)
+            else:
+                results.append(typing.cast(str, entry.message_id))
+        return results
+
+    def _publish_entries(self, entries: typing.List[_PublishEntry]) -> Dict[int, Exception]:
+        """
+        Publishes entries in as few ``PublishBatch`` requests as they fit in, and sets their message ids.
+
+        :return: errors for entries that failed, keyed by index
+        """
+        failures: Dict[int, Exception] = {}
+        offset = 0
+        for chunk in _chunk_entries(entries):
+            try:
+                chunk_failures = self._publish_chunk(chunk)
+            except Exception as e:
+                chunk_failures = {index: e for index in range(len(chunk))}
+            failures.update({offset + index: error for index, error in chunk_failures.items()})
+            offset += len(chunk)
+        return failures
+
+    @retry(stop_max_attempt_number=3, stop_max_delay=3000)
+    def _publish_batch_over_sns(self, topic: str, entries: typing.List[_PublishEntry]) -> dict:
+        return self.sns_client.publish_batch(
+            TopicArn=topic,
+            PublishBatchRequestEntries=[
+                {'Id': str(index), 'Message': entry.message_json, 'MessageAttributes': entry.message_attributes}
+                for index, entry in enumerate(entries)
+            ],
+        )
+
+    def _publish_chunk(self, entries: typing.List[_PublishEntry]) -> Dict[int, Exception]:
+        response = self._publish_batch_over_sns(self.topic_name, entries)
+        for result in response.get('Successful', []):
+            entries[int(result['Id'])].message_id = result['MessageId']
+        failures: Dict[int, Exception] = {}
+        for result in response.get('Failed', []):
+            index = int(result['Id'])
+            if result.get('SenderFault'):
+                failures[index] = PartialFailure(response, result.get('Code'), result.get('Message'))
+                continue
+            logger.info('Retrying failed batch entry', extra={'code': result.get('Code'), 'sender_fault': False})
+            try:
+                entries[index].message_id = self.sns_client.publish(
+                    TopicArn=self.topic_name,
+                    Message=entries[index].message_json,
+                    MessageAttributes=entries[index].message_attributes,
+                )['MessageId']
+            except Exception as e:
+                failures[index] = e
+        return failures
+
+
+class AWSSNSAsyncPublisherBackend(AWSSNSPublisherBackend):
+    """
+    Publisher backend that publishes on a pool of ``AWS_SNS_ASYNC_PUBLISH_MAX_WORKERS`` threads sharing one client, and
+    returns futures that resolve to the published message ids. Once ``AWS_SNS_ASYNC_PUBLISH_MAX_PENDING`` messages are
+    waiting for a thread, dispatching blocks until one is free.
+
+    Call `flush` before the process exits, so that waiting messages aren't lost.
+    """
+
+    def __init__(self, priority: Priority):
+        super().__init__(priority)
+        max_workers = settings.AWS_SNS_ASYNC_PUBLISH_MAX_WORKERS
+        if max_workers <= 0:
+            raise ValueError("AWS_SNS_ASYNC_PUBLISH_MAX_WORKERS must be greater than zero")
+        self._max_in_flight = max_workers + settings.AWS_SNS_ASYNC_PUBLISH_MAX_PENDING
+        self._in_flight = 0
+        self._cond = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='taskhawk-publish')
+
+    def _publish(
+        self,
+        message: Message,
+        payload: str,
+        headers: typing.Optional[typing.Mapping] = None,
+    ) -> typing.Union[str, Future]:
+        with self._cond:
+            self._cond.wait_for(lambda: self._in_flight < self._max_in_flight)
+            self._in_flight += 1
+        try:
+            future = self._executor.submit(self._publish_over_sns, self.topic_name, payload, headers or {})
+        except Exception:
+            self._release()
+            raise
+        future.add_done_callback(lambda _: self._release())
+        return future
+
+    def _release(self) -> None:
+        with self._cond:
+            self._in_flight -= 1
+            self._cond.notify_all()
+
+    def flush(self) -> None:
+        """
+        Blocks until all messages dispatched so far have been published
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self._in_flight == 0)
+
+
+class AWSSNSBatchPublisherBackend(AWSSNSPublisherBackend):
+    """
+    Publisher backend that groups messages into ``PublishBatch`` requests, and returns futures that resolve to the
+    published message ids. Batches are sent from a background thread once ``AWS_SNS_PUBLISH_BATCH_MAX_MESSAGES``
+    messages are waiting, or once the oldest has waited ``AWS_SNS_PUBLISH_BATCH_MAX_LATENCY_S``. Entries that fail in a
+    batch request are retried individually, unless SNS reports the request itself was invalid.
+
+    Waiting messages are flushed when the interpreter exits normally. Call `flush` or `close` earlier if the process
+    may be killed, e.g. at the end of a request or job.
+    """
+
+    def __init__(self, priority: Priority):
+        super().__init__(priority)
+        self._batcher: Batcher[_PublishEntry] = Batcher(
+            self._publish_entries,
+            min(settings.AWS_SNS_PUBLISH_BATCH_MAX_MESSAGES, MAX_BATCH_ENTRIES),
+            settings.AWS_SNS_PUBLISH_BATCH_MAX_LATENCY_S,
+            'taskhawk-publish',
+        )
+        # the batcher's thread is a daemon, so it would otherwise be stopped with messages still waiting
+        atexit.register(self.flush)
+
+    def _publish(
+        self,
+        message: Message,
+        payload: str,
+        headers: typing.Optional[typing.Mapping] = None,
+    ) -> typing.Union[str, Future]:
+        entry = _PublishEntry(payload, headers or {})
+        future: Future = Future()
+
+        def _settle(batch_future: Future) -> None:
+            error = batch_future.exception()
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(entry.message_id)
+
+        self._batcher.add(entry).add_done_callback(_settle)
+        return future
+
+    def flush(self) -> None:
+        """
+        Publishes any waiting messages, and blocks until they've been sent
+        """
+        self._batcher.flush()
+
+    def close(self) -> None:
+        """
+        Publishes any waiting messages, and stops flushing at exit. Messages dispatched afterwards must be flushed
+        explicitly.
+        """
+        self.flush()
+        atexit.unregister(self.flush)
+
 
 class AWSSQSConsumerBackend(TaskhawkConsumerBaseBackend):
     WAIT_TIME_SECONDS = 20
+    DEFAULT_VISIBILITY_TIMEOUT_S = 30
+    MAX_PULL_MESSAGES = MAX_BATCH_ENTRIES
+    MAX_VISIBILITY_TIMEOUT_S = 43200
 
     def __init__(self, priority: Priority, dlq=False):
-        self._sqs_resource: Optional[SQSServiceResource] = None
+        # boto3 resources aren't thread-safe, so each thread gets its own
+        self._local = threading.local()
+        # creating clients and resources using the default boto3 session isn't thread-safe either
+        self._boto3_lock = threading.Lock()
         self._sqs_client: Optional[SQSClient] = None
+        self._queue_url: Optional[str] = None
+        self._dlq_url: Optional[str] = None
         self.queue_name = (
             f'TASKHAWK-{settings.TASKHAWK_QUEUE.upper()}{self.get_priority_suffix(priority)}{"-DLQ" if dlq else ""}'
         )
+        self._dlq_name = f'TASKHAWK-{settings.TASKHAWK_QUEUE.upper()}{self.get_priority_suffix(priority)}-DLQ'
+        self._delete_batcher: Optional[Batcher[str]] = None
+        self._nack_batcher: Optional[Batcher[str]] = None
+        ack_batch_size = min(settings.AWS_SQS_ACK_BATCH_MAX_MESSAGES, MAX_BATCH_ENTRIES)
+        if ack_batch_size > 1:
+            ack_batch_latency_s = settings.AWS_SQS_ACK_BATCH_MAX_LATENCY_S
+            self._delete_batcher = Batcher(self._delete_messages, ack_batch_size, ack_batch_latency_s, 'taskhawk-ack')
+            self._nack_batcher = Batcher(self._nack_messages, ack_batch_size, ack_batch_latency_s, 'taskhawk-nack')
 
     @property
-    def sqs_resource(self):
-        if self._sqs_resource is None:
-            self._sqs_resource = boto3.resource(
-                'sqs',
-                region_name=settings.AWS_REGION,
-                aws_access_key_id=settings.AWS_ACCESS_KEY,
-                aws_secret_access_key=settings.AWS_SECRET_KEY,
-                aws_session_token=settings.AWS_SESSION_TOKEN,
-                endpoint_url=settings.AWS_ENDPOINT_SQS,
-            )
-        return self._sqs_resource
+    def sqs_resource(self) -> SQSServiceResource:
+        sqs_resource: Optional[SQSServiceResource] = getattr(self._local, 'sqs_resource', None)
+        if sqs_resource is None:
+            with self._boto3_lock:
+                sqs_resource = self._local.sqs_resource = boto3.resource(
+                    'sqs',
+                    region_name=settings.AWS_REGION,
+                    aws_access_key_id=settings.AWS_ACCESS_KEY,
+                    aws_secret_access_key=settings.AWS_SECRET_KEY,
+                    aws_session_token=settings.AWS_SESSION_TOKEN,
+                    endpoint_url=settings.AWS_ENDPOINT_SQS,
+                )
+        return sqs_resource
 
     @property
     def sqs_client(self):
         if self._sqs_client is None:
-            self._sqs_client = boto3.client(
-                'sqs',
-                region_name=settings.AWS_REGION,
-                aws_access_key_id=settings.AWS_ACCESS_KEY,
-                aws_secret_access_key=settings.AWS_SECRET_KEY,
-                aws_session_token=settings.AWS_SESSION_TOKEN,
-                endpoint_url=settings.AWS_ENDPOINT_SQS,
-            )
+            with self._boto3_lock:
+                if self._sqs_client is None:
+                    self._sqs_client = boto3.client(
+                        'sqs',
+                        region_name=settings.AWS_REGION,
+                        aws_access_key_id=settings.AWS_ACCESS_KEY,
+                        aws_secret_access_key=settings.AWS_SECRET_KEY,
+                        aws_session_token=settings.AWS_SESSION_TOKEN,
+                        endpoint_url=settings.AWS_ENDPOINT_SQS,
+                    )
         return self._sqs_client
 
     @staticmethod
@@ -155,28 +409,123 @@ class AWSSQSConsumerBackend(TaskhawkConsumerBaseBackend):
     def _get_queue(self):
         return self.sqs_resource.get_queue_by_name(QueueName=self.queue_name)
 
-    def pull_messages(self, num_messages: int = 1, visibility_timeout: Optional[int] = None) -> typing.List[SQSMessage]:
+    @property
+    def queue_url(self) -> str:
+        if self._queue_url is None:
+            self._queue_url = self.sqs_client.get_queue_url(QueueName=self.queue_name)['QueueUrl']
+        return self._queue_url
+
+    def pull_messages(
+        self, num_messages: int = 1, visibility_timeout: Optional[int] = None, wait_time_s: Optional[int] = None
+    ) -> typing.List[SQSMessage]:
         params = {
             'MaxNumberOfMessages': num_messages,
-            'WaitTimeSeconds': self.WAIT_TIME_SECONDS,
+            'WaitTimeSeconds': self.WAIT_TIME_SECONDS if wait_time_s is None else wait_time_s,
             'MessageAttributeNames': ['All'],
+            'AttributeNames': ['ApproximateReceiveCount'],
         }
         if visibility_timeout is not None:
             params['VisibilityTimeout'] = visibility_timeout
         return self._get_queue().receive_messages(**params)
 
-    def process_message(self, queue_message: SQSMessage) -> None:
-        message_json = queue_message.body
-        receipt = queue_message.receipt_handle
-        self.message_handler(message_json, AWSMetadata(receipt))
+    def _decode_queue_message(self, queue_message: SQSMessage) -> typing.Tuple[str, AWSMetadata]:
+        receive_count = (queue_message.attributes or {}).get('ApproximateReceiveCount')
+        attributes = {k: v.get('StringValue') for k, v in (queue_message.message_attributes or {}).items()}
+        return decompress_payload(queue_message.body, attributes), AWSMetadata(
+            queue_message.receipt_handle, int(receive_count) if receive_count is not None else None
+        )
+
+    def message_size(self, queue_message: SQSMessage) -> int:
+        return len(queue_message.body)
+
+    def delivery_attempt(self, provider_metadata: Optional[AWSMetadata]) -> Optional[int]:
+        return provider_metadata.receive_count if provider_metadata is not None else None
 
-    def delete_message(self, queue_message: SQSMessage) -> None:
+    def send_to_dead_letter(self, message_json: str, headers: typing.Dict[str, str]) -> None:
+        if self._dlq_url is None:
+            self._dlq_url = self.sqs_client.get_queue_url(QueueName=self._dlq_name)['QueueUrl']
+        self.sqs_client.send_message(
+            QueueUrl=self._dlq_url,
+            MessageBody=message_json,
+            MessageAttributes={k: {'DataType': 'String', 'StringValue': str(v)} for k, v in headers.items()},
+        )
+
+    def delete_message(self, queue_message: SQSMessage) -> Optional[Future]:
+        if self._delete_batcher is not None:
+            future = self._delete_batcher.add(queue_message.receipt_handle)
+            future.add_done_callback(
+                log_failure('Exception while deleting message', extra={'queue_message': queue_message})
+            )
+            return future
         queue_message.delete()
+        return None
 
     def nack_message(self, queue_message: SQSMessage) -> None:
+        if self._nack_batcher is not None:
+            self._nack_batcher.add(queue_message.receipt_handle).add_done_callback(
+                log_failure('Exception while nacking message', extra={'queue_message': queue_message})
+            )
+            return
         # should operate like a nack https://docs.aws.amazon.com/AWSSimpleQueueService/latest/SQSDeveloperGuide/sqs-visibility-timeout.html#terminating-message-visibility-timeout
         queue_message.change_visibility(VisibilityTimeout=0)
 
+    def _delete_messages(self, receipts: typing.List[str]) -> Dict[int, Exception]:
+        response = self.sqs_client.delete_message_batch(
+            QueueUrl=self.queue_url,
+            Entries=[{'Id': str(index), 'ReceiptHandle': receipt} for index, receipt in enumerate(receipts)],
+        )
+        return self._retry_failed_entries(
+            response,
+            lambda index: self.sqs_client.delete_message(QueueUrl=self.queue_url, ReceiptHandle=receipts[index]),
+        )
+
+    def _nack_messages(self, receipts: typing.List[str]) -> Dict[int, Exception]:
+        return self._change_visibility_batch(receipts, 0)
+
+    def _change_visibility_batch(self, receipts: typing.List[str], visibility_timeout_s: int) -> Dict[int, Exception]:
+        response = self.sqs_client.change_message_visibility_batch(
+            QueueUrl=self.queue_url,
+            Entries=[
+                {'Id': str(index), 'ReceiptHandle': receipt, 'VisibilityTimeout': visibility_timeout_s}
+                for index, receipt in enumerate(receipts)
+            ],
+        )
+        return self._retry_failed_entries(
+            response,
+            lambda index: self.sqs_client.change_message_visibility(
+                QueueUrl=self.queue_url, ReceiptHandle=receipts[index], VisibilityTimeout=visibility_timeout_s
+            ),
+        )
+
+    @staticmethod
+    def _retry_failed_entries(response: typing.Mapping, retry_fn: typing.Callable[[int], Any]) -> Dict[int, Exception]:
+        """
+        Retries entries that failed in a batch request one at a time.
+
+        :return: errors for entries that failed again, keyed by index
+        """
+        failures: Dict[int, Exception] = {}
+        for entry in response.get('Failed', []):
+            index = int(entry['Id'])
+            logger.info(
+                'Retrying failed batch entry',
+                extra={'code': entry.get('Code'), 'sender_fault': entry.get('SenderFault')},
+            )
+            try:
+                retry_fn(index)
+            except Exception as e:
+                failures[index] = e
+        return failures
+
+    def flush(self) -> None:
+        """
+        Sends any batched deletes and visibility changes
+        """
+        if self._delete_batcher is not None:
+            self._delete_batcher.flush()
+        if self._nack_batcher is not None:
+            self._nack_batcher.flush()
+
     def extend_visibility_timeout(
         self,
         visibility_timeout_s: int,
@@ -189,11 +538,29 @@ class AWSSQSConsumerBackend(TaskhawkConsumerBaseBackend):
         if not (bool(metadata) ^ bool(queue_message)):
             raise ValueError("Only one of metadata and queue_message must be given")
         receipt = metadata.receipt if metadata else queue_message.receipt_handle  # type: ignore
-        queue_url = self.sqs_client.get_queue_url(QueueName=self.queue_name)['QueueUrl']
         self.sqs_client.change_message_visibility(
-            QueueUrl=queue_url, ReceiptHandle=receipt, VisibilityTimeout=visibility_timeout_s
+            QueueUrl=self.queue_url, ReceiptHandle=receipt, VisibilityTimeout=visibility_timeout_s
         )
 
+    def extend_visibility_timeouts(
+        self, queue_messages: typing.List[SQSMessage], visibility_timeout_s: int
+    ) -> Dict[int, Exception]:
+        """
+        Extends visibility timeout of several messages, up to 10 per request.
+        """
+        failures: Dict[int, Exception] = {}
+        for offset, chunk in zip(
+            range(0, len(queue_messages), MAX_BATCH_ENTRIES), funcy.chunks(MAX_BATCH_ENTRIES, queue_messages)
+        ):
+            try:
+                chunk_failures = self._change_visibility_batch(
+                    [queue_message.receipt_handle for queue_message in chunk], visibility_timeout_s
+                )
+            except Exception as e:
+                chunk_failures = {index: e for index in range(len(chunk))}
+            failures.update({offset + index: error for index, error in chunk_failures.items()})
+        return failures
+
     def requeue_dead_letter(self, num_messages: int = 10, visibility_timeout: Optional[int] = None) -> None:
         """
         Re-queues everything in the Taskhawk DLQ back into the Taskhawk queue.
@@ -258,7 +625,9 @@ class AWSSNSConsumerBackend(TaskhawkConsumerBaseBackend):
     def requeue_dead_letter(self, num_messages: int = 10, visibility_timeout: Optional[int] = None) -> None:
         raise RuntimeError("invalid operation for backend")
 
-    def pull_messages(self, num_messages: int = 1, visibility_timeout: Optional[int] = None) -> typing.List:
+    def pull_messages(
+        self, num_messages: int = 1, visibility_timeout: Optional[int] = None, wait_time_s: Optional[int] = None
+    ) -> typing.List:
         raise RuntimeError("invalid operation for backend")
 
     def delete_message(self, queue_message) -> None:
@@ -271,6 +640,49 @@ class AWSSNSConsumerBackend(TaskhawkConsumerBaseBackend):
 
     def process_message(self, queue_message) -> None:
         settings.TASKHAWK_PRE_PROCESS_HOOK(sns_record=queue_message)
-        message_json = queue_message['Sns']['Message']
+        attributes = {k: v.get('Value') for k, v in queue_message['Sns'].get('MessageAttributes', {}).items()}
+        message_json = decompress_payload(queue_message['Sns']['Message'], attributes)
         self.message_handler(message_json, None)
         settings.TASKHAWK_POST_PROCESS_HOOK(sns_record=queue_message)
+
+
+class S3BlobStore(BlobStore):
+    """
+    Keeps blobs of large messages in an S3 bucket, under keys starting with `prefix`. Blobs are deleted once their
+    message was processed. Add a lifecycle rule to expire blobs of messages that never are, e.g. after the DLQ
+    retention period.
+    """
+
+    def __init__(self, bucket: str, prefix: str = '') -> None:
+        self.bucket = bucket
+        self.prefix = prefix
+        self._s3_client = None
+        self._client_lock = threading.Lock()
+
+    @property
+    def s3_client(self):
+        if self._s3_client is None:
+            with self._client_lock:
+                if self._s3_client is None:
+                    config = Config(
+                        connect_timeout=settings.AWS_CONNECT_TIMEOUT_S, read_timeout=settings.AWS_READ_TIMEOUT_S
+                    )
+                    self._s3_client = boto3.client(
+                        's3',
+                        region_name=settings.AWS_REGION,
+                        aws_access_key_id=settings.AWS_ACCESS_KEY,
+                        aws_secret_access_key=settings.AWS_SECRET_KEY,
+                        aws_session_token=settings.AWS_SESSION_TOKEN,
+                        endpoint_url=settings.AWS_ENDPOINT_S3,
+                        config=config,
+                    )
+        return self._s3_client
+
+    def put(self, key: str, data: bytes) -> None:
+        self.s3_client.put_object(Bucket=self.bucket, Key=self.prefix + key, Body=data)
+
+    def get(self, key: str) -> bytes:
+        return self.s3_client.get_object(Bucket=self.bucket, Key=self.prefix + key)['Body'].read()
+
+    def delete(self, key: str) -> None:
+        self.s3_client.delete_object(Bucket=self.bucket, Key=self.prefix + key)
@@ -1,27 +1,80 @@
+import asyncio
 from concurrent.futures import Future
+import functools
 import json
 import logging
+import math
+import time
 import typing
 import uuid
 from contextlib import contextmanager
+from contextvars import ContextVar
 from decimal import Decimal
-from typing import Any, Dict, Iterator, Optional
+from typing import Any, Callable, Dict, Iterator, List, Optional
 from unittest import mock
 
 from taskhawk.backends.import_utils import import_class
+from taskhawk.backends.utils import get_blob_store
+from taskhawk.backpressure import Backpressure
+from taskhawk.batches import TaskBatches
+from taskhawk.circuit import CircuitBreakers
+from taskhawk.claim_check import CLAIM_CHECK_FIELD, DEFAULT_MIN_BYTES, check_in
+from taskhawk.compression import ENCODING_ATTRIBUTE, compress_payload
+from taskhawk.concurrency import BoundedExecutor
 from taskhawk.conf import settings
+from taskhawk.dedup import DedupCache
+from taskhawk.drain import Drain
 from taskhawk.exceptions import (
+    ConfigurationError,
     ValidationError,
     IgnoreException,
     LoggingException,
     RetryException,
+    TaskTimeout,
 )
+from taskhawk.lease import Lease, LeaseManager, _current_lease, current_lease
 from taskhawk.models import Message
-
+from taskhawk.retry import ATTEMPT_HEADER, RETRY_AT_HEADER, delivery_attempt
+from taskhawk.watchdog import Watch, Watchdog, _current_watch, report_timeout
 
 logger = logging.getLogger(__name__)
 
 
+BACKPRESSURE_WAIT_S = 1.0
+"""
+How long a fetch waits for the consumer to get under its memory limits before it gives up, so the consumer can check
+whether it's shutting down
+"""
+
+
+_claim_checks: ContextVar[Optional[List[str]]] = ContextVar('taskhawk_claim_checks', default=None)
+"""
+Blob keys of messages whose tasks ran successfully, to be deleted once the message being processed is acked
+"""
+
+_sync_dispatch: ContextVar[bool] = ContextVar('taskhawk_sync_dispatch', default=False)
+"""
+Whether the message being processed was dispatched with ``TASKHAWK_SYNC``. Such messages aren't retried or moved to the
+dead letter queue, their task's exception is raised to the caller instead.
+"""
+
+
+class _Deferral(RetryException):
+    """
+    Raised when a message's task isn't run for now because of its limits or circuit breaker
+    """
+
+
+class _Batched(Exception):
+    """
+    Raised by the message handler when a message was set aside for its task's next batch
+    """
+
+    def __init__(self, message: Message) -> None:
+        super().__init__()
+        self.message = message
+
+
 class TaskhawkBaseBackend:
     @classmethod
     def build(cls, dotted_path: str, *args, **kwargs):
@@ -44,7 +97,11 @@ class TaskhawkPublisherBaseBackend(TaskhawkBaseBackend):
         consumer_backend = get_consumer_backend(priority=message.priority)
         queue_message = self._mock_queue_message(message)
         settings.TASKHAWK_PRE_PROCESS_HOOK(**consumer_backend.pre_process_hook_kwargs(queue_message))
-        consumer_backend.process_message(queue_message)
+        token = _sync_dispatch.set(True)
+        try:
+            consumer_backend.process_message(queue_message)
+        finally:
+            _sync_dispatch.reset(token)
         settings.TASKHAWK_POST_PROCESS_HOOK(**consumer_backend.post_process_hook_kwargs(queue_message))
 
     def _mock_queue_message(self, message: Message) -> mock.Mock:
@@ -76,14 +133,145 @@ class TaskhawkPublisherBaseBackend(TaskhawkBaseBackend):
         instrumentation_headers: Dict[str, str] = {}
         with self._maybe_instrument(message, instrumentation_headers):
             message_body = message.as_dict()
-            new_headers = {**message_body["headers"], **instrumentation_headers}
-            payload = self.message_payload(message_body)
+            payload, new_headers = self._encode(message_body, instrumentation_headers)
             result = self._publish(message, payload, new_headers)
             log_published_message(message_body, result)
             return result
 
+    def _encode(self, message_body: dict, instrumentation_headers: Dict[str, str]) -> typing.Tuple[str, dict]:
+        """
+        Serializes a message, and compresses it if configured to. Args and kwargs of messages that are still too large
+        are offloaded to the blob store if configured to.
+
+        :return: the payload, and the headers to publish it with
+        """
+        headers = {**message_body["headers"], **instrumentation_headers}
+        compression = settings.TASKHAWK_COMPRESSION
+        payload, encoding = compress_payload(self.message_payload(message_body), compression)
+        claim_check = settings.TASKHAWK_CLAIM_CHECK
+        if (
+            claim_check is not None
+            and len(payload) >= claim_check.get('min_bytes', DEFAULT_MIN_BYTES)
+            and CLAIM_CHECK_FIELD not in message_body
+        ):
+            args_json = self.message_payload({'args': message_body['args'], 'kwargs': message_body['kwargs']})
+            message_body = check_in(get_blob_store(), message_body, args_json, compression)
+            payload, encoding = compress_payload(self.message_payload(message_body), compression)
+        if encoding is not None:
+            headers[ENCODING_ATTRIBUTE] = encoding
+        return payload, headers
+
+    def _publish_many(
+        self, entries: typing.List[typing.Tuple[Message, str, typing.Mapping]]
+    ) -> typing.List[typing.Union[str, Future]]:
+        """
+        Publishes several messages, given as tuples of message, payload and headers. Backends that support batch
+        requests override this.
+
+        :return: a message id or a future for each message. Futures of messages that failed hold their exception.
+        """
+        results: typing.List[typing.Union[str, Future]] = []
+        for message, payload, headers in entries:
+            try:
+                results.append(self._publish(message, payload, headers))
+            except Exception as e:
+                results.append(_failed_future(e))
+        return results
+
+    def publish_many(self, messages: typing.List[Message]) -> typing.List[Future]:
+        """
+        Publishes several messages, using batch requests where the provider supports them.
+
+        :return: a future for each message, which resolves to the published message id or to the message's exception
+        """
+        if settings.TASKHAWK_SYNC:
+            results: typing.List[typing.Union[str, Future]] = []
+            for message in messages:
+                try:
+                    results.append(self.publish(message))
+                except Exception as e:
+                    results.append(_failed_future(e))
+            return [_as_future(result) for result in results]
+
+        futures: typing.List[Optional[Future]] = [None] * len(messages)
+        entries: typing.List[typing.Tuple[Message, str, typing.Mapping]] = []
+        indexes = []
+        bodies = []
+        for index, message in enumerate(messages):
+            instrumentation_headers: Dict[str, str] = {}
+            try:
+                with self._maybe_instrument(message, instrumentation_headers):
+                    message_body = message.as_dict()
+                    payload, headers = self._encode(message_body, instrumentation_headers)
+            except Exception as e:
+                futures[index] = _failed_future(e)
+                continue
+            entries.append((message, payload, headers))
+            indexes.append(index)
+            bodies.append(message_body)
+        for index, message_body, result in zip(indexes, bodies, self._publish_many(entries)):
+            future = _as_future(result)
+            log_published_message(message_body, future)
+            futures[index] = future
+        return typing.cast(typing.List[Future], futures)
+
 
 class TaskhawkConsumerBaseBackend(TaskhawkBaseBackend):
+    DEFAULT_VISIBILITY_TIMEOUT_S: Optional[int] = None
+    """
+    The provider default for how long a pulled message stays invisible to other consumers, used when no explicit
+    visibility timeout is given. None if unknown.
+    """
+
+    MAX_PULL_MESSAGES: Optional[int] = None
+    """
+    The most messages the provider returns from a single pull. None if unknown.
+    """
+
+    MAX_VISIBILITY_TIMEOUT_S: Optional[int] = None
+    """
+    The longest the provider allows a message's visibility to be extended by. Retries delayed by longer than this are
+    re-published instead. None if unknown.
+    """
+
+    MANAGES_LEASES = False
+    """
+    Whether the provider's client library extends the visibility of messages being processed by itself, in which case
+    ``TASKHAWK_CONSUMER_LEASE_S`` doesn't apply
+    """
+
+    lease_manager: Optional[LeaseManager] = None
+    """
+    If set, the visibility of messages being processed is extended automatically
+    """
+
+    watchdog: Optional[Watchdog] = None
+    """
+    If set, messages whose tasks run past their timeout are released
+    """
+
+    task_batches: Optional[TaskBatches] = None
+    """
+    If set, messages of batch tasks are collected into batches. Otherwise, batch tasks are called with one message
+    at a time.
+    """
+
+    dedup_cache: Optional[DedupCache] = None
+    """
+    If set, messages that were already processed successfully are acked without running their task again
+    """
+
+    circuit_breakers: Optional[CircuitBreakers] = None
+    """
+    If set, messages of tasks that keep failing are deferred for a while instead of being run
+    """
+
+    max_outstanding: Optional[int] = None
+    """
+    If set, how many messages the consumer works on at once. Backends that receive messages ahead of pulls hold at
+    most this many.
+    """
+
     def heartbeat_hook_kwargs(self) -> dict:
         return {}
 
@@ -96,60 +284,370 @@ class TaskhawkConsumerBaseBackend(TaskhawkBaseBackend):
         return {}
 
     def message_handler(self, message_json: str, provider_metadata) -> None:
+        message = self._prepare_message(message_json, provider_metadata)
+        if not self._before_task(message):
+            return
+        if message.task.batch_size is not None and self.task_batches is not None:
+            raise _Batched(message)
+        with self._retry(message), self._limit(message), self._circuit(message):
+            message.call_task()
+        self._after_task(message)
+
+    async def message_handler_async(self, message_json: str, provider_metadata) -> None:
+        message = self._prepare_message(message_json, provider_metadata)
+        # the dedup cache, re-publishing, the dead letter queue and the blob store are blocking calls
+        if self._may_block_before_task(message):
+            ready = await asyncio.to_thread(self._before_task, message)
+        else:
+            ready = self._before_task(message)
+        if not ready:
+            return
+        try:
+            with self._limit(message), self._circuit(message):
+                await self._call_task_async(message)
+        except Exception as exc:
+            replacement = await asyncio.to_thread(self._retry_exception, message, exc)
+            if replacement is None:
+                raise
+            raise replacement from exc
+        if self.dedup_cache is not None or message.claim_check is not None:
+            await asyncio.to_thread(self._after_task, message)
+
+    @staticmethod
+    async def _call_task_async(message: Message) -> None:
+        timeout_s = message.task.timeout
+        if timeout_s is None:
+            await message.call_task_async()
+            return
+        try:
+            await asyncio.wait_for(message.call_task_async(), timeout_s)
+        except asyncio.TimeoutError:
+            logger.error(
+                'Task timed out',
+                extra={'task': message.task_name, 'message_id': message.id, 'timeout_s': timeout_s},
+            )
+            report_timeout(message.task_name, message.id, timeout_s)
+            raise TaskTimeout(f'Task timed out after {timeout_s} seconds')
+
+    def _before_task(self, message: Message) -> bool:
+        """
+        Checks whether a message's task should run, and fetches its args if they were offloaded
+
+        :return: False if the message is a duplicate that should be acked without running its task
+        """
+        if self._is_duplicate(message):
+            return False
+        self._defer_until_due(message)
+        self._dead_letter_if_exhausted(message)
+        self._check_out(message)
+        return True
+
+    def _may_block_before_task(self, message: Message) -> bool:
+        return (
+            self.dedup_cache is not None
+            or RETRY_AT_HEADER in message.headers
+            or message.claim_check is not None
+            or self._max_attempts(message) is not None
+        )
+
+    def _after_task(self, message: Message) -> None:
+        self._mark_processed(message)
+        self._release_claim_check(message)
+
+    def _prepare_message(self, message_json: str, provider_metadata) -> Message:
         message = self._build_message(message_json, provider_metadata)
         _log_received_message(message.as_dict())
         self._maybe_update_instrumentation(message)
+        self._maybe_limit_lease(message)
+        self._maybe_set_timeout(message)
+        return message
 
-        message.call_task()
+    def fetch_and_process_messages(
+        self,
+        num_messages: int = 1,
+        visibility_timeout: Optional[int] = None,
+        executor: Optional[BoundedExecutor] = None,
+        drain: Optional[Drain] = None,
+        backpressure: Optional[Backpressure] = None,
+    ) -> None:
+        """
+        Pulls a batch of messages and processes them.
 
-    def fetch_and_process_messages(self, num_messages: int = 1, visibility_timeout: Optional[int] = None) -> None:
+        :param num_messages: Maximum number of messages to pull
+        :param visibility_timeout: The number of seconds the message should remain invisible to other queue readers.
+        :param executor: If given, messages are processed concurrently on this executor, and at most as many messages
+            as the executor has free slots are pulled. This call then returns as soon as the messages are submitted.
+        :param drain: If given, messages that haven't started once the consumer is shutting down are nacked instead.
+        :param backpressure: If given, fewer messages are pulled, or none at all, while the consumer is close to its
+            memory limits.
+        """
+        if executor is not None:
+            num_messages = min(num_messages, executor.wait_for_capacity())
+        if backpressure is not None:
+            num_messages = backpressure.capacity(num_messages, timeout=BACKPRESSURE_WAIT_S)
+            if not num_messages:
+                return
         queue_messages = self.pull_messages(num_messages, visibility_timeout)
-        for queue_message in queue_messages:
-            with self._maybe_instrument(**self.pre_process_hook_kwargs(queue_message)):
-                try:
-                    settings.TASKHAWK_PRE_PROCESS_HOOK(**self.pre_process_hook_kwargs(queue_message))
-                except Exception:
-                    logger.exception(
-                        'Exception in post process hook for message', extra={'queue_message': queue_message}
-                    )
-                    continue
+        self.process_queue_messages(queue_messages, executor=executor, drain=drain, backpressure=backpressure)
 
-                try:
-                    self.process_message(queue_message)
-                except IgnoreException:
-                    logger.info('Ignoring task', extra={'queue_message': queue_message})
-                except LoggingException as e:
-                    # log with message and extra
-                    logger.exception(str(e), extra=e.extra)
-                    self.nack_message(queue_message)
-                    continue
-                except RetryException as exc:
-                    # Retry without logging exception
-                    if exc.delay_seconds > 0:
-                        logger.info(f'Retrying with delay {exc.delay_seconds} seconds')
-                        self.extend_visibility_timeout(exc.delay_seconds, queue_message=queue_message)
-                        # the `continue` below will prevent the `self.delete_message` call from deleting the message from the queue.
-                    else:
-                        logger.info('Retrying due to exception')
-                        self.nack_message(queue_message)
-                    continue
-                except Exception:
-                    logger.exception('Exception while processing message')
-                    self.nack_message(queue_message)
-                    continue
+    def process_queue_messages(
+        self,
+        queue_messages: typing.List,
+        executor: Optional[BoundedExecutor] = None,
+        drain: Optional[Drain] = None,
+        backpressure: Optional[Backpressure] = None,
+        pulled_at: Optional[float] = None,
+    ) -> typing.List[Future]:
+        """
+        Processes a batch of messages that was already pulled.
+
+        :param queue_messages: Messages returned by `pull_messages`
+        :param executor: If given, messages are processed concurrently on this executor. See
+            `fetch_and_process_messages`.
+        :param drain: If given, messages that haven't started once the consumer is shutting down are nacked instead.
+        :param backpressure: If given, payload bytes of messages are counted until they're processed.
+        :param pulled_at: `time.monotonic()` at which the batch was pulled, if it waited before being handed over.
+            Defaults to now.
+        :return: futures of the messages submitted to `executor`, which are done once the messages were processed
+        """
+        futures = []
+        # lease the whole batch right away, so messages waiting for their turn don't reach their visibility timeout
+        leases = self._acquire_leases(queue_messages, pulled_at)
+        for queue_message, lease in zip(queue_messages, leases):
+            if backpressure is not None:
+                backpressure.acquire(queue_message, self.message_size(queue_message))
+            if executor is not None:
+                futures.append(executor.submit(self._process_queue_message, queue_message, drain, backpressure, lease))
+            else:
+                self._process_queue_message(queue_message, drain, backpressure, lease)
+        if executor is None and queue_messages:
+            # settle the whole batch at once rather than waiting for batched acks to time out
+            self.flush()
+        return futures
+
+    def _process_queue_message(
+        self,
+        queue_message,
+        drain: Optional[Drain] = None,
+        backpressure: Optional[Backpressure] = None,
+        lease: Optional[Lease] = None,
+    ) -> Optional[Future]:
+        """
+        Runs a single queue message through hooks and the task, and acks or nacks it depending on the result.
+
+        :param lease: Lease taken out when the message was pulled, if any
+        :return: if the message was added to a batch, a future that's done once it was settled, otherwise None
+        """
+        settled = None
+        try:
+            if not self._begin_draining(queue_message, drain, lease):
+                return None
+            try:
+                settled = self._process_started_queue_message(queue_message, drain, lease)
+            finally:
+                # messages added to a batch are tracked until they're settled
+                if drain is not None and settled is None:
+                    drain.end(queue_message)
+        finally:
+            if lease is not None:
+                # the message may have been settled without running, e.g. if the consumer is shutting down
+                self._release_lease(lease)
+            if backpressure is not None:
+                if settled is None:
+                    backpressure.release(queue_message)
+                else:
+                    # the message is still held in memory until its batch ran
+                    settled.add_done_callback(lambda _: backpressure.release(queue_message))
+        return settled
 
+    def _process_started_queue_message(
+        self, queue_message, drain: Optional[Drain], lease: Optional[Lease]
+    ) -> Optional[Future]:
+        with self._maybe_instrument(**self.pre_process_hook_kwargs(queue_message)):
+            if not self._call_pre_process_hook(queue_message):
+                return None
+
+            settle = None
+            # stop extending visibility before the message is settled, so an extension doesn't undo a nack
+            with self._maybe_lease(queue_message, lease), self._maybe_watch(queue_message) as watch:
                 try:
-                    settings.TASKHAWK_POST_PROCESS_HOOK(**self.post_process_hook_kwargs(queue_message))
-                except Exception:
-                    logger.exception(
-                        'Exception in post process hook for message', extra={'queue_message': queue_message}
-                    )
-                    continue
+                    with self._collect_claim_checks() as claim_checks:
+                        self.process_message(queue_message)
+                except _Batched as batched:
+                    # the message is settled once its batch ran
+                    return typing.cast(TaskBatches, self.task_batches).add(self, queue_message, batched.message, drain)
+                except Exception as exc:
+                    settle = self._handle_task_exception(queue_message, exc)
+            if not self._still_owned(queue_message, drain) or self._timed_out(queue_message, watch):
+                return None
+            if settle is not None:
+                settle()
+                return None
+
+            if not self._call_post_process_hook(queue_message):
+                return None
+
+            self._ack_message(queue_message, claim_checks)
+            return None
 
+    async def _process_queue_message_async(
+        self,
+        queue_message,
+        drain: Optional[Drain] = None,
+        backpressure: Optional[Backpressure] = None,
+        lease: Optional[Lease] = None,
+    ) -> None:
+        """
+        Same as `_process_queue_message`, but awaits coroutine tasks on the running event loop. Blocking calls to the
+        cloud provider and hooks are run on the default executor.
+        """
+        try:
+            if not self._begin_draining(queue_message, drain, lease):
+                return
+            try:
+                await self._process_started_queue_message_async(queue_message, drain, lease)
+            finally:
+                if drain is not None:
+                    drain.end(queue_message)
+        finally:
+            if lease is not None:
+                self._release_lease(lease)
+            if backpressure is not None:
+                backpressure.release(queue_message)
+
+    async def _process_started_queue_message_async(
+        self, queue_message, drain: Optional[Drain], lease: Optional[Lease] = None
+    ) -> None:
+        with self._maybe_instrument(**self.pre_process_hook_kwargs(queue_message)):
+            if not await asyncio.to_thread(self._call_pre_process_hook, queue_message):
+                return
+
+            settle = None
+            # stop extending visibility before the message is settled, so an extension doesn't undo a nack
+            with self._maybe_lease(queue_message, lease):
                 try:
-                    self.delete_message(queue_message)
-                except Exception:
-                    logger.exception('Exception while deleting message', extra={'queue_message': queue_message})
+                    with self._collect_claim_checks() as claim_checks:
+                        await self.process_message_async(queue_message)
+                except Exception as exc:
+                    settle = self._handle_task_exception(queue_message, exc)
+            if not self._still_owned(queue_message, drain):
+                return
+            if settle is not None:
+                await asyncio.to_thread(settle)
+                return
+
+            if not await asyncio.to_thread(self._call_post_process_hook, queue_message):
+                return
+
+            await asyncio.to_thread(self._ack_message, queue_message, claim_checks)
+
+    def _begin_draining(self, queue_message, drain: Optional[Drain], lease: Optional[Lease] = None) -> bool:
+        if drain is None or drain.begin(self, queue_message):
+            return True
+        logger.info('Consumer is shutting down, releasing message', extra={'queue_message': queue_message})
+        if lease is not None:
+            # so an extension doesn't undo the nack
+            self._release_lease(lease)
+        try:
+            self.nack_message(queue_message)
+        except Exception:
+            logger.exception('Exception while nacking message', extra={'queue_message': queue_message})
+        return False
+
+    @staticmethod
+    def _still_owned(queue_message, drain: Optional[Drain]) -> bool:
+        if drain is None or drain.end(queue_message):
+            return True
+        logger.warning(
+            'Message was released when the drain deadline passed, ignoring its outcome',
+            extra={'queue_message': queue_message},
+        )
+        return False
+
+    def _call_pre_process_hook(self, queue_message) -> bool:
+        try:
+            settings.TASKHAWK_PRE_PROCESS_HOOK(**self.pre_process_hook_kwargs(queue_message))
+            return True
+        except Exception:
+            logger.exception('Exception in post process hook for message', extra={'queue_message': queue_message})
+            return False
+
+    def _call_post_process_hook(self, queue_message) -> bool:
+        try:
+            settings.TASKHAWK_POST_PROCESS_HOOK(**self.post_process_hook_kwargs(queue_message))
+            return True
+        except Exception:
+            logger.exception('Exception in post process hook for message', extra={'queue_message': queue_message})
+            return False
+
+    def _settle_batched(self, queue_message, message: Message, error: Optional[BaseException]) -> None:
+        """
+        Acks or nacks a message of a batch task, once its batch ran.
+        """
+        settle = None
+        if error is not None:
+            try:
+                raise error
+            except Exception as exc:
+                settle = self._handle_task_exception(queue_message, self._retry_exception(message, exc) or exc)
+        else:
+            self._mark_processed(message)
+        if settle is not None:
+            settle()
+            return
+
+        if not self._call_post_process_hook(queue_message):
+            return
+
+        claim_checks = [message.claim_check['key']] if error is None and message.claim_check is not None else []
+        self._ack_message(queue_message, claim_checks)
+
+    def _handle_task_exception(self, queue_message, exc: Exception) -> Optional[Callable[[], None]]:
+        """
+        Logs an exception raised while processing a message, and decides what should happen to the message. Must be
+        called from the `except` block that caught `exc`.
+
+        :return: a callable that nacks the message or delays its retry, or None if the message should still be acked.
+        """
+        if isinstance(exc, IgnoreException):
+            logger.info('Ignoring task', extra={'queue_message': queue_message})
+            return None
+        if isinstance(exc, LoggingException):
+            # log with message and extra
+            logger.exception(str(exc), extra=exc.extra)
+            return functools.partial(self.nack_message, queue_message)
+        if isinstance(exc, RetryException):
+            # Retry without logging exception
+            if exc.delay_seconds > 0:
+                logger.info(f'Retrying with delay {exc.delay_seconds} seconds')
+                return functools.partial(self.extend_visibility_timeout, exc.delay_seconds, queue_message=queue_message)
+            logger.info('Retrying due to exception')
+            return functools.partial(self.nack_message, queue_message)
+        logger.exception('Exception while processing message')
+        return functools.partial(self.nack_message, queue_message)
+
+    def _ack_message(self, queue_message, claim_checks: List[str]) -> None:
+        """
+        Acks a message, and deletes the blobs of its claim checks once the ack went through. If the backend buffers
+        acks, that's once the buffered ack was sent.
+        """
+        try:
+            ack = self.delete_message(queue_message)
+        except Exception:
+            logger.exception('Exception while deleting message', extra={'queue_message': queue_message})
+            return
+        if not claim_checks:
+            return
+        if not isinstance(ack, Future):
+            self._delete_blobs(claim_checks)
+            return
+
+        def _on_acked(future: Future) -> None:
+            # a message whose ack failed is redelivered, and still needs its blobs
+            if future.exception() is None:
+                self._delete_blobs(claim_checks)
+
+        ack.add_done_callback(_on_acked)
 
     def extend_visibility_timeout(
         self, visibility_timeout_s: int, metadata: Optional[Any] = None, queue_message: Optional[Any] = None
@@ -159,34 +657,97 @@ class TaskhawkConsumerBaseBackend(TaskhawkBaseBackend):
         """
         raise NotImplementedError
 
+    def send_to_dead_letter(self, message_json: str, headers: Dict[str, str]) -> None:
+        """
+        Publishes a message straight to the dead letter queue
+        """
+        raise NotImplementedError
+
+    def delivery_attempt(self, provider_metadata) -> Optional[int]:
+        """
+        Returns how many times a message was delivered, including this delivery, if the provider reports it
+        """
+        return None
+
+    def extend_visibility_timeouts(
+        self, queue_messages: typing.List, visibility_timeout_s: int
+    ) -> Dict[int, Exception]:
+        """
+        Extends visibility timeout of several messages, in as few requests as possible.
+
+        :return: errors for messages that couldn't be extended, keyed by index
+        """
+        failures: Dict[int, Exception] = {}
+        for index, queue_message in enumerate(queue_messages):
+            try:
+                self.extend_visibility_timeout(visibility_timeout_s, queue_message=queue_message)
+            except Exception as e:
+                failures[index] = e
+        return failures
+
     def requeue_dead_letter(self, num_messages: int = 10, visibility_timeout: Optional[int] = None) -> None:
         """
         Re-queues everything in the Taskhawk DLQ back into the Taskhawk queue.
         """
         raise NotImplementedError
 
-    def pull_messages(self, num_messages: int = 1, visibility_timeout: Optional[int] = None) -> typing.List:
+    def pull_messages(
+        self, num_messages: int = 1, visibility_timeout: Optional[int] = None, wait_time_s: Optional[int] = None
+    ) -> typing.List:
         """
         Pulls messages from the cloud for this app.
         :param num_messages:
         :param visibility_timeout:
+        :param wait_time_s: How long to wait for messages if there are none. Defaults to None, which is the backend
+            default.
         :return: a tuple of list of messages and the queue they were pulled from
         """
         raise NotImplementedError
 
     def process_message(self, queue_message) -> None:
+        self.message_handler(*self._decode_queue_message(queue_message))
+
+    async def process_message_async(self, queue_message) -> None:
+        await self.message_handler_async(*self._decode_queue_message(queue_message))
+
+    def _decode_queue_message(self, queue_message) -> typing.Tuple[str, Any]:
+        """
+        Extracts the message json and provider metadata from a queue message
+        """
         raise NotImplementedError
 
+    def message_size(self, queue_message) -> int:
+        """
+        Returns the size of a queue message's payload, used to limit how much the consumer holds in memory
+        """
+        return len(self._decode_queue_message(queue_message)[0])
+
     def process_messages(self, lambda_event) -> None:
         # for lambda backend
         raise NotImplementedError
 
-    def delete_message(self, queue_message) -> None:
+    def delete_message(self, queue_message) -> Optional[Future]:
+        """
+        Acks a message.
+
+        :return: a future that resolves once the ack was sent, if the backend buffers acks
+        """
         raise NotImplementedError
 
     def nack_message(self, queue_message) -> None:
         raise NotImplementedError
 
+    def flush(self) -> None:
+        """
+        Sends any acks or nacks the backend has buffered to batch them.
+        """
+
+    def close(self) -> None:
+        """
+        Flushes any work the backend buffers, such as batched acks. This is called when a consumer shuts down.
+        """
+        self.flush()
+
     def call_heartbeat_hook(self):
         try:
             settings.TASKHAWK_HEARTBEAT_HOOK(**self.heartbeat_hook_kwargs())
@@ -217,6 +778,344 @@ class TaskhawkConsumerBaseBackend(TaskhawkBaseBackend):
         except ImportError:
             yield None
 
+    @contextmanager
+    def _limit(self, message: Message) -> Iterator[None]:
+        """
+        Enforces the task's concurrency and rate limits. Messages over a limit are retried after a delay instead of
+        being run.
+        """
+        limiter = message.task.limiter
+        if limiter is None:
+            yield
+            return
+        delay_s = limiter.acquire()
+        if delay_s is not None:
+            logger.info('Task is over its limits, deferring message', extra={'task': message.task_name})
+            raise _Deferral(max(1, math.ceil(delay_s)))
+        try:
+            yield
+        finally:
+            limiter.release()
+
+    def _deferral(self, message: Message, delay_s: int) -> Exception:
+        """
+        Retries a message that wasn't run after `delay_s`. If the message's delivery attempts are counted, it's
+        re-published, so that being deferred doesn't count as an attempt. Otherwise, its visibility is extended by as
+        much as the provider allows, and it's simply deferred again if it's still not due by then.
+        """
+        if self._max_attempts(message) is not None:
+            # this delivery didn't run the task
+            attempt = delivery_attempt(message.headers, self.delivery_attempt(message.provider_metadata)) - 1
+            try:
+                self._republish(
+                    message,
+                    {
+                        **message.headers,
+                        RETRY_AT_HEADER: str(int((time.time() + delay_s) * 1000)),
+                        ATTEMPT_HEADER: str(attempt),
+                    },
+                )
+            except Exception:
+                logger.exception('Exception while re-publishing deferred message', extra={'message_id': message.id})
+            else:
+                return IgnoreException(f'Message was re-published to be retried in {delay_s} seconds')
+        if self.MAX_VISIBILITY_TIMEOUT_S is not None:
+            delay_s = min(delay_s, self.MAX_VISIBILITY_TIMEOUT_S)
+        return RetryException(delay_s)
+
+    def _defer_until_due(self, message: Message) -> None:
+        """
+        Defers a message that was re-published for a delayed retry, until the retry is due
+        """
+        retry_at = message.headers.get(RETRY_AT_HEADER)
+        if retry_at is None:
+            return
+        remaining_s = math.ceil(int(retry_at) / 1000 - time.time())
+        if remaining_s <= 0:
+            return
+        max_delay_s = self.MAX_VISIBILITY_TIMEOUT_S
+        if max_delay_s is not None and remaining_s > max_delay_s:
+            # re-publish rather than extend, so that waiting doesn't count towards the message's delivery attempts
+            self._republish(message, message.headers)
+            raise IgnoreException('Message was re-published until its retry is due')
+        logger.info('Message is scheduled for a later retry, deferring', extra={'message_id': message.id})
+        raise RetryException(remaining_s)
+
+    def _max_attempts(self, message: Message) -> Optional[int]:
+        max_attempts = message.task.max_attempts
+        if max_attempts is None:
+            max_attempts = settings.TASKHAWK_CONSUMER_MAX_ATTEMPTS
+        return max_attempts
+
+    def _dead_letter_if_exhausted(self, message: Message) -> None:
+        """
+        Moves a message that was already delivered more than its maximum attempts to the dead letter queue, without
+        running its task. This catches messages whose failures weren't seen, e.g. because their consumer crashed.
+        """
+        max_attempts = self._max_attempts(message)
+        if max_attempts is None or _sync_dispatch.get():
+            return
+        attempt = delivery_attempt(message.headers, self.delivery_attempt(message.provider_metadata))
+        if attempt > max_attempts and self._dead_letter(message, attempt):
+            raise IgnoreException('Message was moved to the dead letter queue')
+
+    def _dead_letter(self, message: Message, attempt: int) -> bool:
+        """
+        Publishes a message to the dead letter queue
+
+        :return: True if the message was published, and should be acked
+        """
+        data = message.as_dict()
+        data['headers'] = {k: v for k, v in data['headers'].items() if k not in (RETRY_AT_HEADER, ATTEMPT_HEADER)}
+        try:
+            self.send_to_dead_letter(self.message_payload(data), data['headers'])
+        except Exception:
+            logger.exception(
+                'Exception while moving message to the dead letter queue', extra={'message_id': message.id}
+            )
+            return False
+        logger.warning(
+            'Message ran out of attempts, moved it to the dead letter queue',
+            extra={'task': message.task_name, 'message_id': message.id, 'attempt': attempt},
+        )
+        return True
+
+    @contextmanager
+    def _retry(self, message: Message) -> Iterator[None]:
+        """
+        Applies the task's maximum attempts and retry policy to messages that fail
+        """
+        try:
+            yield
+        except Exception as exc:
+            replacement = self._retry_exception(message, exc)
+            if replacement is None:
+                raise
+            raise replacement from exc
+
+    def _retry_exception(self, message: Message, exc: BaseException) -> Optional[Exception]:
+        """
+        Decides how a failed message is retried, from its task's maximum attempts and retry policy.
+
+        :return: an exception to handle in place of `exc`, or None if `exc` should be handled as is
+        """
+        if not isinstance(exc, Exception) or isinstance(exc, IgnoreException) or _sync_dispatch.get():
+            return None
+        if isinstance(exc, _Deferral):
+            # the task didn't run, so this isn't a failed attempt
+            return self._deferral(message, exc.delay_seconds)
+        if isinstance(exc, RetryException) and exc.delay_seconds > 0:
+            # the task asked for a specific delay
+            return None
+        max_attempts = self._max_attempts(message)
+        policy = message.task.retry
+        if max_attempts is None and policy is None:
+            return None
+        # may be called from another thread than the one that caught exc
+        if isinstance(exc, LoggingException):
+            logger.error(str(exc), exc_info=exc, extra=exc.extra)
+        elif not isinstance(exc, RetryException):
+            logger.error('Exception while processing message', exc_info=exc)
+
+        attempt = delivery_attempt(message.headers, self.delivery_attempt(message.provider_metadata))
+        if max_attempts is not None and attempt >= max_attempts and self._dead_letter(message, attempt):
+            return IgnoreException('Message was moved to the dead letter queue')
+        if policy is None:
+            return RetryException()
+        delay_s = policy.delay(attempt)
+        max_delay_s = self.MAX_VISIBILITY_TIMEOUT_S
+        if max_delay_s is None or delay_s <= max_delay_s:
+            return RetryException(delay_s)
+        try:
+            self._republish(
+                message,
+                {
+                    **message.headers,
+                    RETRY_AT_HEADER: str(int((time.time() + delay_s) * 1000)),
+                    ATTEMPT_HEADER: str(attempt),
+                },
+            )
+        except Exception:
+            logger.exception('Exception while re-publishing message for retry', extra={'message_id': message.id})
+            return RetryException(max_delay_s)
+        return IgnoreException(f'Message was re-published to be retried in {delay_s} seconds')
+
+    @staticmethod
+    def _republish(message: Message, headers: dict) -> None:
+        """
+        Re-publishes a message with different headers
+        """
+        from taskhawk.publisher import publish
+
+        retry_message = Message.new(
+            message.task_name,
+            message.priority,
+            tuple(message.args),
+            message.kwargs,
+            msg_id=message.id,
+            headers=headers,
+            claim_check=message.claim_check,
+        )
+        result = publish(retry_message)
+        if isinstance(result, Future):
+            result.result()
+        logger.info('Re-published message for a later retry', extra={'message_id': message.id})
+
+    @contextmanager
+    def _circuit(self, message: Message) -> Iterator[None]:
+        """
+        Records the outcome of the task in its circuit breaker. While the breaker is open, messages are retried after
+        a delay instead of being run.
+        """
+        if self.circuit_breakers is None:
+            yield
+            return
+        breaker = self.circuit_breakers.get(message.task_name)
+        delay_s = breaker.allow()
+        if delay_s is not None:
+            logger.info('Circuit breaker of task is open, deferring message', extra={'task': message.task_name})
+            raise _Deferral(max(1, math.ceil(delay_s)))
+        try:
+            yield
+        except IgnoreException:
+            breaker.record(True)
+            raise
+        except Exception:
+            breaker.record(False)
+            raise
+        breaker.record(True)
+
+    def _acquire_leases(self, queue_messages: typing.List, pulled_at: Optional[float]) -> typing.List[Optional[Lease]]:
+        lease_manager = self.lease_manager
+        if lease_manager is None:
+            return [None] * len(queue_messages)
+        return [lease_manager.acquire(queue_message, pulled_at) for queue_message in queue_messages]
+
+    def _release_lease(self, lease: Lease) -> None:
+        lease_manager = self.lease_manager
+        if lease_manager is not None:
+            lease_manager.release(lease)
+
+    @contextmanager
+    def _maybe_lease(self, queue_message, lease: Optional[Lease] = None) -> Iterator:
+        lease_manager = self.lease_manager
+        if lease is None:
+            if lease_manager is None:
+                yield
+                return
+            lease = lease_manager.acquire(queue_message)
+        token = _current_lease.set(lease)
+        try:
+            yield
+        finally:
+            _current_lease.reset(token)
+            self._release_lease(lease)
+
+    @contextmanager
+    def _maybe_watch(self, queue_message) -> Iterator[Optional[Watch]]:
+        watchdog = self.watchdog
+        if watchdog is None:
+            yield None
+            return
+        watch = watchdog.watch(self, queue_message, current_lease())
+        token = _current_watch.set(watch)
+        try:
+            yield watch
+        finally:
+            _current_watch.reset(token)
+            watchdog.unwatch(watch)
+
+    @staticmethod
+    def _timed_out(queue_message, watch: Optional[Watch]) -> bool:
+        if watch is None or not watch.timed_out:
+            return False
+        logger.warning(
+            'Message was released when its task timed out, ignoring its outcome', extra={'queue_message': queue_message}
+        )
+        return True
+
+    def _maybe_set_timeout(self, message: Message) -> None:
+        watch = _current_watch.get()
+        if watch is not None and self.watchdog is not None and message.task.timeout is not None:
+            self.watchdog.set_timeout(watch, message.task_name, message.id, message.task.timeout)
+
+    def _is_duplicate(self, message: Message) -> bool:
+        dedup_cache = self.dedup_cache
+        if dedup_cache is None:
+            return False
+        try:
+            seen = dedup_cache.seen(message.id)
+        except Exception:
+            logger.exception('Exception while looking up message in dedup cache', extra={'message_id': message.id})
+            return False
+        if seen:
+            logger.info(
+                'Message was already processed, skipping duplicate',
+                extra={'task': message.task_name, 'message_id': message.id},
+            )
+        return seen
+
+    def _mark_processed(self, message: Message) -> None:
+        dedup_cache = self.dedup_cache
+        if dedup_cache is None:
+            return
+        try:
+            dedup_cache.add(message.id)
+        except Exception:
+            logger.exception('Exception while adding message to dedup cache', extra={'message_id': message.id})
+
+    @staticmethod
+    def _check_out(message: Message) -> None:
+        """
+        Fetches args and kwargs of a message that were offloaded to the blob store, right before its task runs
+        """
+        if message.claim_check is None:
+            return
+        store = get_blob_store()
+        if store is None:
+            raise ConfigurationError("Message args were offloaded to a blob store, but TASKHAWK_CLAIM_CHECK isn't set")
+        message.check_out(store)
+
+    def _release_claim_check(self, message: Message) -> None:
+        """
+        Deletes the blob of a message whose task ran successfully, once the message is acked
+        """
+        if message.claim_check is None:
+            return
+        claim_checks = _claim_checks.get()
+        if claim_checks is None:
+            # not acked by the consumer, e.g. on Lambda
+            self._delete_blobs([message.claim_check['key']])
+            return
+        claim_checks.append(message.claim_check['key'])
+
+    @staticmethod
+    @contextmanager
+    def _collect_claim_checks() -> Iterator[List[str]]:
+        claim_checks: List[str] = []
+        token = _claim_checks.set(claim_checks)
+        try:
+            yield claim_checks
+        finally:
+            _claim_checks.reset(token)
+
+    @staticmethod
+    def _delete_blobs(keys: List[str]) -> None:
+        if not keys:
+            return
+        store = get_blob_store()
+        for key in keys:
+            try:
+                store.delete(key)
+            except Exception:
+                logger.exception('Exception while deleting message blob', extra={'key': key})
+
+    @staticmethod
+    def _maybe_limit_lease(message: Message) -> None:
+        lease = current_lease()
+        if lease is not None and message.task.max_lease_s is not None:
+            lease.max_lease_s = message.task.max_lease_s
+
     def _maybe_update_instrumentation(self, message: Message) -> None:
         try:
             import taskhawk.instrumentation
@@ -236,12 +1135,32 @@ def _decimal_json_default(obj):
     raise TypeError
 
 
+def _as_future(result: typing.Union[str, Future]) -> Future:
+    if isinstance(result, Future):
+        return result
+    future: Future = Future()
+    future.set_result(result)
+    return future
+
+
+def _failed_future(error: BaseException) -> Future:
+    future: Future = Future()
+    future.set_exception(error)
+    return future
+
+
 def log_published_message(message_body: dict, result: typing.Union[str, Future]) -> None:
     def _log(message_id: str):
         logger.debug('Sent message', extra={'message_body': message_body, 'message_id': message_id})
 
     if isinstance(result, Future):
-        result.add_done_callback(lambda f: _log(f.result()))
+
+        def _on_done(future: Future) -> None:
+            # failures are up to whoever holds the future
+            if future.exception() is None:
+                _log(future.result())
+
+        result.add_done_callback(_on_done)
     else:
         _log(result)
 
@@ -0,0 +1,136 @@
+import logging
+import threading
+import time
+import typing
+from concurrent.futures import Future
+from typing import Callable, Generic, List, Mapping, Optional, Tuple, TypeVar
+
+
+logger = logging.getLogger(__name__)
+
+
+T = TypeVar('T')
+
+
+class Batcher(Generic[T]):
+    """
+    Accumulates items and hands them to `flush_fn` in batches. A batch is sent once `max_items` items are pending, or
+    once the oldest pending item has waited for `max_latency_s`, whichever happens first. Batches are sent from a
+    background thread that's started on first use.
+
+    `flush_fn` is called with a list of at most `max_items` items. It may return a mapping of index (in that list) to
+    exception for items that failed individually. If it raises, all items in the batch fail with that exception.
+
+    If `max_pending` is set, `add` blocks while that many items are pending, until the next batch is taken.
+    """
+
+    def __init__(
+        self,
+        flush_fn: Callable[[List[T]], Optional[Mapping[int, BaseException]]],
+        max_items: int,
+        max_latency_s: float,
+        name: str = 'taskhawk-batcher',
+        max_pending: Optional[int] = None,
+    ) -> None:
+        if max_items <= 0:
+            raise ValueError("max_items must be greater than zero")
+        if max_latency_s < 0:
+            raise ValueError("max_latency_s must not be negative")
+        if max_pending is not None and max_pending <= 0:
+            raise ValueError("max_pending must be greater than zero")
+        self._flush_fn = flush_fn
+        self._max_items = max_items
+        self._max_latency_s = max_latency_s
+        self._max_pending = max_pending
+        self._name = name
+        self._pending: List[Tuple[T, Future]] = []
+        self._oldest_at = 0.0
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def max_items(self) -> int:
+        return self._max_items
+
+    def add(self, item: T) -> Future:
+        """
+        Adds an item to the next batch.
+
+        :return: a future that resolves to None once the item's batch was sent, or to the item's exception
+        """
+        future: Future = Future()
+        with self._cond:
+            if self._max_pending is not None:
+                self._cond.wait_for(lambda: len(self._pending) < typing.cast(int, self._max_pending))
+            if not self._pending:
+                self._oldest_at = time.monotonic()
+            self._pending.append((item, future))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self._name, daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+        return future
+
+    def flush(self) -> None:
+        """
+        Sends all pending items from the calling thread, and blocks until they've been sent.
+        """
+        while True:
+            with self._cond:
+                batch = self._take_batch()
+            if not batch:
+                return
+            self._send(batch)
+
+    def _take_batch(self) -> List[Tuple[T, Future]]:
+        batch = self._pending[: self._max_items]
+        del self._pending[: self._max_items]
+        if self._pending:
+            # remaining items were added after the sent ones, so this is conservative
+            self._oldest_at = time.monotonic()
+        if batch:
+            # wake up adds waiting for room
+            self._cond.notify_all()
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: bool(self._pending))
+                while len(self._pending) < self._max_items:
+                    remaining = self._oldest_at + self._max_latency_s - time.monotonic()
+                    if remaining <= 0 or not self._pending:
+                        break
+                    self._cond.wait(remaining)
+                batch = self._take_batch()
+            if batch:
+                self._send(batch)
+
+    def _send(self, batch: List[Tuple[T, Future]]) -> None:
+        items = [item for item, _ in batch]
+        try:
+            failures = self._flush_fn(items) or {}
+        except Exception as e:
+            logger.exception(f'Exception while sending batch of {len(items)} items', extra={'batcher': self._name})
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for index, (_, future) in enumerate(batch):
+            error = failures.get(index)
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(None)
+
+
+def log_failure(message: str, extra: typing.Optional[dict] = None) -> Callable[[Future], None]:
+    """
+    Returns a future callback that logs `message` if the future failed
+    """
+
+    def _callback(future: Future) -> None:
+        exc = future.exception()
+        if exc is not None:
+            logger.error(message, exc_info=exc, extra=extra)
+
+    return _callback
@@ -1,23 +1,32 @@
+import concurrent.futures
 import dataclasses
 import json
 import logging
+import queue
+import threading
 import typing
 from contextlib import contextmanager, ExitStack
 from datetime import datetime, timedelta
 from typing import cast, Generator, Optional
 from unittest import mock
 
-from google.api_core.exceptions import DeadlineExceeded, ServiceUnavailable
+import funcy
+from google.api_core.exceptions import DeadlineExceeded, NotFound, ServiceUnavailable
 from google.auth import environment_vars as google_env_vars, default as google_auth_default
 from google.cloud import pubsub_v1
 from google.cloud.pubsub_v1.futures import Future
+from google.cloud.pubsub_v1.subscriber.futures import StreamingPullFuture
+from google.cloud.pubsub_v1.subscriber.message import Message as PubSubMessage
 from google.cloud.pubsub_v1.types import ReceivedMessage
 
 from taskhawk.backends.base import (
     TaskhawkPublisherBaseBackend,
     TaskhawkConsumerBaseBackend,
 )
+from taskhawk.backends.batching import Batcher, log_failure
 from taskhawk.backends.utils import override_env
+from taskhawk.claim_check import BlobStore
+from taskhawk.compression import decompress_payload
 from taskhawk.conf import settings
 from taskhawk.models import Message, Priority
 
@@ -25,6 +34,13 @@ from taskhawk.models import Message, Priority
 logger = logging.getLogger(__name__)
 
 
+MAX_ACK_IDS_PER_REQUEST = 2500
+"""
+Maximum number of ack ids sent in a single acknowledge or modify_ack_deadline request, which keeps requests well under
+the Pub/Sub request size limit
+"""
+
+
 @contextmanager
 def _seed_credentials() -> Generator[None, None, None]:
     """
@@ -94,6 +110,21 @@ def get_priority_suffix(priority: Priority) -> str:
     return ''
 
 
+def _batch_settings() -> pubsub_v1.types.BatchSettings:
+    config = settings.TASKHAWK_PUBLISHER_GCP_BATCH_SETTINGS
+    if isinstance(config, typing.Mapping):
+        return pubsub_v1.types.BatchSettings(**config)
+    return pubsub_v1.types.BatchSettings(*config)
+
+
+def _publish_flow_control() -> pubsub_v1.types.PublishFlowControl:
+    config = dict(settings.TASKHAWK_PUBLISHER_GCP_FLOW_CONTROL)
+    behavior = config.get('limit_exceeded_behavior')
+    if isinstance(behavior, str):
+        config['limit_exceeded_behavior'] = pubsub_v1.types.LimitExceededBehavior(behavior.lower())
+    return pubsub_v1.types.PublishFlowControl(**config)
+
+
 class GooglePubSubAsyncPublisherBackend(TaskhawkPublisherBaseBackend):
     def __init__(self, priority: Priority) -> None:
         self._publisher = None
@@ -107,7 +138,10 @@ class GooglePubSubAsyncPublisherBackend(TaskhawkPublisherBaseBackend):
     def publisher(self):
         if self._publisher is None:
             with _seed_credentials():
-                self._publisher = pubsub_v1.PublisherClient()
+                self._publisher = pubsub_v1.PublisherClient(
+                    batch_settings=_batch_settings(),
+                    publisher_options=pubsub_v1.types.PublisherOptions(flow_control=_publish_flow_control()),
+                )
         return self._publisher
 
     def publish_to_topic(
@@ -125,7 +159,9 @@ class GooglePubSubAsyncPublisherBackend(TaskhawkPublisherBaseBackend):
         gcp_message = mock.Mock()
         gcp_message.message = mock.Mock()
         gcp_message.message.data = json.dumps(message.as_dict()).encode('utf8')
+        gcp_message.message.attributes = {}
         gcp_message.ack_id = 'test-receipt'
+        gcp_message.delivery_attempt = None
         return gcp_message
 
     def _publish(
@@ -143,13 +179,42 @@ class GooglePubSubPublisherBackend(GooglePubSubAsyncPublisherBackend):
     ) -> typing.Union[str, Future]:
         return cast(Future, super().publish_to_topic(topic_path, data, attrs)).result()
 
+    def _publish_many(
+        self, entries: typing.List[typing.Tuple[Message, str, typing.Mapping]]
+    ) -> typing.List[typing.Union[str, Future]]:
+        # let the client library batch these, rather than waiting for each one
+        results: typing.List[typing.Union[str, Future]] = []
+        for _, payload, headers in entries:
+            try:
+                results.append(
+                    GooglePubSubAsyncPublisherBackend.publish_to_topic(
+                        self, self._topic_path, payload.encode("utf8"), headers
+                    )
+                )
+            except Exception as e:
+                future: Future = Future()
+                future.set_exception(e)
+                results.append(future)
+        return results
+
 
 class GooglePubSubConsumerBackend(TaskhawkConsumerBaseBackend):
+    DEFAULT_VISIBILITY_TIMEOUT_S = 10
+    MAX_PULL_MESSAGES = 1000
+    MAX_VISIBILITY_TIMEOUT_S = 600
+
     def __init__(self, priority: Priority, dlq=False) -> None:
         self._error_count = 0
         self._publisher = None
         self._subscriber = None
         self.last_log_time = datetime(1970, 1, 1)
+        self._ack_batcher: Optional[Batcher[str]] = None
+        self._nack_batcher: Optional[Batcher[str]] = None
+        ack_batch_size = min(settings.GOOGLE_PUBSUB_ACK_BATCH_MAX_MESSAGES, MAX_ACK_IDS_PER_REQUEST)
+        if ack_batch_size > 1:
+            ack_batch_latency_s = settings.GOOGLE_PUBSUB_ACK_BATCH_MAX_LATENCY_S
+            self._ack_batcher = Batcher(self._acknowledge, ack_batch_size, ack_batch_latency_s, 'taskhawk-ack')
+            self._nack_batcher = Batcher(self._nack, ack_batch_size, ack_batch_latency_s, 'taskhawk-nack')
         if not settings.TASKHAWK_SYNC:
             cloud_project = get_google_cloud_project()
             self._subscription_path: str = pubsub_v1.SubscriberClient.subscription_path(
@@ -190,7 +255,7 @@ class GooglePubSubConsumerBackend(TaskhawkConsumerBaseBackend):
         return self._error_count
 
     def pull_messages(
-        self, num_messages: int = 1, visibility_timeout: Optional[int] = None
+        self, num_messages: int = 1, visibility_timeout: Optional[int] = None, wait_time_s: Optional[int] = None
     ) -> typing.List[ReceivedMessage]:
         try:
             # Only log that we're pulling messages every 1 minute so we know the process is ready and not hung but not on every message pull to keep it from being spammy
@@ -202,7 +267,7 @@ class GooglePubSubConsumerBackend(TaskhawkConsumerBaseBackend):
                 subscription=self._subscription_path,
                 max_messages=num_messages,
                 retry=None,
-                timeout=settings.GOOGLE_PUBSUB_READ_TIMEOUT_S,
+                timeout=settings.GOOGLE_PUBSUB_READ_TIMEOUT_S if wait_time_s is None else wait_time_s,
             ).received_messages
 
             self._error_count = 0
@@ -216,22 +281,63 @@ class GooglePubSubConsumerBackend(TaskhawkConsumerBaseBackend):
             self._error_count += 1
             return []
 
-    def process_message(self, queue_message: ReceivedMessage) -> None:
-        self.message_handler(
-            queue_message.message.data.decode(),
+    def _decode_queue_message(self, queue_message: ReceivedMessage) -> typing.Tuple[str, GoogleMetadata]:
+        return (
+            decompress_payload(queue_message.message.data.decode(), queue_message.message.attributes),
             GoogleMetadata(queue_message.ack_id, queue_message.message.publish_time, queue_message.delivery_attempt),
         )
 
-    def delete_message(self, queue_message: ReceivedMessage) -> None:
-        self.subscriber.acknowledge(subscription=self._subscription_path, ack_ids=[queue_message.ack_id])
+    def message_size(self, queue_message: ReceivedMessage) -> int:
+        return len(queue_message.message.data)
+
+    def delivery_attempt(self, provider_metadata: Optional[GoogleMetadata]) -> Optional[int]:
+        # Pub/Sub only counts delivery attempts for subscriptions with a dead letter policy, and reports 0 otherwise
+        if provider_metadata is None or not provider_metadata.delivery_attempt:
+            return None
+        return provider_metadata.delivery_attempt
+
+    def send_to_dead_letter(self, message_json: str, headers: typing.Dict[str, str]) -> None:
+        attrs = {str(key): str(value) for key, value in headers.items()}
+        self.publisher.publish(self._dlq_topic_path, data=message_json.encode('utf8'), **attrs).result()
+
+    def delete_message(self, queue_message: ReceivedMessage) -> Optional[concurrent.futures.Future]:
+        if self._ack_batcher is not None:
+            # failed acks are redelivered by Pub/Sub once their ack deadline expires
+            future = self._ack_batcher.add(queue_message.ack_id)
+            future.add_done_callback(
+                log_failure('Exception while deleting message', extra={'queue_message': queue_message})
+            )
+            return future
+        self._acknowledge([queue_message.ack_id])
+        return None
 
     def nack_message(self, queue_message: ReceivedMessage) -> None:
+        if self._nack_batcher is not None:
+            self._nack_batcher.add(queue_message.ack_id).add_done_callback(
+                log_failure('Exception while nacking message', extra={'queue_message': queue_message})
+            )
+            return
+        self._nack([queue_message.ack_id])
+
+    def _acknowledge(self, ack_ids: typing.List[str]) -> None:
+        self.subscriber.acknowledge(subscription=self._subscription_path, ack_ids=ack_ids)
+
+    def _nack(self, ack_ids: typing.List[str]) -> None:
         # https://cloud.google.com/pubsub/docs/reference/rest/v1/projects.subscriptions/pull#receivedmessage
         # A NACK is any call to subscriptions.modifyAckDeadline with a 0 deadline
         self.subscriber.modify_ack_deadline(
-            subscription=self._subscription_path, ack_ids=[queue_message.ack_id], ack_deadline_seconds=0
+            subscription=self._subscription_path, ack_ids=ack_ids, ack_deadline_seconds=0
         )
 
+    def flush(self) -> None:
+        """
+        Sends any batched acks and nacks
+        """
+        if self._ack_batcher is not None:
+            self._ack_batcher.flush()
+        if self._nack_batcher is not None:
+            self._nack_batcher.flush()
+
     @staticmethod
     def pre_process_hook_kwargs(queue_message: ReceivedMessage) -> dict:
         return {'google_pubsub_message': queue_message}
@@ -260,6 +366,29 @@ class GooglePubSubConsumerBackend(TaskhawkConsumerBaseBackend):
             subscription=self._subscription_path, ack_ids=[ack_id], ack_deadline_seconds=visibility_timeout_s
         )
 
+    def extend_visibility_timeouts(
+        self, queue_messages: typing.List[ReceivedMessage], visibility_timeout_s: int
+    ) -> typing.Dict[int, Exception]:
+        """
+        Extends visibility timeout of several messages, up to 2500 per request.
+        """
+        if visibility_timeout_s < 0 or visibility_timeout_s > 600:
+            raise ValueError("Invalid visibility_timeout_s")
+        failures: typing.Dict[int, Exception] = {}
+        for offset, chunk in zip(
+            range(0, len(queue_messages), MAX_ACK_IDS_PER_REQUEST),
+            funcy.chunks(MAX_ACK_IDS_PER_REQUEST, queue_messages),
+        ):
+            try:
+                self.subscriber.modify_ack_deadline(
+                    subscription=self._subscription_path,
+                    ack_ids=[queue_message.ack_id for queue_message in chunk],
+                    ack_deadline_seconds=visibility_timeout_s,
+                )
+            except Exception as e:
+                failures.update({offset + index: e for index in range(len(chunk))})
+        return failures
+
     def requeue_dead_letter(self, num_messages: int = 10, visibility_timeout: Optional[int] = None) -> None:
         """
         Re-queues everything in the Taskhawk DLQ back into the Taskhawk queue.
@@ -304,3 +433,203 @@ class GooglePubSubConsumerBackend(TaskhawkConsumerBaseBackend):
                     )
 
             logging.info("Re-queued {} messages".format(len(queue_messages)))
+
+
+class GooglePubSubStreamingConsumerBackend(GooglePubSubConsumerBackend):
+    """
+    Consumer backend that receives messages over a streaming pull instead of polling with synchronous pulls. The
+    client library keeps the stream open, limits outstanding messages as configured by `GOOGLE_PUBSUB_FLOW_CONTROL`,
+    and extends the ack deadline of messages until they're acked or nacked, so ``TASKHAWK_CONSUMER_LEASE_S`` doesn't
+    apply. Unless `max_messages` is set there, at most `max_outstanding` messages are outstanding, or the first pull's
+    `num_messages` if that isn't set either, so that messages aren't hoarded away from other consumers.
+
+    Messages received on the stream are queued locally and handed out by `pull_messages`, so tasks are still run by
+    the consumer, with the same hooks, concurrency, and exception handling as other backends.
+    """
+
+    # the client library extends ack deadlines for up to `max_lease_duration` of GOOGLE_PUBSUB_FLOW_CONTROL, which
+    # defaults to an hour
+    DEFAULT_VISIBILITY_TIMEOUT_S = 3600
+    MANAGES_LEASES = True
+
+    def __init__(self, priority: Priority, dlq=False) -> None:
+        super().__init__(priority, dlq=dlq)
+        self._priority = priority
+        self._dlq = dlq
+        self._received: "queue.Queue[PubSubMessage]" = queue.Queue()
+        self._streaming_pull_future: Optional[StreamingPullFuture] = None
+        self._lock = threading.Lock()
+
+    def _ensure_streaming(self, num_messages: int) -> None:
+        with self._lock:
+            if self._streaming_pull_future is not None:
+                if not self._streaming_pull_future.done():
+                    return
+                # the stream stopped on a non-retryable error, start a new one
+                logger.error(
+                    f"Streaming pull stopped subscription={self._subscription_path}",
+                    exc_info=self._streaming_pull_future.exception(),
+                )
+                self._error_count += 1
+            flow_control = dict(settings.GOOGLE_PUBSUB_FLOW_CONTROL)
+            flow_control.setdefault('max_messages', self.max_outstanding or num_messages)
+            if self._streaming_pull_future is None:
+                # flow control keeps the client library from handing over more messages than this
+                self._received = queue.Queue(maxsize=flow_control['max_messages'])
+            self._streaming_pull_future = self.subscriber.subscribe(
+                self._subscription_path,
+                callback=self._received.put,
+                flow_control=pubsub_v1.types.FlowControl(**flow_control),
+            )
+
+    def pull_messages(
+        self, num_messages: int = 1, visibility_timeout: Optional[int] = None, wait_time_s: Optional[int] = None
+    ) -> typing.List[PubSubMessage]:
+        """
+        Returns up to `num_messages` messages received on the stream, waiting for the first one for up to
+        `wait_time_s`. `visibility_timeout` is ignored, since the client library manages ack deadlines.
+        """
+        self._ensure_streaming(num_messages)
+        try:
+            messages = [
+                self._received.get(
+                    timeout=settings.GOOGLE_PUBSUB_READ_TIMEOUT_S if wait_time_s is None else wait_time_s
+                )
+            ]
+        except queue.Empty:
+            return []
+        while len(messages) < num_messages:
+            try:
+                messages.append(self._received.get_nowait())
+            except queue.Empty:
+                break
+        self._error_count = 0
+        return messages
+
+    def _decode_queue_message(self, queue_message: PubSubMessage) -> typing.Tuple[str, GoogleMetadata]:
+        return (
+            decompress_payload(queue_message.data.decode(), queue_message.attributes),
+            GoogleMetadata(queue_message.ack_id, queue_message.publish_time, queue_message.delivery_attempt),
+        )
+
+    def message_size(self, queue_message: PubSubMessage) -> int:
+        return queue_message.size
+
+    def delete_message(self, queue_message: PubSubMessage) -> Optional[concurrent.futures.Future]:
+        # acks are batched by the client library. Its future only tracks the ack if exactly-once delivery is enabled
+        # on the subscription, and resolves right away otherwise.
+        ack_with_response = getattr(queue_message, 'ack_with_response', None)
+        if ack_with_response is None:
+            # google-cloud-pubsub < 2.13
+            queue_message.ack()
+            return None
+        return ack_with_response()
+
+    def nack_message(self, queue_message: PubSubMessage) -> None:
+        queue_message.nack()
+
+    def extend_visibility_timeout(
+        self,
+        visibility_timeout_s: int,
+        metadata: Optional[GoogleMetadata] = None,
+        queue_message: Optional[PubSubMessage] = None,
+    ) -> None:
+        """
+        Extends visibility timeout of a message on a given priority queue for long running tasks. When called with a
+        `queue_message`, the message is also released from lease management, so that it's redelivered after
+        `visibility_timeout_s` rather than having its ack deadline extended by the client library.
+        """
+        if queue_message is None or metadata is not None:
+            super().extend_visibility_timeout(visibility_timeout_s, metadata=metadata, queue_message=queue_message)
+            return
+        if visibility_timeout_s < 0 or visibility_timeout_s > 600:
+            raise ValueError("Invalid visibility_timeout_s")
+        queue_message.modify_ack_deadline(visibility_timeout_s)
+        queue_message.drop()
+
+    def extend_visibility_timeouts(
+        self, queue_messages: typing.List[PubSubMessage], visibility_timeout_s: int
+    ) -> typing.Dict[int, Exception]:
+        """
+        Extends visibility timeout of several messages. Requests are batched by the client library.
+        """
+        if visibility_timeout_s < 0 or visibility_timeout_s > 600:
+            raise ValueError("Invalid visibility_timeout_s")
+        for queue_message in queue_messages:
+            queue_message.modify_ack_deadline(visibility_timeout_s)
+        return {}
+
+    def flush(self) -> None:
+        """
+        Does nothing, acks and nacks are sent by the client library
+        """
+
+    def close(self) -> None:
+        """
+        Stops the stream, and nacks messages that were received but not handed out, so they're redelivered right away
+        """
+        with self._lock:
+            streaming_pull_future, self._streaming_pull_future = self._streaming_pull_future, None
+        if streaming_pull_future is not None:
+            streaming_pull_future.cancel()
+            try:
+                # waits for the stream to shut down, so no more messages are received
+                streaming_pull_future.result()
+            except Exception:
+                pass
+        ack_ids = []
+        while True:
+            try:
+                ack_ids.append(self._received.get_nowait().ack_id)
+            except queue.Empty:
+                break
+        for chunk in funcy.chunks(MAX_ACK_IDS_PER_REQUEST, ack_ids):
+            try:
+                self._nack(chunk)
+            except Exception:
+                logger.exception('Exception while nacking messages', extra={'num_messages': len(chunk)})
+        super().close()
+
+    def requeue_dead_letter(self, num_messages: int = 10, visibility_timeout: Optional[int] = None) -> None:
+        """
+        Re-queues everything in the Taskhawk DLQ back into the Taskhawk queue. This stops once the DLQ is empty, so it
+        uses synchronous pulls.
+        """
+        GooglePubSubConsumerBackend(self._priority, dlq=self._dlq).requeue_dead_letter(num_messages, visibility_timeout)
+
+
+class GCSBlobStore(BlobStore):
+    """
+    Keeps blobs of large messages in a Google Cloud Storage bucket, under names starting with `prefix`. Requires the
+    ``google-cloud-storage`` package. Blobs are deleted once their message was processed. Add a lifecycle rule to
+    delete blobs of messages that never are, e.g. after the dead letter subscription's retention period.
+    """
+
+    def __init__(self, bucket: str, prefix: str = '') -> None:
+        self.bucket = bucket
+        self.prefix = prefix
+        self._bucket = None
+        self._client_lock = threading.Lock()
+
+    @property
+    def storage_bucket(self):
+        if self._bucket is None:
+            with self._client_lock:
+                if self._bucket is None:
+                    from google.cloud import storage
+
+                    with _seed_credentials():
+                        self._bucket = storage.Client().bucket(self.bucket)
+        return self._bucket
+
+    def put(self, key: str, data: bytes) -> None:
+        self.storage_bucket.blob(self.prefix + key).upload_from_string(data)
+
+    def get(self, key: str) -> bytes:
+        return self.storage_bucket.blob(self.prefix + key).download_as_bytes()
+
+    def delete(self, key: str) -> None:
+        try:
+            self.storage_bucket.blob(self.prefix + key).delete()
+        except NotFound:
+            pass
@@ -20,6 +20,13 @@ def get_consumer_backend(*args, **kwargs):
     return TaskhawkConsumerBaseBackend.build(settings.TASKHAWK_CONSUMER_BACKEND, *args, **kwargs)
 
 
+@lru_cache(maxsize=1)
+def get_blob_store():
+    from taskhawk.claim_check import build_blob_store
+
+    return build_blob_store(settings.TASKHAWK_CLAIM_CHECK)
+
+
 @contextmanager
 def override_env(env: str, value: Any) -> Generator[None, None, None]:
     """
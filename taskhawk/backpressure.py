@@ -0,0 +1,134 @@
+import logging
+import mmap
+import threading
+import time
+from typing import Dict, Optional
+
+
+logger = logging.getLogger(__name__)
+
+
+RSS_CHECK_INTERVAL_S = 1.0
+"""
+How often the memory use of the process is checked again while pulls are paused
+"""
+
+EWMA_WEIGHT = 0.2
+"""
+Weight of the latest message in the moving average of message sizes
+"""
+
+
+def current_rss_bytes() -> Optional[int]:
+    """
+    Returns the resident set size of the current process, or None if it can't be determined on this platform
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * mmap.PAGESIZE
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class Backpressure:
+    """
+    Keeps the consumer from pulling more than it can hold in memory:
+
+    - Payload bytes of messages being processed are counted, and pulls are sized so that they're expected to fit
+      under `max_bytes` at the average message size seen so far. Pulls pause while `max_bytes` is reached.
+    - Pulls pause while the resident set size of the process is at or above `max_rss_bytes`.
+
+    At least one message is always allowed when nothing is being processed, so that neither a message larger than
+    `max_bytes`, nor memory the process holds on to while idle, stops the consumer.
+    """
+
+    def __init__(self, max_bytes: Optional[int] = None, max_rss_bytes: Optional[int] = None) -> None:
+        if max_bytes is not None and max_bytes <= 0:
+            raise ValueError("max_bytes must be greater than zero")
+        if max_rss_bytes is not None and max_rss_bytes <= 0:
+            raise ValueError("max_rss_bytes must be greater than zero")
+        if max_rss_bytes is not None and current_rss_bytes() is None:
+            logger.warning('Memory use of the process is not available on this platform, ignoring max_rss_bytes')
+            max_rss_bytes = None
+        self._max_bytes = max_bytes
+        self._max_rss_bytes = max_rss_bytes
+        self._in_flight: Dict[int, int] = {}
+        self._bytes_in_flight = 0
+        self._message_size: Optional[float] = None
+        self._paused = False
+        self._cond = threading.Condition()
+
+    @property
+    def bytes_in_flight(self) -> int:
+        """
+        Total payload bytes of messages being processed
+        """
+        with self._cond:
+            return self._bytes_in_flight
+
+    def capacity(self, num_messages: int, timeout: Optional[float] = None) -> int:
+        """
+        Blocks until the consumer is under its limits.
+
+        :param num_messages: Number of messages the consumer would like to pull
+        :param timeout: Maximum number of seconds to wait. Defaults to None, which means wait forever.
+        :return: number of messages to pull, which may be fewer than `num_messages`, or 0 if the consumer is still
+            over its limits after `timeout`
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while True:
+                allowed = self._allowed(num_messages)
+                if allowed > 0:
+                    if self._paused:
+                        self._paused = False
+                        logger.info('Consumer is under its memory limits, resuming pulls')
+                    return allowed
+                if not self._paused:
+                    self._paused = True
+                    logger.warning(
+                        'Consumer reached its memory limits, pausing pulls',
+                        extra={'bytes_in_flight': self._bytes_in_flight, 'rss_bytes': current_rss_bytes()},
+                    )
+                wait_s = RSS_CHECK_INTERVAL_S
+                if deadline is not None:
+                    wait_s = min(wait_s, deadline - time.monotonic())
+                    if wait_s <= 0:
+                        return 0
+                self._cond.wait(wait_s)
+
+    def _allowed(self, num_messages: int) -> int:
+        if self._max_rss_bytes is not None:
+            rss_bytes = current_rss_bytes()
+            if rss_bytes is not None and rss_bytes >= self._max_rss_bytes:
+                # memory that was freed isn't necessarily returned to the OS, so waiting may not help when idle
+                return 0 if self._in_flight else 1
+        if self._max_bytes is None or not self._message_size:
+            allowed = num_messages
+        else:
+            allowed = min(num_messages, int((self._max_bytes - self._bytes_in_flight) // self._message_size))
+        if allowed <= 0 and not self._in_flight:
+            return 1
+        return max(allowed, 0)
+
+    def acquire(self, queue_message, size: int) -> None:
+        """
+        Counts a message as being processed
+        """
+        with self._cond:
+            self._in_flight[id(queue_message)] = size
+            self._bytes_in_flight += size
+            if self._message_size is None:
+                self._message_size = float(size)
+            else:
+                self._message_size += EWMA_WEIGHT * (size - self._message_size)
+
+    def release(self, queue_message) -> None:
+        """
+        Stops counting a message, because it was processed
+        """
+        with self._cond:
+            size = self._in_flight.pop(id(queue_message), None)
+            if size is not None:
+                self._bytes_in_flight -= size
+                self._cond.notify_all()
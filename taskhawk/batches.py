@@ -0,0 +1,122 @@
+import logging
+import threading
+import typing
+from concurrent.futures import Future
+from typing import Dict, List, Optional
+
+from taskhawk.backends.batching import Batcher
+from taskhawk.lease import current_lease
+from taskhawk.models import Message
+
+if typing.TYPE_CHECKING:  # pragma: no cover
+    from taskhawk.backends.base import TaskhawkConsumerBaseBackend
+    from taskhawk.drain import Drain
+    from taskhawk.lease import Lease, LeaseManager
+    from taskhawk.task_manager import Task
+
+
+logger = logging.getLogger(__name__)
+
+
+class _Pending:
+    """
+    A message of a batch task that's waiting for its batch to run
+    """
+
+    def __init__(
+        self,
+        consumer_backend: 'TaskhawkConsumerBaseBackend',
+        queue_message,
+        message: Message,
+        lease_manager: Optional['LeaseManager'],
+        lease: Optional['Lease'],
+        drain: Optional['Drain'],
+    ) -> None:
+        self.consumer_backend = consumer_backend
+        self.queue_message = queue_message
+        self.message = message
+        self.lease_manager = lease_manager
+        self.lease = lease
+        self.drain = drain
+        self.settled: Future = Future()
+
+    def settle(self, future: Future) -> None:
+        try:
+            if self.lease_manager is not None and self.lease is not None:
+                self.lease_manager.release(self.lease)
+            if self.drain is not None and not self.drain.end(self.queue_message):
+                logger.warning(
+                    'Message was released when the drain deadline passed, ignoring its batch outcome',
+                    extra={'queue_message': self.queue_message},
+                )
+                return
+            self.consumer_backend._settle_batched(self.queue_message, self.message, future.exception())
+        finally:
+            self.settled.set_result(None)
+
+
+class TaskBatches:
+    """
+    Collects messages of batch tasks across pulls, and calls each task with a batch of messages once it has
+    ``batch_size`` of them, or once the oldest has waited ``batch_window_ms``. Batches of each task run on a thread of
+    their own. Messages are acked or nacked individually once their batch ran, and their visibility is extended while
+    they wait if the consumer manages leases. Adding a message blocks while ``batch_size`` messages of its task are
+    already waiting for their batch to start. Messages stay tracked by the consumer's drain until they're settled, so
+    ones that are still waiting at the drain deadline are released.
+    """
+
+    def __init__(self) -> None:
+        self._batchers: Dict[str, Batcher[_Pending]] = {}
+        self._lock = threading.Lock()
+
+    def _batcher(self, task: 'Task') -> Batcher[_Pending]:
+        with self._lock:
+            batcher = self._batchers.get(task.name)
+            if batcher is None:
+
+                def _call(items: List[_Pending]) -> Dict[int, BaseException]:
+                    return task.call_batch([item.message for item in items])
+
+                batcher = Batcher(
+                    _call,
+                    typing.cast(int, task.batch_size),
+                    task.batch_window_ms / 1000,
+                    name=f'taskhawk-batch-{task.name}',
+                    max_pending=task.batch_size,
+                )
+                self._batchers[task.name] = batcher
+            return batcher
+
+    def add(
+        self,
+        consumer_backend: 'TaskhawkConsumerBaseBackend',
+        queue_message,
+        message: Message,
+        drain: Optional['Drain'] = None,
+    ) -> Future:
+        """
+        Adds a message to the next batch of its task. The message is settled through `consumer_backend` once its batch
+        ran, unless `drain` released it in the meantime.
+
+        :return: a future that's done once the message was settled
+        """
+        lease_manager = consumer_backend.lease_manager
+        lease = None
+        if lease_manager is not None:
+            # the message's visibility timeout keeps running from when it was pulled
+            current = current_lease()
+            lease = lease_manager.acquire(queue_message, current.acquired_at if current is not None else None)
+            if message.task.max_lease_s is not None:
+                lease.max_lease_s = message.task.max_lease_s
+        pending = _Pending(consumer_backend, queue_message, message, lease_manager, lease, drain)
+        self._batcher(message.task).add(pending).add_done_callback(pending.settle)
+        return pending.settled
+
+    def flush(self) -> None:
+        """
+        Runs all pending batches from the calling thread, and blocks until they're done
+        """
+        with self._lock:
+            batchers = list(self._batchers.values())
+        for batcher in batchers:
+            batcher.flush()
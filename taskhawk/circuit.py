@@ -0,0 +1,138 @@
+import collections
+import logging
+import threading
+import time
+from typing import Deque, Dict, Optional, Tuple
+
+
+logger = logging.getLogger(__name__)
+
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitBreaker:
+    """
+    Stops running a task while most of its calls fail, e.g. because a service it depends on is down:
+
+    - While closed, calls are allowed. Once at least `min_calls` calls finished in the last `window_s` seconds, and
+      `error_rate` or more of them failed, the breaker opens.
+    - While open, calls aren't allowed. After `open_s` seconds, the breaker is half-open.
+    - While half-open, up to `half_open_calls` calls are allowed as probes. The breaker closes once all of them
+      succeed, and opens again as soon as one fails. If probes don't finish within `open_s`, new ones are allowed.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        error_rate: float = 0.5,
+        min_calls: int = 20,
+        window_s: float = 60,
+        open_s: float = 60,
+        half_open_calls: int = 3,
+    ) -> None:
+        if not 0 < error_rate <= 1:
+            raise ValueError("error_rate must be greater than zero and at most 1")
+        if min_calls <= 0 or half_open_calls <= 0:
+            raise ValueError("min_calls and half_open_calls must be greater than zero")
+        if window_s <= 0 or open_s <= 0:
+            raise ValueError("window_s and open_s must be greater than zero")
+        self._name = name
+        self._error_rate = error_rate
+        self._min_calls = min_calls
+        self._window_s = window_s
+        self._open_s = open_s
+        self._half_open_calls = half_open_calls
+        self._state = CLOSED
+        self._calls: Deque[Tuple[float, bool]] = collections.deque()
+        self._changed_at = time.monotonic()
+        self._probes = 0
+        self._probe_successes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state
+
+    def allow(self) -> Optional[float]:
+        """
+        Checks whether a call may be made, without blocking.
+
+        :return: None if the call may be made, in which case `record` must be called once it's done. Otherwise, the
+            number of seconds after which it should be retried.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self._state == CLOSED:
+                return None
+            if self._state == OPEN:
+                remaining = self._changed_at + self._open_s - now
+                if remaining > 0:
+                    return remaining
+                self._transition(HALF_OPEN, now)
+            elif now >= self._changed_at + self._open_s:
+                # probes got lost, e.g. their tasks are stuck
+                self._transition(HALF_OPEN, now)
+            if self._probes < self._half_open_calls:
+                self._probes += 1
+                return None
+            return self._changed_at + self._open_s - now
+
+    def record(self, success: bool) -> None:
+        """
+        Records the outcome of an allowed call
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self._state == HALF_OPEN:
+                if not success:
+                    self._transition(OPEN, now)
+                    return
+                self._probe_successes += 1
+                if self._probe_successes >= self._half_open_calls:
+                    self._transition(CLOSED, now)
+                return
+            if self._state == OPEN:
+                # a call that started before the breaker opened
+                return
+            self._calls.append((now, success))
+            while self._calls and self._calls[0][0] <= now - self._window_s:
+                self._calls.popleft()
+            if len(self._calls) < self._min_calls:
+                return
+            failures = sum(1 for _, ok in self._calls if not ok)
+            if failures / len(self._calls) >= self._error_rate:
+                self._transition(OPEN, now)
+
+    def _transition(self, state: str, now: float) -> None:
+        self._state = state
+        self._changed_at = now
+        self._probes = 0
+        self._probe_successes = 0
+        self._calls.clear()
+        if state == OPEN:
+            logger.warning('Circuit breaker opened, deferring messages of task', extra={'task': self._name})
+        elif state == CLOSED:
+            logger.info('Circuit breaker closed, resuming task', extra={'task': self._name})
+
+
+class CircuitBreakers:
+    """
+    Keeps a circuit breaker for each task, configured by ``TASKHAWK_CONSUMER_CIRCUIT_BREAKER``
+    """
+
+    def __init__(self, config: dict) -> None:
+        self._config = config
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._lock = threading.Lock()
+
+    def get(self, task_name: str) -> CircuitBreaker:
+        with self._lock:
+            breaker = self._breakers.get(task_name)
+            if breaker is None:
+                breaker = CircuitBreaker(task_name, **self._config)
+                self._breakers[task_name] = breaker
+            return breaker
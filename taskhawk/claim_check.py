@@ -0,0 +1,137 @@
+import json
+import os
+import tempfile
+import uuid
+from typing import Optional, Tuple
+
+from taskhawk.backends.import_utils import import_class
+from taskhawk.compression import DEFAULT_ALGORITHM, compress, decompress
+
+
+CLAIM_CHECK_FIELD = 'claim_check'
+"""
+Message field with the reference to args and kwargs that were offloaded to the blob store
+"""
+
+CLAIM_CHECK_VERSION = '1.1'
+"""
+Message format version of messages whose args and kwargs were offloaded. Consumers that don't know about claim checks
+reject these, rather than running the task without arguments.
+"""
+
+DEFAULT_MIN_BYTES = 200 * 1024
+"""
+Default size in bytes from which payloads are offloaded. SNS and SQS accept messages of up to 256 KB, including
+message attributes.
+"""
+
+
+class BlobStore:
+    """
+    Stores the args and kwargs of messages that are too large to publish, see ``TASKHAWK_CLAIM_CHECK``
+    """
+
+    def put(self, key: str, data: bytes) -> None:
+        """
+        Stores a blob under a new key
+        """
+        raise NotImplementedError
+
+    def get(self, key: str) -> bytes:
+        """
+        :return: the blob stored under a key
+        """
+        raise NotImplementedError
+
+    def delete(self, key: str) -> None:
+        """
+        Deletes a blob. Deleting a blob that doesn't exist isn't an error.
+        """
+        raise NotImplementedError
+
+
+class FileBlobStore(BlobStore):
+    """
+    Keeps blobs as files under the directory `path`. This only works if publishers and consumers share a file system,
+    e.g. in tests or when everything runs on a single host.
+    """
+
+    def __init__(self, path: str) -> None:
+        self._path = path
+
+    def _file(self, key: str) -> str:
+        path = os.path.normpath(os.path.join(self._path, key))
+        if os.path.commonpath([path, os.path.normpath(self._path)]) != os.path.normpath(self._path):
+            raise ValueError(f"Invalid key: {key}")
+        return path
+
+    def put(self, key: str, data: bytes) -> None:
+        path = self._file(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to a temporary file first so that a concurrent get never sees a partial blob
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def get(self, key: str) -> bytes:
+        with open(self._file(key), 'rb') as f:
+            return f.read()
+
+    def delete(self, key: str) -> None:
+        try:
+            os.unlink(self._file(key))
+        except FileNotFoundError:
+            pass
+
+
+def build_blob_store(config: Optional[dict]) -> Optional[BlobStore]:
+    """
+    Builds a blob store from the ``TASKHAWK_CLAIM_CHECK`` setting
+    """
+    if config is None:
+        return None
+    return import_class(config['store'])(**config.get('options', {}))
+
+
+def check_in(store: BlobStore, message_body: dict, args_json: str, compression: Optional[dict]) -> dict:
+    """
+    Offloads the args and kwargs of a message to the blob store.
+
+    :param args_json: args and kwargs of the message, serialized as a JSON object
+    :param compression: value of ``TASKHAWK_COMPRESSION``. Blobs are compressed with its algorithm, but not base64
+        encoded.
+    :return: the message body to publish instead, which holds a reference to the blob, with version
+        `CLAIM_CHECK_VERSION`
+    """
+    key = f'{message_body["id"]}/{uuid.uuid4()}'
+    data = args_json.encode('utf8')
+    encoding = None
+    if compression is not None:
+        encoding = compression.get('algorithm') or DEFAULT_ALGORITHM
+        data = compress(data, encoding, compression.get('level'))
+    store.put(key, data)
+    return {
+        **message_body,
+        'metadata': {**message_body['metadata'], 'version': CLAIM_CHECK_VERSION},
+        'args': [],
+        'kwargs': {},
+        CLAIM_CHECK_FIELD: {'key': key, 'encoding': encoding},
+    }
+
+
+def check_out(store: BlobStore, claim_check: dict) -> Tuple[list, dict]:
+    """
+    Fetches the args and kwargs of a message from the blob store
+
+    :param claim_check: the reference the message was published with
+    """
+    data = store.get(claim_check['key'])
+    if claim_check.get('encoding'):
+        data = decompress(data, claim_check['encoding'])
+    payload = json.loads(data)
+    return payload['args'], payload['kwargs']
@@ -0,0 +1,79 @@
+import base64
+import zlib
+from typing import Mapping, Optional, Tuple
+
+try:
+    import zstandard
+
+    HAVE_ZSTD = True
+except ImportError:  # pragma: no cover
+    HAVE_ZSTD = False
+
+
+ENCODING_ATTRIBUTE = 'taskhawk-encoding'
+"""
+Message attribute that marks a compressed payload, with the algorithm it was compressed with
+"""
+
+ZLIB = 'zlib'
+ZSTD = 'zstd'
+
+DEFAULT_ALGORITHM = ZLIB
+"""
+Algorithm used unless one is configured. zstd has to be opted into, since consumers then need the zstandard package.
+"""
+
+DEFAULT_MIN_BYTES = 1024
+"""
+Default size in bytes below which payloads aren't compressed
+"""
+
+
+def compress(data: bytes, algorithm: str, level: Optional[int] = None) -> bytes:
+    if algorithm == ZLIB:
+        return zlib.compress(data, -1 if level is None else level)
+    if algorithm == ZSTD:
+        if not HAVE_ZSTD:
+            raise ImportError("zstd compression requires the zstandard package")
+        return zstandard.ZstdCompressor(level=3 if level is None else level).compress(data)
+    raise ValueError(f"Unknown compression algorithm: {algorithm}")
+
+
+def decompress(data: bytes, algorithm: str) -> bytes:
+    if algorithm == ZLIB:
+        return zlib.decompress(data)
+    if algorithm == ZSTD:
+        if not HAVE_ZSTD:
+            raise ImportError("zstd compression requires the zstandard package")
+        return zstandard.ZstdDecompressor().decompress(data)
+    raise ValueError(f"Unknown compression algorithm: {algorithm}")
+
+
+def compress_payload(payload: str, config: Optional[dict]) -> Tuple[str, Optional[str]]:
+    """
+    Compresses a message payload as configured by ``TASKHAWK_COMPRESSION``, if it's large enough. Compressed payloads
+    are base64 encoded, since providers only accept text messages.
+
+    :return: the payload to publish, and the algorithm it was compressed with, or None if it wasn't compressed
+    """
+    if config is None:
+        return payload, None
+    data = payload.encode('utf8')
+    if len(data) < config.get('min_bytes', DEFAULT_MIN_BYTES):
+        return payload, None
+    algorithm = config.get('algorithm') or DEFAULT_ALGORITHM
+    compressed = base64.b64encode(compress(data, algorithm, config.get('level'))).decode('ascii')
+    if len(compressed) >= len(data):
+        # incompressible, e.g. already compressed args
+        return payload, None
+    return compressed, algorithm
+
+
+def decompress_payload(payload: str, attributes: Optional[Mapping[str, Optional[str]]]) -> str:
+    """
+    Reverses `compress_payload`, given the message attributes a payload was received with
+    """
+    algorithm = (attributes or {}).get(ENCODING_ATTRIBUTE)
+    if not algorithm:
+        return payload
+    return decompress(base64.b64decode(payload), algorithm).decode('utf8')
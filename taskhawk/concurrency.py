@@ -0,0 +1,131 @@
+import functools
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, Optional, Set
+
+
+logger = logging.getLogger(__name__)
+
+
+class BoundedExecutor:
+    """
+    A thread pool that caps the number of in-flight work items (queued + running). This lets the consumer pull only as
+    many messages as it can start right away, so that no message sits in a local queue while its visibility timeout
+    runs out.
+    """
+
+    def __init__(self, max_workers: int, max_in_flight: Optional[int] = None) -> None:
+        if max_workers <= 0:
+            raise ValueError("max_workers must be greater than zero")
+        self._max_in_flight = max_in_flight or max_workers
+        if self._max_in_flight < max_workers:
+            raise ValueError("max_in_flight must be at least max_workers")
+        self._max_workers = max_workers
+        self._executor = self._new_pool()
+        self._in_flight = 0
+        self._running: Dict[int, object] = {}
+        self._abandoned: Set[object] = set()
+        self._cond = threading.Condition()
+
+    def _new_pool(self) -> ThreadPoolExecutor:
+        return ThreadPoolExecutor(max_workers=self._max_workers, thread_name_prefix='taskhawk-worker')
+
+    @property
+    def max_in_flight(self) -> int:
+        return self._max_in_flight
+
+    @property
+    def in_flight(self) -> int:
+        """
+        Number of work items that have been submitted but haven't finished yet
+        """
+        with self._cond:
+            return self._in_flight
+
+    def wait_for_capacity(self, timeout: Optional[float] = None) -> int:
+        """
+        Blocks until at least one slot is free.
+
+        :param timeout: Maximum number of seconds to wait. Defaults to None, which means wait forever.
+        :return: number of free slots, which may be 0 if timeout expired
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self._in_flight < self._max_in_flight, timeout=timeout)
+            return self._max_in_flight - self._in_flight
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        """
+        Submits a callable to the pool, blocking until a slot is free. Exceptions raised by the callable are logged.
+
+        If the callable returns a future, e.g. because it handed its work off to be finished later, its slot stays
+        taken until that future is done, without holding on to a thread.
+        """
+        work_item = object()
+        with self._cond:
+            self._cond.wait_for(lambda: self._in_flight < self._max_in_flight)
+            self._in_flight += 1
+            try:
+                future = self._executor.submit(self._run, work_item, fn, *args, **kwargs)
+            except Exception:
+                self._release(work_item)
+                raise
+        future.add_done_callback(functools.partial(self._on_done, work_item))
+        return future
+
+    def _run(self, work_item: object, fn: Callable, *args, **kwargs):
+        thread_id = threading.get_ident()
+        with self._cond:
+            self._running[thread_id] = work_item
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self._cond:
+                if self._running.get(thread_id) is work_item:
+                    del self._running[thread_id]
+
+    def abandon(self, thread_id: int) -> bool:
+        """
+        Gives up on the work item running on a thread that's stuck. Its slot is freed, and new work items run on fresh
+        threads, while the stuck thread is left to finish on its own.
+
+        :return: False if no work item of this executor is running on that thread
+        """
+        with self._cond:
+            work_item = self._running.pop(thread_id, None)
+            if work_item is None:
+                return False
+            self._in_flight -= 1
+            self._abandoned.add(work_item)
+            self._cond.notify_all()
+            stuck_pool, self._executor = self._executor, self._new_pool()
+        # threads of the old pool exit once they're done with their current work item
+        stuck_pool.shutdown(wait=False)
+        logger.warning('Replaced stuck consumer worker thread')
+        return True
+
+    def _release(self, work_item: object) -> None:
+        with self._cond:
+            if work_item in self._abandoned:
+                # already released
+                self._abandoned.discard(work_item)
+                return
+            self._in_flight -= 1
+            self._cond.notify_all()
+
+    def _on_done(self, work_item: object, future: Future) -> None:
+        if not future.cancelled() and future.exception() is None and isinstance(future.result(), Future):
+            future.result().add_done_callback(lambda _: self._release(work_item))
+            return
+        self._release(work_item)
+        if not future.cancelled() and future.exception() is not None:
+            logger.error('Exception in consumer worker thread', exc_info=future.exception())
+
+    def shutdown(self, wait: bool = True) -> None:
+        with self._cond:
+            executor = self._executor
+        executor.shutdown(wait=wait)
+        if wait:
+            # work items left on pools that were replaced, other than abandoned ones
+            with self._cond:
+                self._cond.wait_for(lambda: self._in_flight == 0)
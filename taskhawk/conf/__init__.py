@@ -26,16 +26,43 @@ _DEFAULTS = {
     'AWS_ACCOUNT_ID': None,
     'AWS_ACCESS_KEY': None,
     'AWS_CONNECT_TIMEOUT_S': 2,
+    'AWS_ENDPOINT_S3': None,
     'AWS_ENDPOINT_SNS': None,
     'AWS_ENDPOINT_SQS': None,
     'AWS_READ_TIMEOUT_S': 2,
     'AWS_SECRET_KEY': None,
     'AWS_SESSION_TOKEN': None,
+    'AWS_SNS_ASYNC_PUBLISH_MAX_PENDING': 1000,
+    'AWS_SNS_ASYNC_PUBLISH_MAX_WORKERS': 10,
+    'AWS_SNS_PUBLISH_BATCH_MAX_LATENCY_S': 0.05,
+    'AWS_SNS_PUBLISH_BATCH_MAX_MESSAGES': 10,
+    'AWS_SQS_ACK_BATCH_MAX_LATENCY_S': 0.1,
+    'AWS_SQS_ACK_BATCH_MAX_MESSAGES': 1,
     'GOOGLE_APPLICATION_CREDENTIALS': None,
     'GOOGLE_CLOUD_PROJECT': None,
+    'GOOGLE_PUBSUB_ACK_BATCH_MAX_LATENCY_S': 0.1,
+    'GOOGLE_PUBSUB_ACK_BATCH_MAX_MESSAGES': 1,
+    'GOOGLE_PUBSUB_FLOW_CONTROL': {},
     'GOOGLE_PUBSUB_READ_TIMEOUT_S': 20,
     'IS_LAMBDA_APP': False,
+    'TASKHAWK_CLAIM_CHECK': None,
+    'TASKHAWK_COMPRESSION': None,
+    'TASKHAWK_CONSUMER_ADAPTIVE_PULL': None,
+    'TASKHAWK_CONSUMER_ASYNC_MAX_IN_FLIGHT': 100,
     'TASKHAWK_CONSUMER_BACKEND': None,
+    'TASKHAWK_CONSUMER_CIRCUIT_BREAKER': None,
+    'TASKHAWK_CONSUMER_CONCURRENCY': 1,
+    'TASKHAWK_CONSUMER_DEDUP': None,
+    'TASKHAWK_CONSUMER_DRAIN_TIMEOUT_S': 25,
+    'TASKHAWK_CONSUMER_HANDLE_SIGNALS': False,
+    'TASKHAWK_CONSUMER_LEASE_S': None,
+    'TASKHAWK_CONSUMER_MAX_ATTEMPTS': None,
+    'TASKHAWK_CONSUMER_MAX_BYTES_IN_FLIGHT': None,
+    'TASKHAWK_CONSUMER_MAX_LEASE_S': 3600,
+    'TASKHAWK_CONSUMER_MAX_RSS_BYTES': None,
+    'TASKHAWK_CONSUMER_PREFETCH': 0,
+    'TASKHAWK_CONSUMER_PRIORITY_WEIGHTS': {'high': 8, 'default': 4, 'low': 2, 'bulk': 1},
+    'TASKHAWK_CONSUMER_PROCESSES': None,
     'TASKHAWK_DEFAULT_HEADERS': 'taskhawk.conf.default_headers_hook',
     'TASKHAWK_HEARTBEAT_HOOK': 'taskhawk.conf.noop_hook',
     'TASKHAWK_HEARTBEAT_HOOK_SYNC_CALL_S': None,
@@ -43,9 +70,11 @@ _DEFAULTS = {
     'TASKHAWK_POST_PROCESS_HOOK': 'taskhawk.conf.noop_hook',
     'TASKHAWK_PUBLISHER_BACKEND': None,
     'TASKHAWK_PUBLISHER_GCP_BATCH_SETTINGS': (),
+    'TASKHAWK_PUBLISHER_GCP_FLOW_CONTROL': {'limit_exceeded_behavior': 'block'},
     'TASKHAWK_QUEUE': None,
     'TASKHAWK_SYNC': False,
     'TASKHAWK_TASK_CLASS': 'taskhawk.task_manager.Task',
+    'TASKHAWK_TASK_TIMEOUT_HOOK': 'taskhawk.conf.noop_hook',
 }
 
 
@@ -56,6 +85,7 @@ _IMPORT_STRINGS = (
     'TASKHAWK_PRE_PROCESS_HOOK',
     'TASKHAWK_POST_PROCESS_HOOK',
     'TASKHAWK_TASK_CLASS',
+    'TASKHAWK_TASK_TIMEOUT_HOOK',
 )
 
 
@@ -1,11 +1,41 @@
+import asyncio
+import contextlib
+import functools
+import inspect
 import itertools
+import logging
+import os
+import signal
 import threading
-from typing import Optional
+import time
+from concurrent.futures import Future
+from typing import Callable, cast, ContextManager, Iterable, List, Mapping, Optional, Set
 
+from taskhawk.adaptive import AdaptivePullController
+from taskhawk.backends.base import TaskhawkConsumerBaseBackend
 from taskhawk.backends.utils import get_consumer_backend
+from taskhawk.backpressure import Backpressure
+from taskhawk.batches import TaskBatches
+from taskhawk.circuit import CircuitBreakers
+from taskhawk.concurrency import BoundedExecutor
 from taskhawk.conf import settings
+from taskhawk.dedup import build_dedup_cache
+from taskhawk.drain import Drain, handle_signals
 from taskhawk.heartbeat import start_periodic_heartbeat_hook_thread
+from taskhawk.lease import LeaseManager
 from taskhawk.models import Priority
+from taskhawk.prefetch import Prefetcher
+from taskhawk.scheduling import QueuePoller, WeightedScheduler, parse_weights
+from taskhawk.watchdog import Watchdog
+
+
+logger = logging.getLogger(__name__)
+
+
+_SHUTDOWN_POLL_INTERVAL_S = 1.0
+
+# set in worker processes forked by listen_for_messages_prefork, which are restarted by their supervisor if they exit
+_supervised = False
 
 
 def process_messages_for_lambda_consumer(lambda_event: dict) -> None:
@@ -20,15 +50,212 @@ def process_messages_for_lambda_consumer(lambda_event: dict) -> None:
     dead-letter queue.
     """
     sns_consumer_backend = get_consumer_backend()
+    if sns_consumer_backend.dedup_cache is None:
+        # kept for as long as the Lambda execution environment is reused
+        _attach_dedup_cache([sns_consumer_backend])
     sns_consumer_backend.process_messages(lambda_event)
 
 
+def _attach_dedup_cache(consumer_backends: Iterable[TaskhawkConsumerBaseBackend]) -> None:
+    dedup_cache = build_dedup_cache(settings.TASKHAWK_CONSUMER_DEDUP)
+    for consumer_backend in consumer_backends:
+        consumer_backend.dedup_cache = dedup_cache
+
+
+def _attach_circuit_breakers(consumer_backends: Iterable[TaskhawkConsumerBaseBackend]) -> None:
+    config = settings.TASKHAWK_CONSUMER_CIRCUIT_BREAKER
+    circuit_breakers = CircuitBreakers(config) if config is not None else None
+    for consumer_backend in consumer_backends:
+        consumer_backend.circuit_breakers = circuit_breakers
+
+
+def _attach_max_outstanding(consumer_backends: Iterable[TaskhawkConsumerBaseBackend], max_outstanding: int) -> None:
+    for consumer_backend in consumer_backends:
+        consumer_backend.max_outstanding = max_outstanding
+
+
+def _start_lease_manager(
+    consumer_backend: TaskhawkConsumerBaseBackend, lease_s: Optional[int]
+) -> Optional[LeaseManager]:
+    if not lease_s:
+        return None
+    if consumer_backend.MANAGES_LEASES:
+        # two sources of extensions would undo each other's nacks
+        logger.info('Consumer backend manages leases itself, ignoring lease_s', extra={'lease_s': lease_s})
+        return None
+    lease_manager = LeaseManager(consumer_backend, lease_s, settings.TASKHAWK_CONSUMER_MAX_LEASE_S).start()
+    consumer_backend.lease_manager = lease_manager
+    return lease_manager
+
+
+def _stop_lease_manager(consumer_backend: TaskhawkConsumerBaseBackend, lease_manager: Optional[LeaseManager]) -> None:
+    if lease_manager is not None:
+        consumer_backend.lease_manager = None
+        lease_manager.stop()
+
+
+def _replace_stuck_thread(executor: Optional[BoundedExecutor], shutdown_event: threading.Event, thread_id: int) -> None:
+    if executor is not None:
+        executor.abandon(thread_id)
+        return
+    # the task is stuck on the consumer's own thread, which can't be replaced
+    if _supervised:
+        logger.critical('Consumer is stuck, exiting so that the process is restarted')
+        logging.shutdown()
+        os._exit(1)
+    # nothing would restart this process, so shut down cleanly instead, once the task returns
+    logger.critical('Consumer is stuck, shutting down once the task returns')
+    shutdown_event.set()
+
+
+def _start_watchdog(
+    consumer_backends: Iterable[TaskhawkConsumerBaseBackend],
+    executor: Optional[BoundedExecutor],
+    shutdown_event: threading.Event,
+) -> Watchdog:
+    watchdog = Watchdog(functools.partial(_replace_stuck_thread, executor, shutdown_event)).start()
+    for consumer_backend in consumer_backends:
+        consumer_backend.watchdog = watchdog
+    return watchdog
+
+
+def _stop_watchdog(consumer_backends: Iterable[TaskhawkConsumerBaseBackend], watchdog: Watchdog) -> None:
+    for consumer_backend in consumer_backends:
+        consumer_backend.watchdog = None
+    watchdog.stop()
+
+
+def _start_task_batches(consumer_backends: Iterable[TaskhawkConsumerBaseBackend]) -> TaskBatches:
+    task_batches = TaskBatches()
+    for consumer_backend in consumer_backends:
+        consumer_backend.task_batches = task_batches
+    return task_batches
+
+
+def _stop_task_batches(consumer_backends: Iterable[TaskhawkConsumerBaseBackend], task_batches: TaskBatches) -> None:
+    for consumer_backend in consumer_backends:
+        consumer_backend.task_batches = None
+    # run what's been collected so far, rather than leaving messages to time out
+    task_batches.flush()
+
+
+def _fetch_and_process_kwargs(
+    consumer_backend: TaskhawkConsumerBaseBackend,
+    executor: Optional[BoundedExecutor],
+    drain: Drain,
+    backpressure: Optional[Backpressure],
+) -> dict:
+    """
+    Optional arguments for `fetch_and_process_messages`. They're only passed when in use, so that custom backends with
+    the older signature keep working.
+    """
+    kwargs: dict = {}
+    if executor is not None:
+        kwargs['executor'] = executor
+    parameters = inspect.signature(consumer_backend.fetch_and_process_messages).parameters
+    if 'drain' in parameters or any(p.kind is inspect.Parameter.VAR_KEYWORD for p in parameters.values()):
+        # draining is always on, so it's left out for backends that can't take it
+        kwargs['drain'] = drain
+    if backpressure is not None:
+        kwargs['backpressure'] = backpressure
+    return kwargs
+
+
+def _maybe_handle_signals(shutdown_event: threading.Event) -> ContextManager:
+    if settings.TASKHAWK_CONSUMER_HANDLE_SIGNALS:
+        return handle_signals(shutdown_event)
+    return contextlib.nullcontext()
+
+
+def _backpressure() -> Optional[Backpressure]:
+    max_bytes = settings.TASKHAWK_CONSUMER_MAX_BYTES_IN_FLIGHT
+    max_rss_bytes = settings.TASKHAWK_CONSUMER_MAX_RSS_BYTES
+    if max_bytes is None and max_rss_bytes is None:
+        return None
+    return Backpressure(max_bytes=max_bytes, max_rss_bytes=max_rss_bytes)
+
+
+def _adaptive_pull_controller(
+    consumer_backend: TaskhawkConsumerBaseBackend, num_messages: int, visibility_timeout_s: Optional[int]
+) -> Optional[AdaptivePullController]:
+    config = settings.TASKHAWK_CONSUMER_ADAPTIVE_PULL
+    if config is None:
+        return None
+    max_messages = config.get('max_messages') or consumer_backend.MAX_PULL_MESSAGES or num_messages
+    if consumer_backend.MAX_PULL_MESSAGES is not None:
+        max_messages = min(max_messages, consumer_backend.MAX_PULL_MESSAGES)
+    return AdaptivePullController(
+        num_messages,
+        min_messages=config.get('min_messages', 1),
+        max_messages=max_messages,
+        min_wait_s=config.get('min_wait_s', 1),
+        max_wait_s=config.get('max_wait_s', 20),
+        visibility_timeout_s=(
+            visibility_timeout_s if visibility_timeout_s is not None else consumer_backend.DEFAULT_VISIBILITY_TIMEOUT_S
+        ),
+    )
+
+
+def _fetch_and_process_adaptive(
+    consumer_backend: TaskhawkConsumerBaseBackend,
+    controller: AdaptivePullController,
+    visibility_timeout_s: Optional[int],
+    executor: Optional[BoundedExecutor],
+    drain: Drain,
+    backpressure: Optional[Backpressure],
+) -> None:
+    num_messages = controller.batch_size
+    if executor is not None:
+        num_messages = min(num_messages, executor.wait_for_capacity())
+    if backpressure is not None:
+        num_messages = backpressure.capacity(num_messages, timeout=_SHUTDOWN_POLL_INTERVAL_S)
+        if not num_messages:
+            return
+    queue_messages = consumer_backend.pull_messages(
+        num_messages, visibility_timeout_s, wait_time_s=controller.wait_time_s
+    )
+    start = time.monotonic()
+    futures = consumer_backend.process_queue_messages(
+        queue_messages, executor=executor, drain=drain, backpressure=backpressure
+    )
+    # with a thread pool, the batch is only done once its messages are, rather than once they're handed off
+    _call_when_done(
+        list(futures), lambda: controller.record(num_messages, len(queue_messages), time.monotonic() - start)
+    )
+
+
+def _call_when_done(futures: List[Future], fn: Callable[[], None]) -> None:
+    """
+    Calls `fn` once all `futures` are done, or right away if there are none
+    """
+    remaining = len(futures)
+    if not remaining:
+        fn()
+        return
+    lock = threading.Lock()
+
+    def _on_done(_: Future) -> None:
+        nonlocal remaining
+        with lock:
+            remaining -= 1
+            done = not remaining
+        if done:
+            fn()
+
+    for future in futures:
+        future.add_done_callback(_on_done)
+
+
 def listen_for_messages(
     priority: Priority,
     num_messages: int = 1,
     visibility_timeout_s: Optional[int] = None,
     loop_count: Optional[int] = None,
     shutdown_event: Optional[threading.Event] = None,
+    concurrency: Optional[int] = None,
+    prefetch: Optional[int] = None,
+    lease_s: Optional[int] = None,
+    drain_timeout_s: Optional[float] = None,
 ) -> None:
     """
     Starts a Taskhawk listener for message types provided and calls the task function with given `args` and `kwargs`.
@@ -41,18 +268,55 @@ def listen_for_messages(
     the message is moved to the dead-letter queue.
 
     This function is blocking by default. It may be run for specific number of loops by passing `loop_count`. It may
-    also be stopped by passing a shut down event object which can be set to stop the function.
+    also be stopped by passing a shut down event object which can be set to stop the function. If
+    ``TASKHAWK_CONSUMER_HANDLE_SIGNALS`` is enabled, SIGTERM and SIGINT set the shut down event when this function is
+    called from the main thread.
+
+    Once shutting down, messages that were pulled but haven't started are nacked right away so other consumers pick
+    them up. Messages still being processed when the drain deadline passes are nacked as well.
+
+    If ``TASKHAWK_CONSUMER_MAX_BYTES_IN_FLIGHT`` or ``TASKHAWK_CONSUMER_MAX_RSS_BYTES`` is set, fewer messages are
+    pulled, or pulls are paused, while the consumer is close to those limits.
+
+    If ``TASKHAWK_CONSUMER_DEDUP`` is set, redelivered messages whose task already ran successfully are acked without
+    running the task again.
+
+    If ``TASKHAWK_CONSUMER_CIRCUIT_BREAKER`` is set, messages of a task that keeps failing are deferred for a while
+    instead of being run.
 
     :param priority: The priority queue to listen to
-    :param num_messages: Maximum number of messages to fetch in one SQS API call. Defaults to 1
+    :param num_messages: Maximum number of messages to fetch in one SQS API call. Defaults to 1. If
+        ``TASKHAWK_CONSUMER_ADAPTIVE_PULL`` is set, this is only the initial batch size.
     :param visibility_timeout_s: The number of seconds the message should remain invisible to other queue readers.
         Defaults to None, which is queue default
     :param loop_count: How many times to fetch messages from SQS. Default to None, which means loop forever.
     :param shutdown_event: An event to signal that the process should shut down. This prevents more messages from
-        being de-queued and function exits after the current messages have been processed.
+        being de-queued. Messages that were pulled but haven't started are nacked, and the function returns once
+        messages being processed finish, or once they're nacked at the drain deadline (see `drain_timeout_s`).
+    :param concurrency: Number of messages to process concurrently on a thread pool. This is useful for I/O bound
+        tasks. Defaults to None, which means use ``TASKHAWK_CONSUMER_CONCURRENCY`` setting.
+    :param prefetch: Number of batches to pull ahead on a background thread while the current batch is processed.
+        Defaults to None, which means use ``TASKHAWK_CONSUMER_PREFETCH`` setting.
+    :param lease_s: If set, messages are pulled with this visibility timeout (unless `visibility_timeout_s` is given),
+        and the visibility of messages being processed is extended automatically before it runs out. Defaults to None,
+        which means use ``TASKHAWK_CONSUMER_LEASE_S`` setting.
+    :param drain_timeout_s: How long to wait for messages being processed after the shut down event is set. Defaults
+        to None, which means use ``TASKHAWK_CONSUMER_DRAIN_TIMEOUT_S`` setting.
     """
     if not shutdown_event:
         shutdown_event = threading.Event()
+    if drain_timeout_s is None:
+        drain_timeout_s = settings.TASKHAWK_CONSUMER_DRAIN_TIMEOUT_S
+
+    if concurrency is None:
+        concurrency = settings.TASKHAWK_CONSUMER_CONCURRENCY
+    executor = BoundedExecutor(concurrency) if concurrency > 1 else None
+    if prefetch is None:
+        prefetch = settings.TASKHAWK_CONSUMER_PREFETCH
+    if lease_s is None:
+        lease_s = settings.TASKHAWK_CONSUMER_LEASE_S
+    if visibility_timeout_s is None:
+        visibility_timeout_s = lease_s
 
     consumer_backend = get_consumer_backend(priority=priority)
     if settings.TASKHAWK_HEARTBEAT_HOOK_SYNC_CALL_S is not None:
@@ -60,10 +324,312 @@ def listen_for_messages(
             consumer_backend, settings.TASKHAWK_HEARTBEAT_HOOK_SYNC_CALL_S, shutdown_event
         )
 
-    for count in itertools.count():
-        if (loop_count is None or count < loop_count) and not shutdown_event.is_set():
-            consumer_backend.fetch_and_process_messages(
-                num_messages=num_messages, visibility_timeout=visibility_timeout_s
+    backpressure = _backpressure()
+    prefetcher = (
+        Prefetcher(consumer_backend, num_messages, visibility_timeout_s, prefetch, backpressure)
+        if prefetch > 0
+        else None
+    )
+    adaptive_pull = _adaptive_pull_controller(consumer_backend, num_messages, visibility_timeout_s)
+    if prefetcher is not None and adaptive_pull is not None:
+        logger.warning(
+            'TASKHAWK_CONSUMER_ADAPTIVE_PULL is ignored when prefetching, batches are pulled with a fixed size'
+        )
+        adaptive_pull = None
+    lease_manager = _start_lease_manager(consumer_backend, lease_s)
+    watchdog = _start_watchdog([consumer_backend], executor, shutdown_event)
+    task_batches = _start_task_batches([consumer_backend])
+    _attach_dedup_cache([consumer_backend])
+    _attach_circuit_breakers([consumer_backend])
+    _attach_max_outstanding([consumer_backend], max(concurrency, 1) * num_messages)
+    drain = Drain(shutdown_event, drain_timeout_s).start()
+
+    with _maybe_handle_signals(shutdown_event):
+        try:
+            if prefetcher is not None:
+                prefetcher.start()
+            for count in itertools.count():
+                if (loop_count is None or count < loop_count) and not shutdown_event.is_set():
+                    if prefetcher is not None:
+                        queue_messages = prefetcher.get()
+                        consumer_backend.process_queue_messages(
+                            queue_messages,
+                            executor=executor,
+                            drain=drain,
+                            backpressure=backpressure,
+                            pulled_at=prefetcher.pulled_at,
+                        )
+                    elif adaptive_pull is not None:
+                        _fetch_and_process_adaptive(
+                            consumer_backend, adaptive_pull, visibility_timeout_s, executor, drain, backpressure
+                        )
+                    else:
+                        consumer_backend.fetch_and_process_messages(
+                            num_messages=num_messages,
+                            visibility_timeout=visibility_timeout_s,
+                            **_fetch_and_process_kwargs(consumer_backend, executor, drain, backpressure),
+                        )
+                else:
+                    break
+        finally:
+            if prefetcher is not None:
+                prefetcher.stop()
+            if executor is not None:
+                # let in-flight messages finish, or until they're released at the drain deadline
+                executor.shutdown(wait=True)
+            _stop_task_batches([consumer_backend], task_batches)
+            drain.stop()
+            _stop_watchdog([consumer_backend], watchdog)
+            _stop_lease_manager(consumer_backend, lease_manager)
+            consumer_backend.close()
+
+
+def listen_for_messages_weighted(
+    weights: Optional[Mapping[Priority, int]] = None,
+    num_messages: int = 1,
+    visibility_timeout_s: Optional[int] = None,
+    loop_count: Optional[int] = None,
+    shutdown_event: Optional[threading.Event] = None,
+    concurrency: Optional[int] = None,
+    lease_s: Optional[int] = None,
+    drain_timeout_s: Optional[float] = None,
+) -> None:
+    """
+    Starts a Taskhawk listener for several priority queues at once, so that one pool of workers can absorb whichever
+    queue is busy. This works like :meth:`listen_for_messages` otherwise.
+
+    Each queue is long-polled on its own thread, and batches are picked by weighted round robin: when several queues
+    have messages, each gets a share of batches proportional to its weight, so the low priority queues are never
+    starved. Ties go to the higher priority.
+
+    .. code:: python
+
+        taskhawk.listen_for_messages_weighted({taskhawk.Priority.high: 8, taskhawk.Priority.bulk: 1})
+
+    :param weights: Mapping of priority to weight for each queue to listen to. Defaults to None, which means use
+        ``TASKHAWK_CONSUMER_PRIORITY_WEIGHTS`` setting.
+    :param num_messages: Maximum number of messages to fetch in one API call. Defaults to 1
+    :param visibility_timeout_s: The number of seconds the message should remain invisible to other queue readers.
+        Defaults to None, which is queue default
+    :param loop_count: How many batches to process. Default to None, which means loop forever.
+    :param shutdown_event: An event to signal that the process should shut down. This prevents more messages from
+        being de-queued. Messages that were pulled but haven't started are nacked, and the function returns once
+        messages being processed finish, or once they're nacked at the drain deadline (see `drain_timeout_s`).
+    :param concurrency: Number of messages to process concurrently on a thread pool shared by all queues. Defaults to
+        None, which means use ``TASKHAWK_CONSUMER_CONCURRENCY`` setting.
+    :param lease_s: See :meth:`listen_for_messages`.
+    :param drain_timeout_s: See :meth:`listen_for_messages`.
+    """
+    if not shutdown_event:
+        shutdown_event = threading.Event()
+    if drain_timeout_s is None:
+        drain_timeout_s = settings.TASKHAWK_CONSUMER_DRAIN_TIMEOUT_S
+    if lease_s is None:
+        lease_s = settings.TASKHAWK_CONSUMER_LEASE_S
+    if visibility_timeout_s is None:
+        visibility_timeout_s = lease_s
+    scheduler = WeightedScheduler(parse_weights(weights or settings.TASKHAWK_CONSUMER_PRIORITY_WEIGHTS))
+
+    if concurrency is None:
+        concurrency = settings.TASKHAWK_CONSUMER_CONCURRENCY
+    executor = BoundedExecutor(concurrency) if concurrency > 1 else None
+
+    ready = threading.Condition()
+    pollers = {
+        priority: QueuePoller(
+            priority, get_consumer_backend(priority=priority), num_messages, visibility_timeout_s, ready
+        )
+        for priority in scheduler.priorities
+    }
+    if settings.TASKHAWK_HEARTBEAT_HOOK_SYNC_CALL_S is not None:
+        start_periodic_heartbeat_hook_thread(
+            pollers[scheduler.priorities[0]].consumer_backend,
+            settings.TASKHAWK_HEARTBEAT_HOOK_SYNC_CALL_S,
+            shutdown_event,
+        )
+
+    lease_managers = {
+        priority: _start_lease_manager(poller.consumer_backend, lease_s) for priority, poller in pollers.items()
+    }
+    watchdog = _start_watchdog([poller.consumer_backend for poller in pollers.values()], executor, shutdown_event)
+    task_batches = _start_task_batches([poller.consumer_backend for poller in pollers.values()])
+    _attach_dedup_cache([poller.consumer_backend for poller in pollers.values()])
+    _attach_circuit_breakers([poller.consumer_backend for poller in pollers.values()])
+    _attach_max_outstanding(
+        [poller.consumer_backend for poller in pollers.values()], max(concurrency, 1) * num_messages
+    )
+    backpressure = _backpressure()
+    drain = Drain(shutdown_event, drain_timeout_s).start()
+
+    with _maybe_handle_signals(shutdown_event):
+        try:
+            for poller in pollers.values():
+                poller.start()
+            count = 0
+            while (loop_count is None or count < loop_count) and not shutdown_event.is_set():
+                if executor is not None:
+                    # don't take a batch off a queue before there's room to start it
+                    executor.wait_for_capacity()
+                if backpressure is not None and not backpressure.capacity(1, timeout=_SHUTDOWN_POLL_INTERVAL_S):
+                    continue
+                with ready:
+                    ready.wait_for(
+                        lambda: any(poller.has_batch for poller in pollers.values()),
+                        timeout=_SHUTDOWN_POLL_INTERVAL_S,
+                    )
+                    priority = scheduler.next(p for p, poller in pollers.items() if poller.has_batch)
+                    if priority is None:
+                        continue
+                    queue_messages = pollers[priority].take()
+                pollers[priority].consumer_backend.process_queue_messages(
+                    queue_messages,
+                    executor=executor,
+                    drain=drain,
+                    backpressure=backpressure,
+                    pulled_at=pollers[priority].pulled_at,
+                )
+                count += 1
+        finally:
+            for poller in pollers.values():
+                poller.stop()
+            if executor is not None:
+                # let in-flight messages finish, or until they're released at the drain deadline
+                executor.shutdown(wait=True)
+            _stop_task_batches([poller.consumer_backend for poller in pollers.values()], task_batches)
+            drain.stop()
+            _stop_watchdog([poller.consumer_backend for poller in pollers.values()], watchdog)
+            for priority, poller in pollers.items():
+                _stop_lease_manager(poller.consumer_backend, lease_managers[priority])
+                poller.consumer_backend.close()
+
+
+async def listen_for_messages_async(
+    priority: Priority,
+    num_messages: int = 10,
+    visibility_timeout_s: Optional[int] = None,
+    loop_count: Optional[int] = None,
+    shutdown_event: Optional[asyncio.Event] = None,
+    max_in_flight: Optional[int] = None,
+    lease_s: Optional[int] = None,
+    drain_timeout_s: Optional[float] = None,
+) -> None:
+    """
+    Starts a Taskhawk listener on the running event loop. This works like :meth:`listen_for_messages`, but keeps many
+    messages in flight on a single thread: coroutine tasks (``async def``) are awaited on the event loop, and other
+    tasks, as well as pull, ack and nack calls, are run on the event loop's default executor.
+
+    .. code:: python
+
+        asyncio.run(taskhawk.listen_for_messages_async(taskhawk.Priority.high))
+
+    :param priority: The priority queue to listen to
+    :param num_messages: Maximum number of messages to fetch in one API call. Defaults to 10
+    :param visibility_timeout_s: The number of seconds the message should remain invisible to other queue readers.
+        Defaults to None, which is queue default
+    :param loop_count: How many times to fetch messages. Default to None, which means loop forever.
+    :param shutdown_event: An event to signal that the listener should shut down. This prevents more messages from
+        being de-queued. Messages that haven't started are nacked, and the function returns once in-flight messages
+        finish, or once they're nacked at the drain deadline (see `drain_timeout_s`).
+    :param max_in_flight: Maximum number of messages being processed at any time. Defaults to None, which means use
+        ``TASKHAWK_CONSUMER_ASYNC_MAX_IN_FLIGHT`` setting.
+    :param lease_s: See :meth:`listen_for_messages`.
+    :param drain_timeout_s: How long to wait for messages being processed after the shut down event is set, after
+        which they're nacked and their asyncio tasks are cancelled. Defaults to None, which means use
+        ``TASKHAWK_CONSUMER_DRAIN_TIMEOUT_S`` setting.
+    """
+    if not shutdown_event:
+        shutdown_event = asyncio.Event()
+    if drain_timeout_s is None:
+        drain_timeout_s = settings.TASKHAWK_CONSUMER_DRAIN_TIMEOUT_S
+    if max_in_flight is None:
+        max_in_flight = settings.TASKHAWK_CONSUMER_ASYNC_MAX_IN_FLIGHT
+    if max_in_flight <= 0:
+        raise ValueError("max_in_flight must be greater than zero")
+    if lease_s is None:
+        lease_s = settings.TASKHAWK_CONSUMER_LEASE_S
+    if visibility_timeout_s is None:
+        visibility_timeout_s = lease_s
+
+    consumer_backend = get_consumer_backend(priority=priority)
+    heartbeat_shutdown_event = threading.Event()
+    if settings.TASKHAWK_HEARTBEAT_HOOK_SYNC_CALL_S is not None:
+        start_periodic_heartbeat_hook_thread(
+            consumer_backend, settings.TASKHAWK_HEARTBEAT_HOOK_SYNC_CALL_S, heartbeat_shutdown_event
+        )
+
+    lease_manager = _start_lease_manager(consumer_backend, lease_s)
+    _attach_dedup_cache([consumer_backend])
+    _attach_circuit_breakers([consumer_backend])
+    _attach_max_outstanding([consumer_backend], max_in_flight)
+    backpressure = _backpressure()
+    # the drain is shared with executor threads and its own, so it needs a thread-safe event
+    drain = Drain(threading.Event(), drain_timeout_s).start()
+    in_flight: Set[asyncio.Task] = set()
+
+    async def _propagate_shutdown() -> None:
+        await cast(asyncio.Event, shutdown_event).wait()
+        drain.shutdown_event.set()
+
+    propagate_shutdown = asyncio.create_task(_propagate_shutdown())
+
+    def _on_done(task: asyncio.Task) -> None:
+        in_flight.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error('Exception while processing message', exc_info=task.exception())
+
+    signal_handlers = {}
+    if settings.TASKHAWK_CONSUMER_HANDLE_SIGNALS and threading.current_thread() is threading.main_thread():
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal_handlers[signum] = signal.getsignal(signum)
+            loop.add_signal_handler(signum, shutdown_event.set)
+
+    try:
+        for count in itertools.count():
+            if (loop_count is not None and count >= loop_count) or shutdown_event.is_set():
+                break
+            while len(in_flight) >= max_in_flight:
+                await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+            pull_messages = min(num_messages, max_in_flight - len(in_flight))
+            if backpressure is not None:
+                pull_messages = await asyncio.to_thread(backpressure.capacity, pull_messages, _SHUTDOWN_POLL_INTERVAL_S)
+                if not pull_messages:
+                    continue
+            queue_messages = await asyncio.to_thread(
+                consumer_backend.pull_messages, pull_messages, visibility_timeout_s
             )
-        else:
-            break
+            if shutdown_event.is_set():
+                drain.shutdown_event.set()
+            # lease right away, so messages waiting for a thread don't reach their visibility timeout
+            leases = consumer_backend._acquire_leases(queue_messages, None)
+            for queue_message, lease in zip(queue_messages, leases):
+                if backpressure is not None:
+                    backpressure.acquire(queue_message, consumer_backend.message_size(queue_message))
+                task = asyncio.create_task(
+                    consumer_backend._process_queue_message_async(queue_message, drain, backpressure, lease)
+                )
+                in_flight.add(task)
+                task.add_done_callback(_on_done)
+    finally:
+        for signum, handler in signal_handlers.items():
+            asyncio.get_running_loop().remove_signal_handler(signum)
+            signal.signal(signum, handler)
+        if in_flight:
+            timeout_s = drain_timeout_s if shutdown_event.is_set() else None
+            _, pending = await asyncio.wait(in_flight, timeout=timeout_s)
+            if pending:
+                # usually released by the drain's thread already
+                released = await asyncio.to_thread(drain.release_in_flight)
+                if released:
+                    logger.warning(
+                        'Drain deadline passed, released messages that were still being processed',
+                        extra={'num_messages': len(released), 'timeout_s': drain_timeout_s},
+                    )
+                for task in pending:
+                    task.cancel()
+                await asyncio.wait(pending)
+        propagate_shutdown.cancel()
+        drain.stop()
+        await asyncio.to_thread(_stop_lease_manager, consumer_backend, lease_manager)
+        await asyncio.to_thread(consumer_backend.close)
+        heartbeat_shutdown_event.set()
@@ -0,0 +1,161 @@
+import collections
+import sqlite3
+import threading
+import time
+import typing
+from typing import Optional
+
+
+DEFAULT_MAX_SIZE = 10000
+"""
+Default number of message ids remembered
+"""
+
+DEFAULT_TTL_S = 3600
+"""
+Default number of seconds a message id is remembered for
+"""
+
+PRUNE_EVERY = 100
+"""
+How many ids are added to an on-disk cache between removing expired and excess entries
+"""
+
+
+class DedupCache:
+    """
+    Remembers ids of messages whose tasks ran successfully, so that redelivered duplicates can be skipped
+    """
+
+    def seen(self, message_id: str) -> bool:
+        """
+        :return: True if a message with this id was processed recently
+        """
+        raise NotImplementedError
+
+    def add(self, message_id: str) -> None:
+        """
+        Records that a message was processed
+        """
+        raise NotImplementedError
+
+
+class MemoryDedupCache(DedupCache):
+    """
+    Keeps the `max_size` most recently processed message ids in memory, each for at most `ttl_s` seconds. Only
+    duplicates that are redelivered to the same process are caught.
+    """
+
+    def __init__(self, max_size: int = DEFAULT_MAX_SIZE, ttl_s: float = DEFAULT_TTL_S) -> None:
+        if max_size <= 0:
+            raise ValueError("max_size must be greater than zero")
+        if ttl_s <= 0:
+            raise ValueError("ttl_s must be greater than zero")
+        self._max_size = max_size
+        self._ttl_s = ttl_s
+        self._processed_at: typing.OrderedDict[str, float] = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._processed_at)
+
+    def seen(self, message_id: str) -> bool:
+        with self._lock:
+            processed_at = self._processed_at.get(message_id)
+            if processed_at is None:
+                return False
+            if processed_at + self._ttl_s <= time.monotonic():
+                del self._processed_at[message_id]
+                return False
+            return True
+
+    def add(self, message_id: str) -> None:
+        with self._lock:
+            self._processed_at[message_id] = time.monotonic()
+            self._processed_at.move_to_end(message_id)
+            while len(self._processed_at) > self._max_size:
+                self._processed_at.popitem(last=False)
+
+
+class SQLiteDedupCache(DedupCache):
+    """
+    Keeps processed message ids in a SQLite database at `path`, so that all consumer processes on a host that use the
+    same path share them. Ids are remembered for at most `ttl_s` seconds, and the database is pruned down to the
+    `max_size` most recent ids every so often.
+    """
+
+    def __init__(self, path: str, max_size: int = DEFAULT_MAX_SIZE, ttl_s: float = DEFAULT_TTL_S) -> None:
+        if max_size <= 0:
+            raise ValueError("max_size must be greater than zero")
+        if ttl_s <= 0:
+            raise ValueError("ttl_s must be greater than zero")
+        self._path = path
+        self._max_size = max_size
+        self._ttl_s = ttl_s
+        self._local = threading.local()
+        self._added = 0
+        self._lock = threading.Lock()
+        connection = self._connection()
+        # lets readers in other processes proceed while one process writes
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS taskhawk_dedup (message_id TEXT PRIMARY KEY, processed_at REAL NOT NULL)'
+        )
+        connection.execute('CREATE INDEX IF NOT EXISTS taskhawk_dedup_processed_at ON taskhawk_dedup (processed_at)')
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite connections may not be shared between threads
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self._path, timeout=5.0, isolation_level=None)
+            self._local.connection = connection
+        return connection
+
+    def seen(self, message_id: str) -> bool:
+        row = (
+            self._connection()
+            .execute(
+                'SELECT 1 FROM taskhawk_dedup WHERE message_id = ? AND processed_at > ?',
+                (message_id, time.time() - self._ttl_s),
+            )
+            .fetchone()
+        )
+        return row is not None
+
+    def add(self, message_id: str) -> None:
+        connection = self._connection()
+        connection.execute(
+            'INSERT OR REPLACE INTO taskhawk_dedup (message_id, processed_at) VALUES (?, ?)', (message_id, time.time())
+        )
+        with self._lock:
+            self._added += 1
+            prune = self._added % PRUNE_EVERY == 0
+        if prune:
+            self.prune()
+
+    def prune(self) -> None:
+        """
+        Removes expired ids, and the oldest ids beyond `max_size`
+        """
+        connection = self._connection()
+        connection.execute('DELETE FROM taskhawk_dedup WHERE processed_at <= ?', (time.time() - self._ttl_s,))
+        connection.execute(
+            'DELETE FROM taskhawk_dedup WHERE message_id IN '
+            '(SELECT message_id FROM taskhawk_dedup ORDER BY processed_at DESC LIMIT -1 OFFSET ?)',
+            (self._max_size,),
+        )
+
+
+def build_dedup_cache(config: Optional[dict]) -> Optional[DedupCache]:
+    """
+    Builds a dedup cache from the ``TASKHAWK_CONSUMER_DEDUP`` setting
+    """
+    if config is None:
+        return None
+    max_size = config.get('max_size', DEFAULT_MAX_SIZE)
+    ttl_s = config.get('ttl_s', DEFAULT_TTL_S)
+    path = config.get('path')
+    if path is not None:
+        return SQLiteDedupCache(path, max_size=max_size, ttl_s=ttl_s)
+    return MemoryDedupCache(max_size=max_size, ttl_s=ttl_s)
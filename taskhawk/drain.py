@@ -0,0 +1,123 @@
+import logging
+import signal
+import threading
+import typing
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+if typing.TYPE_CHECKING:  # pragma: no cover
+    from taskhawk.backends.base import TaskhawkConsumerBaseBackend
+
+
+logger = logging.getLogger(__name__)
+
+
+@contextmanager
+def handle_signals(shutdown_event: threading.Event) -> Iterator[None]:
+    """
+    Sets `shutdown_event` on SIGTERM and SIGINT while in this block. Original handlers are restored on exit. Signal
+    handlers can only be installed from the main thread, so this does nothing when called from other threads.
+    """
+    original_handlers = {}
+    if threading.current_thread() is threading.main_thread():
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            original_handlers[signum] = signal.signal(signum, lambda *_: shutdown_event.set())
+    try:
+        yield
+    finally:
+        for signum, handler in original_handlers.items():
+            signal.signal(signum, handler)
+
+
+class Drain:
+    """
+    Tracks the messages a consumer is processing, so that it can shut down without making other consumers wait for
+    visibility timeouts to run out:
+
+    - Once `shutdown_event` is set, messages that haven't started processing yet are nacked instead.
+    - If messages are still being processed `timeout_s` after `shutdown_event` was set, they're nacked so other
+      consumers pick them up. Their tasks keep running, but their outcome is ignored.
+    """
+
+    def __init__(self, shutdown_event: threading.Event, timeout_s: Optional[float]) -> None:
+        self._shutdown_event = shutdown_event
+        self._timeout_s = timeout_s
+        self._in_flight: Dict[int, Tuple['TaskhawkConsumerBaseBackend', typing.Any]] = {}
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._watch, name='taskhawk-drain', daemon=True)
+
+    @property
+    def shutdown_event(self) -> threading.Event:
+        return self._shutdown_event
+
+    def start(self) -> 'Drain':
+        if self._timeout_s is not None:
+            self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        """
+        Marks the consumer as drained
+        """
+        self._done.set()
+
+    def begin(self, consumer_backend: 'TaskhawkConsumerBaseBackend', queue_message) -> bool:
+        """
+        Marks a message as started.
+
+        :return: False if the consumer is shutting down, and the message should be nacked instead
+        """
+        with self._lock:
+            if self._shutdown_event.is_set():
+                return False
+            self._in_flight[id(queue_message)] = (consumer_backend, queue_message)
+            return True
+
+    def end(self, queue_message) -> bool:
+        """
+        Marks a message as done.
+
+        :return: False if the message was already nacked because the drain deadline passed, and should be left alone
+        """
+        with self._lock:
+            return self._in_flight.pop(id(queue_message), None) is not None
+
+    @property
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._in_flight)
+
+    def release_in_flight(self) -> List:
+        """
+        Nacks all messages that are being processed, and returns them
+        """
+        with self._lock:
+            in_flight = list(self._in_flight.values())
+            self._in_flight.clear()
+        backends = {}
+        for consumer_backend, queue_message in in_flight:
+            if consumer_backend.lease_manager is not None:
+                # so an extension doesn't undo the nack
+                consumer_backend.lease_manager.release_message(queue_message)
+            try:
+                consumer_backend.nack_message(queue_message)
+            except Exception:
+                logger.exception('Exception while nacking message', extra={'queue_message': queue_message})
+            backends[id(consumer_backend)] = consumer_backend
+        for consumer_backend in backends.values():
+            consumer_backend.flush()
+        return [queue_message for _, queue_message in in_flight]
+
+    def _watch(self) -> None:
+        while not self._shutdown_event.wait(1.0):
+            if self._done.is_set():
+                return
+        if self._done.wait(self._timeout_s):
+            return
+        released = self.release_in_flight()
+        if released:
+            logger.warning(
+                'Drain deadline passed, released messages that were still being processed',
+                extra={'num_messages': len(released), 'timeout_s': self._timeout_s},
+            )
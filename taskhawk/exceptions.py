@@ -28,6 +28,14 @@ class IgnoreException(Exception):
     pass
 
 
+class TaskTimeout(Exception):
+    """
+    Task ran for longer than its timeout
+    """
+
+    pass
+
+
 class ValidationError(Exception):
     """
     Message failed JSON schema validation
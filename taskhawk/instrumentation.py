@@ -23,7 +23,7 @@ def on_receive(sns_record=None, sqs_queue_message=None, google_pubsub_message=No
     elif sns_record is not None:
         attributes = _get_attributes_from_aws_sns_record(sns_record)
     elif google_pubsub_message is not None:
-        attributes = google_pubsub_message.message.attributes
+        attributes = _get_attributes_from_google_pubsub_message(google_pubsub_message)
     else:
         attributes = None
     tracectx = extract(attributes)
@@ -49,6 +49,13 @@ def _get_attributes_from_aws_sns_record(sns_record) -> Dict[str, str]:
     }
 
 
+def _get_attributes_from_google_pubsub_message(google_pubsub_message) -> Dict[str, str]:
+    # messages received over a streaming pull carry their attributes directly
+    if hasattr(google_pubsub_message, "message"):
+        return google_pubsub_message.message.attributes
+    return google_pubsub_message.attributes
+
+
 def on_message(message: Message) -> None:
     """
     Hook for instrumenting consumer after message is deserialized and validated. If applicable, updates the current span
@@ -0,0 +1,218 @@
+import logging
+import math
+import threading
+import time
+import typing
+from contextvars import ContextVar
+from typing import Dict, List, Optional
+
+if typing.TYPE_CHECKING:  # pragma: no cover
+    from taskhawk.backends.base import TaskhawkConsumerBaseBackend
+
+
+logger = logging.getLogger(__name__)
+
+
+RENEW_AFTER_FRACTION = 0.5
+"""
+Fraction of the lease after which it's renewed
+"""
+
+COALESCE_FRACTION = 0.25
+"""
+Leases that would be due within this fraction of the lease are renewed together with the ones that are due, so that
+they share a request
+"""
+
+RETRY_AFTER_S = 1.0
+"""
+Delay before retrying a failed extension
+"""
+
+
+class Lease:
+    """
+    Tracks the visibility of a message that's being processed
+    """
+
+    def __init__(
+        self, queue_message, lease_s: int, max_lease_s: Optional[float], acquired_at: Optional[float] = None
+    ) -> None:
+        self.queue_message = queue_message
+        self.acquired_at = acquired_at if acquired_at is not None else time.monotonic()
+        self.expires_at = self.acquired_at + lease_s
+        self.max_lease_s = max_lease_s
+        self.active = True
+        # whether an extension request for the message is in flight
+        self.extending = False
+
+    @property
+    def deadline(self) -> Optional[float]:
+        """
+        Time after which the lease is no longer extended, or None if it's extended for as long as the message is
+        processed
+        """
+        if self.max_lease_s is None:
+            return None
+        return self.acquired_at + self.max_lease_s
+
+    def extended(self, visibility_timeout_s: float) -> None:
+        """
+        Records that the message's visibility was extended from now
+        """
+        self.expires_at = max(self.expires_at, time.monotonic() + visibility_timeout_s)
+
+
+_current_lease: ContextVar[Optional[Lease]] = ContextVar('taskhawk_current_lease', default=None)
+
+
+def current_lease() -> Optional[Lease]:
+    """
+    Returns the lease of the message being processed by the current thread or asyncio task, if any
+    """
+    return _current_lease.get()
+
+
+class LeaseManager:
+    """
+    Keeps messages invisible to other consumers while they're being processed. Each message is pulled with a short
+    visibility timeout (the lease), and a background thread extends the visibility of every in-flight message before
+    its lease expires, batching as many messages per request as the provider allows. Leases stop being extended after
+    `max_lease_s`, at which point the message becomes visible again as if it had failed.
+    """
+
+    def __init__(
+        self, consumer_backend: 'TaskhawkConsumerBaseBackend', lease_s: int, max_lease_s: Optional[float] = None
+    ) -> None:
+        if lease_s <= 0:
+            raise ValueError("lease_s must be greater than zero")
+        self._consumer_backend = consumer_backend
+        self._lease_s = lease_s
+        self._max_lease_s = max_lease_s
+        self._leases: Dict[int, Lease] = {}
+        self._stopped = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='taskhawk-lease', daemon=True)
+
+    @property
+    def lease_s(self) -> int:
+        return self._lease_s
+
+    def start(self) -> 'LeaseManager':
+        self._thread.start()
+        return self
+
+    def acquire(self, queue_message, acquired_at: Optional[float] = None) -> Lease:
+        """
+        Starts tracking a message that was pulled with a visibility timeout of `lease_s`
+
+        :param acquired_at: `time.monotonic()` at which the message was pulled, since its visibility timeout started
+            running then. Defaults to now.
+        """
+        lease = Lease(queue_message, self._lease_s, self._max_lease_s, acquired_at)
+        with self._cond:
+            self._leases[id(lease)] = lease
+            self._cond.notify_all()
+        return lease
+
+    def release(self, lease: Lease) -> None:
+        """
+        Stops extending a lease, because its message was processed. If an extension of the message is in flight, this
+        waits for it, so that settling the message afterwards isn't undone by the extension.
+        """
+        with self._cond:
+            lease.active = False
+            self._leases.pop(id(lease), None)
+            self._cond.wait_for(lambda: not lease.extending)
+
+    def release_message(self, queue_message) -> None:
+        """
+        Stops extending the leases of a message, because it was nacked before it was processed. Waits for extensions
+        in flight like `release`.
+        """
+        with self._cond:
+            leases = [lease for lease in self._leases.values() if lease.queue_message is queue_message]
+        for lease in leases:
+            self.release(lease)
+
+    def stop(self) -> None:
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def _renew_at(self, lease: Lease) -> float:
+        return lease.expires_at - self._lease_s * (1 - RENEW_AFTER_FRACTION)
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._stopped:
+                    timeout = None
+                    if self._leases:
+                        timeout = min(self._renew_at(lease) for lease in self._leases.values()) - time.monotonic()
+                        if timeout <= 0:
+                            break
+                    self._cond.wait(timeout)
+                if self._stopped:
+                    return
+                due = self._take_due()
+            for visibility_timeout_s, leases in due.items():
+                self._extend(leases, visibility_timeout_s)
+
+    def _take_due(self) -> Dict[int, List[Lease]]:
+        """
+        Collects leases that need to be renewed, grouped by how far they should be extended
+        """
+        now = time.monotonic()
+        horizon = now + self._lease_s * COALESCE_FRACTION
+        due: Dict[int, List[Lease]] = {}
+        for key, lease in list(self._leases.items()):
+            if self._renew_at(lease) > horizon:
+                continue
+            visibility_timeout_s: float = self._lease_s
+            deadline = lease.deadline
+            if deadline is not None and deadline - now < self._lease_s:
+                # last extension, up to the deadline
+                logger.warning(
+                    'Message is reaching its maximum lease, no longer extending its visibility',
+                    extra={'queue_message': lease.queue_message, 'max_lease_s': lease.max_lease_s},
+                )
+                del self._leases[key]
+                visibility_timeout_s = deadline - now
+                if visibility_timeout_s <= 0:
+                    continue
+            due.setdefault(math.ceil(visibility_timeout_s), []).append(lease)
+        return due
+
+    def _extend(self, leases: List[Lease], visibility_timeout_s: int) -> None:
+        with self._cond:
+            # leases released since they were found due must not be extended anymore
+            leases = [lease for lease in leases if lease.active]
+            for lease in leases:
+                lease.extending = True
+        if not leases:
+            return
+        try:
+            failures = self._consumer_backend.extend_visibility_timeouts(
+                [lease.queue_message for lease in leases], visibility_timeout_s
+            )
+        except Exception as e:
+            failures = {index: e for index in range(len(leases))}
+        with self._cond:
+            for lease in leases:
+                lease.extending = False
+            self._cond.notify_all()
+            for index, lease in enumerate(leases):
+                error = failures.get(index)
+                if error is None:
+                    lease.extended(visibility_timeout_s)
+                elif lease.active:
+                    # try again shortly, while the message may still be invisible
+                    lease.expires_at = time.monotonic() + self._lease_s * (1 - RENEW_AFTER_FRACTION) + RETRY_AFTER_S
+                    logger.warning(
+                        'Failed to extend visibility of message',
+                        exc_info=error,
+                        extra={'queue_message': lease.queue_message},
+                    )
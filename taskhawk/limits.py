@@ -0,0 +1,97 @@
+import threading
+import time
+from typing import Optional, Tuple
+
+from taskhawk.exceptions import ConfigurationError
+
+
+RATE_LIMIT_PERIODS = {'s': 1, 'm': 60, 'h': 3600}
+"""
+Supported rate limit periods, in seconds
+"""
+
+CONCURRENCY_RETRY_AFTER_S = 1.0
+"""
+Delay before a message that's over its task's concurrency limit is redelivered
+"""
+
+
+def parse_rate_limit(rate_limit: str) -> Tuple[int, int]:
+    """
+    Parses a rate limit such as ``"100/s"``, ``"10/m"`` or ``"500/h"``
+
+    :return: a tuple of the number of calls, and the period in seconds
+    """
+    count, _, period = rate_limit.partition('/')
+    try:
+        calls = int(count)
+        period_s = RATE_LIMIT_PERIODS[period.strip()]
+    except (KeyError, ValueError):
+        raise ConfigurationError(f'Invalid rate limit "{rate_limit}", expected e.g. "100/s"')
+    if calls <= 0:
+        raise ConfigurationError(f'Invalid rate limit "{rate_limit}", must allow at least one call')
+    return calls, period_s
+
+
+class TokenBucket:
+    """
+    Allows `capacity` calls at once, refilled at `rate` calls per second
+    """
+
+    def __init__(self, rate: float, capacity: int) -> None:
+        self._rate = rate
+        self._capacity = capacity
+        self._tokens = float(capacity)
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self) -> float:
+        """
+        Takes a token if one is available.
+
+        :return: 0 if a token was taken, otherwise the number of seconds until one is available
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._capacity, self._tokens + (now - self._updated_at) * self._rate)
+            self._updated_at = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self._rate
+
+
+class TaskLimiter:
+    """
+    Limits how many messages of a task a consumer processes at once, and how often. Limits are local to the consumer
+    process, so with several consumers, each allows up to the limit.
+    """
+
+    def __init__(self, max_concurrency: Optional[int] = None, rate_limit: Optional[str] = None) -> None:
+        if max_concurrency is not None and max_concurrency <= 0:
+            raise ConfigurationError("max_concurrency must be greater than zero")
+        self._semaphore = threading.BoundedSemaphore(max_concurrency) if max_concurrency is not None else None
+        self._bucket = None
+        if rate_limit is not None:
+            calls, period_s = parse_rate_limit(rate_limit)
+            self._bucket = TokenBucket(calls / period_s, calls)
+
+    def acquire(self) -> Optional[float]:
+        """
+        Claims a slot to process a message, without blocking.
+
+        :return: None if the message may be processed, in which case `release` must be called once it's done.
+            Otherwise, the number of seconds after which it should be retried.
+        """
+        if self._semaphore is not None and not self._semaphore.acquire(blocking=False):
+            return CONCURRENCY_RETRY_AFTER_S
+        if self._bucket is not None:
+            wait_s = self._bucket.take()
+            if wait_s > 0:
+                self.release()
+                return wait_s
+        return None
+
+    def release(self) -> None:
+        if self._semaphore is not None:
+            self._semaphore.release()
@@ -8,7 +8,9 @@ import arrow
 import arrow.parser
 
 from taskhawk.backends.utils import get_consumer_backend
+from taskhawk.claim_check import CLAIM_CHECK_VERSION, BlobStore, check_out
 from taskhawk.exceptions import TaskNotFound, ValidationError
+from taskhawk.lease import current_lease
 
 if typing.TYPE_CHECKING:
     from taskhawk.task_manager import Task  # noqa  # pragma: no cover
@@ -97,6 +99,9 @@ class Metadata:
         """
         consumer_backend = get_consumer_backend(priority=self.priority)
         consumer_backend.extend_visibility_timeout(visibility_timeout_s, metadata=self.provider_metadata)
+        lease = current_lease()
+        if lease is not None:
+            lease.extended(visibility_timeout_s)
 
     def __eq__(self, other) -> bool:
         if not isinstance(other, self.__class__):
@@ -110,7 +115,7 @@ class Message:
     """
 
     CURRENT_VERSION = '1.0'
-    VERSIONS = ['1.0']
+    VERSIONS = ['1.0', CLAIM_CHECK_VERSION]
 
     def __init__(self, data: dict) -> None:
         """
@@ -141,6 +146,9 @@ class Message:
         self._task_name: str = data['task']
         self._args: list = data['args']
         self._kwargs: dict = data['kwargs']
+        # args and kwargs of large messages are offloaded to the blob store, see taskhawk.claim_check
+        self._claim_check: Optional[dict] = data.get('claim_check')
+        self._checked_out = False
 
         self.validate()
 
@@ -195,6 +203,7 @@ class Message:
         kwargs: Optional[dict] = None,
         msg_id: Optional[str] = None,
         headers: Optional[dict] = None,
+        claim_check: Optional[dict] = None,
     ) -> 'Message':
         """
         Creates Message object given type, schema version and data. This is typically used by the publisher code.
@@ -204,17 +213,31 @@ class Message:
         :param kwargs: The dict of kwargs
         :param msg_id: Optional message identifier.  If unset, a random UUID4 will be generated.
         :param headers: Optional additional headers
+        :param claim_check: Optional reference to args and kwargs that were offloaded to the blob store
         """
-        return Message(
-            {
-                'id': msg_id or str(uuid.uuid4()),
-                'metadata': cls._create_metadata(priority),
-                'headers': headers or {},
-                'task': task,
-                'args': args or [],
-                'kwargs': kwargs or {},
-            }
-        )
+        metadata = cls._create_metadata(priority)
+        if claim_check is not None:
+            metadata['version'] = CLAIM_CHECK_VERSION
+        data = {
+            'id': msg_id or str(uuid.uuid4()),
+            'metadata': metadata,
+            'headers': headers or {},
+            'task': task,
+            'args': args or [],
+            'kwargs': kwargs or {},
+        }
+        if claim_check is not None:
+            data['claim_check'] = claim_check
+        return Message(data)
+
+    def check_out(self, store: BlobStore) -> None:
+        """
+        Fetches args and kwargs that were offloaded to the blob store, if they weren't fetched yet
+        """
+        if self._claim_check is None or self._checked_out:
+            return
+        self._args, self._kwargs = check_out(store, self._claim_check)
+        self._checked_out = True
 
     def call_task(self) -> None:
         """
@@ -222,6 +245,12 @@ class Message:
         """
         self.task.call(self)
 
+    async def call_task_async(self) -> None:
+        """
+        Call the task with this message from an event loop
+        """
+        await self.task.call_async(self)
+
     def __eq__(self, other) -> bool:
         if not isinstance(other, self.__class__):
             return NotImplemented
@@ -276,6 +305,13 @@ class Message:
     def task_name(self) -> str:
         return self._task_name
 
+    @property
+    def claim_check(self) -> Optional[dict]:
+        """
+        Reference to args and kwargs that were offloaded to the blob store, if the message was too large to publish
+        """
+        return self._claim_check
+
     @property
     def args(self) -> list:
         return self._args
@@ -288,7 +324,7 @@ class Message:
         return self.as_dict().items()
 
     def as_dict(self) -> dict:
-        return {
+        data = {
             'id': self.id,
             'metadata': self.metadata.as_dict(),
             'headers': self.headers,
@@ -296,6 +332,10 @@ class Message:
             'args': self.args,
             'kwargs': self.kwargs,
         }
+        if self._claim_check is not None:
+            # keep referring to the blob, so that re-published messages don't offload it again
+            data.update(args=[], kwargs={}, claim_check=self._claim_check)
+        return data
 
 
 class Priority(enum.Enum):
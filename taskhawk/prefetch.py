@@ -0,0 +1,178 @@
+import collections
+import logging
+import threading
+import time
+import typing
+from typing import Deque, List, Optional, Tuple
+
+from taskhawk.backends.base import TaskhawkConsumerBaseBackend
+from taskhawk.backpressure import Backpressure
+
+
+logger = logging.getLogger(__name__)
+
+
+PULL_ERROR_BACKOFF_S = 1.0
+
+BACKPRESSURE_WAIT_S = 1.0
+
+VISIBILITY_SAFETY_FACTOR = 0.5
+"""
+Fraction of the visibility timeout a prefetched batch may spend waiting before it's processed
+"""
+
+
+class Prefetcher:
+    """
+    Pulls batches of messages on a background thread while the consumer processes the current batch, so that the
+    consumer doesn't sit idle during every pull round-trip.
+
+    Prefetched messages are already invisible to other consumers, so their visibility timeout is running while they
+    wait. The prefetcher tracks how long batches take to process, and only pulls ahead while the expected wait stays
+    within half the visibility timeout. When tasks run long, it falls back to pulling on demand. Batches that waited
+    too long anyway are dropped, since they may already have been redelivered to another consumer. Dropped messages are
+    nacked, so that ones that weren't redelivered yet are right away, and so that they stop holding flow control.
+    """
+
+    def __init__(
+        self,
+        consumer_backend: TaskhawkConsumerBaseBackend,
+        num_messages: int,
+        visibility_timeout_s: Optional[int],
+        depth: int,
+        backpressure: Optional[Backpressure] = None,
+    ) -> None:
+        if depth <= 0:
+            raise ValueError("depth must be greater than zero")
+        self._consumer_backend = consumer_backend
+        self._num_messages = num_messages
+        self._visibility_timeout_s = visibility_timeout_s
+        self._depth = depth
+        self._backpressure = backpressure
+        self._window_s = (
+            visibility_timeout_s if visibility_timeout_s is not None else consumer_backend.DEFAULT_VISIBILITY_TIMEOUT_S
+        )
+        self._buffer: Deque[Tuple[float, List]] = collections.deque()
+        self._batch_duration_s = 0.0
+        self._last_get_at: Optional[float] = None
+        self._pulled_at: Optional[float] = None
+        self._waiting = False
+        self._stopped = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='taskhawk-prefetch', daemon=True)
+
+    def start(self) -> 'Prefetcher':
+        self._thread.start()
+        return self
+
+    @property
+    def batch_duration_s(self) -> float:
+        """
+        Moving average of how long the consumer takes between consecutive batches
+        """
+        return self._batch_duration_s
+
+    @property
+    def pulled_at(self) -> Optional[float]:
+        """
+        `time.monotonic()` at which the batch last returned by `get` was pulled
+        """
+        return self._pulled_at
+
+    def _should_prefetch(self) -> bool:
+        if len(self._buffer) >= self._depth:
+            return False
+        if self._window_s is None:
+            return True
+        expected_wait_s = self._batch_duration_s * (len(self._buffer) + 1)
+        return expected_wait_s < self._window_s * VISIBILITY_SAFETY_FACTOR
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                self._cond.wait_for(
+                    lambda: self._stopped or (self._waiting and not self._buffer) or self._should_prefetch()
+                )
+                if self._stopped:
+                    return
+            num_messages = self._num_messages
+            if self._backpressure is not None:
+                num_messages = self._backpressure.capacity(num_messages, timeout=BACKPRESSURE_WAIT_S)
+                if not num_messages:
+                    continue
+            try:
+                queue_messages = self._consumer_backend.pull_messages(num_messages, self._visibility_timeout_s)
+            except Exception:
+                logger.exception('Exception while prefetching messages')
+                time.sleep(PULL_ERROR_BACKOFF_S)
+                continue
+            with self._cond:
+                stopped = self._stopped
+                if not stopped:
+                    self._buffer.append((time.monotonic(), queue_messages))
+                    self._cond.notify_all()
+            if stopped:
+                self._release(queue_messages)
+                return
+
+    def get(self) -> List:
+        """
+        Returns the next batch of messages, blocking until one is available. Returns an empty list if the prefetcher
+        was stopped.
+        """
+        now = time.monotonic()
+        if self._last_get_at is not None:
+            # the consumer comes back for the next batch once it's done with the previous one
+            duration_s = now - self._last_get_at
+            self._batch_duration_s = (
+                duration_s if not self._batch_duration_s else (0.8 * self._batch_duration_s + 0.2 * duration_s)
+            )
+
+        stale: typing.List = []
+        queue_messages: typing.List
+        with self._cond:
+            while True:
+                self._waiting = True
+                self._cond.notify_all()
+                self._cond.wait_for(lambda: self._stopped or bool(self._buffer))
+                self._waiting = False
+                if self._stopped:
+                    pulled_at, queue_messages = time.monotonic(), []
+                    break
+                pulled_at, queue_messages = self._buffer.popleft()
+                self._cond.notify_all()
+                waited_s = time.monotonic() - pulled_at
+                if self._window_s is not None and queue_messages and waited_s >= self._window_s:
+                    logger.warning(
+                        'Dropping prefetched messages that waited past their visibility timeout',
+                        extra={'num_messages': len(queue_messages), 'waited_s': waited_s},
+                    )
+                    stale.extend(queue_messages)
+                    continue
+                break
+        self._release(stale)
+
+        self._pulled_at = pulled_at
+        self._last_get_at = time.monotonic()
+        return queue_messages
+
+    def stop(self) -> None:
+        """
+        Stops prefetching, and nacks messages that were prefetched but not handed out, so they're redelivered right
+        away rather than after their visibility timeout.
+        """
+        with self._cond:
+            self._stopped = True
+            buffered = [queue_message for _, batch in self._buffer for queue_message in batch]
+            self._buffer.clear()
+            self._cond.notify_all()
+        self._release(buffered)
+
+    def _release(self, queue_messages: typing.List) -> None:
+        for queue_message in queue_messages:
+            try:
+                self._consumer_backend.nack_message(queue_message)
+            except Exception:
+                logger.exception('Exception while nacking message', extra={'queue_message': queue_message})
+        if queue_messages:
+            self._consumer_backend.flush()
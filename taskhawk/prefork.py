@@ -0,0 +1,215 @@
+import gc
+import importlib
+import logging
+import os
+import signal
+import threading
+import time
+from typing import Dict, Iterable, Optional
+
+from taskhawk import consumer
+from taskhawk.backends.import_utils import import_class
+from taskhawk.backends.utils import get_blob_store, get_consumer_backend, get_publisher_backend
+from taskhawk.conf import settings
+from taskhawk.consumer import listen_for_messages
+from taskhawk.drain import handle_signals
+from taskhawk.models import Priority
+
+
+logger = logging.getLogger(__name__)
+
+
+RESTART_BACKOFF_S = 1.0
+"""
+Minimum delay between restarts of crashed worker processes, so a task module that crashes on import doesn't cause a
+tight fork loop
+"""
+
+SHUTDOWN_TIMEOUT_S = 30.0
+"""
+How long to wait for worker processes to exit after they were asked to shut down before they're killed
+"""
+
+_POLL_INTERVAL_S = 0.5
+
+
+def _preload(task_modules: Iterable[str]) -> None:
+    """
+    Resolve everything that would otherwise be lazily loaded by every worker process, so that it's loaded once in the
+    parent and shared with the workers copy-on-write.
+    """
+    for module in task_modules:
+        importlib.import_module(module)
+    for attr in (
+        'TASKHAWK_DEFAULT_HEADERS',
+        'TASKHAWK_HEARTBEAT_HOOK',
+        'TASKHAWK_PRE_PROCESS_HOOK',
+        'TASKHAWK_POST_PROCESS_HOOK',
+        'TASKHAWK_TASK_CLASS',
+        'TASKHAWK_TASK_TIMEOUT_HOOK',
+    ):
+        getattr(settings, attr)
+    # imports boto3 / google-cloud-pubsub, but doesn't create any clients since those aren't fork-safe
+    import_class(settings.TASKHAWK_CONSUMER_BACKEND)
+
+
+def _run_worker(parent_pid: int, listen_kwargs: dict) -> None:
+    gc.enable()
+
+    # backends hold network clients which must never be shared across a fork
+    get_consumer_backend.cache_clear()
+    get_publisher_backend.cache_clear()
+    get_blob_store.cache_clear()
+
+    shutdown_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: shutdown_event.set())
+    signal.signal(signal.SIGINT, lambda *_: shutdown_event.set())
+
+    def _watch_parent() -> None:
+        while not shutdown_event.wait(_POLL_INTERVAL_S):
+            if os.getppid() != parent_pid:
+                logger.warning('Supervisor process died, shutting down worker')
+                shutdown_event.set()
+
+    threading.Thread(target=_watch_parent, daemon=True).start()
+
+    # a stuck consumer may exit right away, since it's restarted
+    consumer._supervised = True
+    listen_for_messages(shutdown_event=shutdown_event, **listen_kwargs)
+
+
+def _spawn(listen_kwargs: dict) -> int:
+    parent_pid = os.getpid()
+    pid = os.fork()
+    if pid == 0:
+        exit_code = 0
+        try:
+            _run_worker(parent_pid, listen_kwargs)
+        except BaseException:
+            logger.exception('Exception in worker process')
+            exit_code = 1
+        finally:
+            logging.shutdown()
+            os._exit(exit_code)
+    logger.info('Started worker process', extra={'pid': pid})
+    return pid
+
+
+def listen_for_messages_prefork(
+    priority: Priority,
+    processes: Optional[int] = None,
+    num_messages: int = 1,
+    visibility_timeout_s: Optional[int] = None,
+    loop_count: Optional[int] = None,
+    shutdown_event: Optional[threading.Event] = None,
+    concurrency: Optional[int] = None,
+    prefetch: Optional[int] = None,
+    lease_s: Optional[int] = None,
+    drain_timeout_s: Optional[float] = None,
+    task_modules: Iterable[str] = (),
+) -> None:
+    """
+    Starts a supervisor that forks worker processes which each run :meth:`taskhawk.listen_for_messages`.
+
+    Settings, task modules and cloud libraries are loaded once in the supervisor and shared with workers
+    copy-on-write, so pass all task modules as `task_modules`, or import them before calling this function. Each
+    worker creates its own consumer backend after the fork. Workers that crash are restarted.
+
+    This function is blocking. It returns once all workers have exited cleanly (for example, if `loop_count` was
+    given), or after `shutdown_event` is set, in which case workers are asked to shut down with SIGTERM. SIGTERM and
+    SIGINT received by the supervisor set `shutdown_event` when called from the main thread.
+
+    Only available on platforms that support `os.fork`.
+
+    :param priority: The priority queue to listen to
+    :param processes: Number of worker processes. Defaults to None, which means use ``TASKHAWK_CONSUMER_PROCESSES``
+        setting, or the number of CPUs if that isn't set.
+    :param num_messages: Maximum number of messages to fetch in one API call. Defaults to 1
+    :param visibility_timeout_s: The number of seconds the message should remain invisible to other queue readers.
+        Defaults to None, which is queue default
+    :param loop_count: How many times each worker fetches messages. Default to None, which means loop forever.
+    :param shutdown_event: An event to signal that the supervisor and its workers should shut down.
+    :param concurrency: Number of messages each worker processes concurrently. See :meth:`listen_for_messages`.
+    :param prefetch: Number of batches each worker pulls ahead. See :meth:`listen_for_messages`.
+    :param lease_s: Lease used by each worker to extend visibility. See :meth:`listen_for_messages`.
+    :param drain_timeout_s: How long each worker waits for messages being processed once it's asked to shut down. See
+        :meth:`listen_for_messages`.
+    :param task_modules: Names of modules that define tasks, which are imported by the supervisor before forking.
+    """
+    if not shutdown_event:
+        shutdown_event = threading.Event()
+    if processes is None:
+        processes = settings.TASKHAWK_CONSUMER_PROCESSES or os.cpu_count() or 1
+    if processes <= 0:
+        raise ValueError("processes must be greater than zero")
+
+    listen_kwargs = dict(
+        priority=priority,
+        num_messages=num_messages,
+        visibility_timeout_s=visibility_timeout_s,
+        loop_count=loop_count,
+        concurrency=concurrency,
+        prefetch=prefetch,
+        lease_s=lease_s,
+        drain_timeout_s=drain_timeout_s,
+    )
+
+    _preload(task_modules)
+    # collections in the supervisor would touch objects shared with workers, so don't do any from here on. Move
+    # everything allocated so far out of GC tracking, so collections in workers don't touch (and copy) shared pages
+    # either.
+    gc.disable()
+    gc.freeze()
+
+    children: Dict[int, float] = {}
+    with handle_signals(shutdown_event):
+        try:
+            for _ in range(processes):
+                children[_spawn(listen_kwargs)] = time.monotonic()
+
+            while children and not shutdown_event.is_set():
+                pid, status = os.waitpid(-1, os.WNOHANG)
+                if pid == 0:
+                    shutdown_event.wait(_POLL_INTERVAL_S)
+                    continue
+                started_at = children.pop(pid, None)
+                if started_at is None:
+                    continue
+                exit_code = os.waitstatus_to_exitcode(status)
+                if exit_code == 0:
+                    logger.info('Worker process exited', extra={'pid': pid})
+                    continue
+                logger.error('Worker process crashed, restarting', extra={'pid': pid, 'exit_code': exit_code})
+                backoff = RESTART_BACKOFF_S - (time.monotonic() - started_at)
+                if backoff > 0 and shutdown_event.wait(backoff):
+                    break
+                children[_spawn(listen_kwargs)] = time.monotonic()
+        finally:
+            _stop_children(children)
+            gc.unfreeze()
+            gc.enable()
+
+
+def _stop_children(children: Dict[int, float]) -> None:
+    for pid in children:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+    deadline = time.monotonic() + SHUTDOWN_TIMEOUT_S
+    while children and time.monotonic() < deadline:
+        pid, _ = os.waitpid(-1, os.WNOHANG)
+        if pid == 0:
+            time.sleep(0.1)
+        else:
+            children.pop(pid, None)
+
+    for pid in list(children):
+        logger.warning('Worker process did not shut down in time, killing it', extra={'pid': pid})
+        try:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        except (ProcessLookupError, ChildProcessError):
+            pass
+        children.pop(pid, None)
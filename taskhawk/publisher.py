@@ -1,15 +1,100 @@
+import collections
+import dataclasses
 import typing
-from concurrent.futures import Future
-from typing import Optional
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Deque, Iterable, List, Optional, Tuple
+
+import funcy
 
 from taskhawk.backends.base import TaskhawkPublisherBaseBackend
 from taskhawk.backends.utils import get_publisher_backend
 from taskhawk.models import Message
 
 
+DEFAULT_CHUNK_SIZE = 500
+"""
+Default number of messages built and published together by `publish_many`
+"""
+
+DEFAULT_MAX_IN_FLIGHT = 8
+"""
+Default number of chunks `publish_many` publishes at once
+"""
+
+
+@dataclasses.dataclass
+class DispatchResult:
+    """
+    Outcome of dispatching many messages at once
+    """
+
+    dispatched: int = 0
+    """
+    Number of messages that were published
+    """
+
+    failed: List[Tuple[Message, BaseException]] = dataclasses.field(default_factory=list)
+    """
+    Messages that couldn't be published, with their exceptions. These may be published again with
+    :meth:`taskhawk.publish`.
+    """
+
+    @property
+    def ok(self) -> bool:
+        """
+        :return: True if all messages were published
+        """
+        return not self.failed
+
+
 def publish(message: Message, backend: Optional[TaskhawkPublisherBaseBackend] = None) -> typing.Union[str, Future]:
     """
     Publishes a message on Taskhawk topic
     """
     backend = backend or get_publisher_backend(priority=message.priority)
     return backend.publish(message)
+
+
+def _publish_chunk(
+    messages: List[Message], backend: Optional[TaskhawkPublisherBaseBackend]
+) -> List[Tuple[Message, Optional[BaseException]]]:
+    outcomes: List[Tuple[Message, Optional[BaseException]]] = []
+    for priority, group in funcy.group_by(lambda m: m.priority, messages).items():
+        futures = (backend or get_publisher_backend(priority=priority)).publish_many(group)
+        outcomes.extend((message, future.exception()) for message, future in zip(group, futures))
+    return outcomes
+
+
+def publish_many(
+    messages: Iterable[Message],
+    backend: Optional[TaskhawkPublisherBaseBackend] = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    max_in_flight: int = DEFAULT_MAX_IN_FLIGHT,
+) -> DispatchResult:
+    """
+    Publishes many messages on Taskhawk topics, using batch requests where the provider supports them. Messages are
+    consumed from `messages` lazily, `chunk_size` at a time, and up to `max_in_flight` chunks are published at once on
+    a pool of threads. Failures don't stop the remaining messages from being published.
+
+    :return: how many messages were published, and which ones failed
+    """
+    if chunk_size <= 0 or max_in_flight <= 0:
+        raise ValueError("chunk_size and max_in_flight must be greater than zero")
+    result = DispatchResult()
+
+    def _collect(future: Future) -> None:
+        for message, error in future.result():
+            if error is None:
+                result.dispatched += 1
+            else:
+                result.failed.append((message, error))
+
+    with ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix='taskhawk-dispatch') as executor:
+        pending: Deque[Future] = collections.deque()
+        for chunk in funcy.chunks(chunk_size, messages):
+            if len(pending) >= max_in_flight:
+                _collect(pending.popleft())
+            pending.append(executor.submit(_publish_chunk, chunk, backend))
+        while pending:
+            _collect(pending.popleft())
+    return result
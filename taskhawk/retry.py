@@ -0,0 +1,68 @@
+import random
+from typing import Optional
+
+
+RETRY_AT_HEADER = 'taskhawk-retry-at'
+"""
+Header of a re-published message with the time before which it shouldn't be run, in epoch milliseconds
+"""
+
+ATTEMPT_HEADER = 'taskhawk-attempt'
+"""
+Header of a re-published message with the number of delivery attempts before it was re-published
+"""
+
+
+class Backoff:
+    """
+    Retry policy for a task that delays retries exponentially. After a message's n-th failed delivery attempt, it's
+    retried after ``base ** n`` seconds, up to `max` seconds. With `jitter`, the delay is picked at random between half
+    of that and all of it, so that messages that failed together don't all retry together.
+
+    .. code:: python
+
+        @taskhawk.task(retry=taskhawk.Backoff(base=2, max=3600, jitter=True))
+        def send_email(to: str, subject: str) -> None:
+            ...
+    """
+
+    def __init__(self, base: float = 2, max: float = 3600, jitter: bool = True) -> None:
+        if base <= 1:
+            raise ValueError("base must be greater than one")
+        if max < 1:
+            raise ValueError("max must be at least one")
+        self.base = base
+        self.max = max
+        self.jitter = jitter
+
+    def delay(self, attempt: int) -> int:
+        """
+        :param attempt: Number of the delivery attempt that failed, starting at 1
+        :return: number of seconds to wait before the next attempt
+        """
+        # cap the exponent so large attempt counts don't overflow
+        delay_s: float = self.max if attempt >= 64 else min(self.max, self.base ** max(attempt, 1))
+        if self.jitter:
+            delay_s = random.uniform(delay_s / 2, delay_s)
+        return max(1, round(delay_s))
+
+    def __repr__(self) -> str:
+        return f'Backoff(base={self.base}, max={self.max}, jitter={self.jitter})'
+
+
+def delivery_attempt(headers: dict, provider_attempt: Optional[int]) -> int:
+    """
+    Counts the delivery attempts of a message, including those before it was re-published for a delayed retry.
+
+    :param headers: Message headers
+    :param provider_attempt: Delivery attempt reported by the provider, if known
+    """
+    try:
+        previous = int(headers.get(ATTEMPT_HEADER, 0))
+    except ValueError:
+        previous = 0
+    attempt = provider_attempt or 1
+    if RETRY_AT_HEADER in headers:
+        # a re-published message is usually delivered once early, only to be deferred until its retry is due
+        attempt = max(attempt - 1, 1)
+    return previous + attempt
@@ -0,0 +1,190 @@
+import logging
+import threading
+import time
+from typing import Dict, Iterable, List, Mapping, Optional
+
+from taskhawk.backends.base import TaskhawkConsumerBaseBackend
+from taskhawk.models import Priority
+
+
+logger = logging.getLogger(__name__)
+
+
+PULL_ERROR_BACKOFF_S = 1.0
+
+PRIORITY_ORDER = (Priority.high, Priority.default, Priority.low, Priority.bulk)
+"""
+Order in which priorities win ties
+"""
+
+
+class WeightedScheduler:
+    """
+    Picks which priority queue to serve next using smooth weighted round robin. When several queues have messages
+    ready, each is served in proportion to its weight, spread evenly rather than in bursts, so a busy high priority
+    queue can't starve the bulk queue. Queues that have nothing ready don't build up credit. Ties go to the higher
+    priority, so when queues are otherwise even, high is served first.
+    """
+
+    def __init__(self, weights: Mapping[Priority, int]) -> None:
+        if not weights:
+            raise ValueError("weights must not be empty")
+        for priority, weight in weights.items():
+            if weight <= 0:
+                raise ValueError(f"weight for {priority.name} must be greater than zero")
+        self._weights = dict(weights)
+        self._credits: Dict[Priority, int] = {priority: 0 for priority in weights}
+        self._lock = threading.Lock()
+
+    @property
+    def priorities(self) -> List[Priority]:
+        return sorted(self._weights, key=PRIORITY_ORDER.index)
+
+    def next(self, ready: Iterable[Priority]) -> Optional[Priority]:
+        """
+        Returns the priority to serve next out of those that have messages ready, or None if none are.
+        """
+        ready = set(ready)
+        candidates = [priority for priority in self.priorities if priority in ready]
+        if not candidates:
+            return None
+        with self._lock:
+            total = 0
+            for priority in candidates:
+                self._credits[priority] += self._weights[priority]
+                total += self._weights[priority]
+            # max() returns the first maximum, and candidates are in priority order
+            chosen = max(candidates, key=lambda priority: self._credits[priority])
+            self._credits[chosen] -= total
+            return chosen
+
+
+def parse_weights(weights: Mapping) -> Dict[Priority, int]:
+    """
+    Converts a mapping of priority, or priority name, to weight into a mapping of `Priority` to weight
+    """
+    return {
+        (priority if isinstance(priority, Priority) else Priority[priority]): int(weight)
+        for priority, weight in weights.items()
+    }
+
+
+class QueuePoller:
+    """
+    Long-polls a single priority queue on a background thread, and holds on to at most one batch until it's taken.
+    Since the next pull only starts after the previous batch was taken, messages of a queue that isn't scheduled stay
+    on the queue rather than in memory.
+
+    A batch that isn't taken within its visibility timeout is dropped, since it may already have been redelivered to
+    another consumer. Dropped messages are nacked, and the queue is polled again.
+    """
+
+    def __init__(
+        self,
+        priority: Priority,
+        consumer_backend: TaskhawkConsumerBaseBackend,
+        num_messages: int,
+        visibility_timeout_s: Optional[int],
+        ready: threading.Condition,
+    ) -> None:
+        self.priority = priority
+        self.consumer_backend = consumer_backend
+        self._num_messages = num_messages
+        self._visibility_timeout_s = visibility_timeout_s
+        self._window_s = (
+            visibility_timeout_s if visibility_timeout_s is not None else consumer_backend.DEFAULT_VISIBILITY_TIMEOUT_S
+        )
+        self._ready = ready
+        self._batch: Optional[List] = None
+        self._batch_pulled_at = 0.0
+        self._pulled_at: Optional[float] = None
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name=f'taskhawk-poller-{priority.name}', daemon=True)
+
+    def start(self) -> 'QueuePoller':
+        self._thread.start()
+        return self
+
+    @property
+    def has_batch(self) -> bool:
+        """
+        Whether a batch is ready to be taken. Must be called while holding the `ready` condition.
+        """
+        return self._batch is not None and not self._expired()
+
+    def _expired(self) -> bool:
+        return self._window_s is not None and time.monotonic() - self._batch_pulled_at >= self._window_s
+
+    @property
+    def pulled_at(self) -> Optional[float]:
+        """
+        `time.monotonic()` at which the batch that was last taken was pulled
+        """
+        return self._pulled_at
+
+    def take(self) -> List:
+        """
+        Takes the ready batch. Must be called while holding the `ready` condition.
+        """
+        assert self._batch is not None
+        batch, self._batch = self._batch, None
+        self._pulled_at = self._batch_pulled_at
+        self._ready.notify_all()
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            stale = None
+            with self._ready:
+                while not self._stopped and self._batch is not None:
+                    if self._expired():
+                        stale, self._batch = self._batch, None
+                        break
+                    self._ready.wait(
+                        None if self._window_s is None else self._batch_pulled_at + self._window_s - time.monotonic()
+                    )
+                if self._stopped:
+                    return
+            if stale is not None:
+                logger.warning(
+                    'Dropping messages that waited past their visibility timeout',
+                    extra={'num_messages': len(stale), 'priority': self.priority.name},
+                )
+                self._release(stale)
+            try:
+                queue_messages = self.consumer_backend.pull_messages(self._num_messages, self._visibility_timeout_s)
+                pulled_at = time.monotonic()
+            except Exception:
+                logger.exception('Exception while pulling messages', extra={'priority': self.priority.name})
+                time.sleep(PULL_ERROR_BACKOFF_S)
+                continue
+            if not queue_messages:
+                continue
+            with self._ready:
+                stopped = self._stopped
+                if not stopped:
+                    self._batch = queue_messages
+                    self._batch_pulled_at = pulled_at
+                    self._ready.notify_all()
+            if stopped:
+                self._release(queue_messages)
+                return
+
+    def stop(self) -> None:
+        """
+        Stops polling, and nacks the batch that wasn't taken so it's redelivered right away.
+        """
+        with self._ready:
+            self._stopped = True
+            batch, self._batch = self._batch, None
+            self._ready.notify_all()
+        if batch:
+            self._release(batch)
+
+    def _release(self, queue_messages: List) -> None:
+        for queue_message in queue_messages:
+            try:
+                self.consumer_backend.nack_message(queue_message)
+            except Exception:
+                logger.exception('Exception while nacking message', extra={'queue_message': queue_message})
+        self.consumer_backend.flush()
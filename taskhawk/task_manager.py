@@ -1,19 +1,82 @@
+import asyncio
 import copy
+import dataclasses
 import inspect
 import typing
-from concurrent.futures import Future
+from concurrent.futures import Future, ThreadPoolExecutor
 from typing import Optional
 
 from taskhawk.conf import settings
 from taskhawk.exceptions import ConfigurationError, TaskNotFound
+from taskhawk.limits import TaskLimiter
 from taskhawk.models import Metadata, Message, Priority
-from taskhawk.publisher import publish
+from taskhawk.publisher import DEFAULT_CHUNK_SIZE, DEFAULT_MAX_IN_FLIGHT, DispatchResult, publish, publish_many
+from taskhawk.retry import Backoff
 
 
 _ALL_TASKS: dict = {}
 
 
-def task(*args, priority: Priority = Priority.default, name: typing.Optional[str] = None) -> typing.Any:
+DEFAULT_BATCH_WINDOW_MS = 1000
+"""
+How long the oldest message of a batch task waits for more messages by default, in milliseconds
+"""
+
+
+def _run_coroutine(coroutine: typing.Coroutine) -> typing.Any:
+    """
+    Runs a coroutine to completion from synchronous code. `asyncio.run` can't be called from a thread that's running an
+    event loop already, e.g. when a coroutine dispatches a task with ``TASKHAWK_SYNC`` set, so the coroutine is run on a
+    new event loop on another thread then.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix='taskhawk-sync') as executor:
+        return executor.submit(asyncio.run, coroutine).result()
+
+
+@dataclasses.dataclass(frozen=True)
+class BatchItem:
+    """
+    One message of a batch passed to a batch task
+    """
+
+    args: list
+    """
+    Arguments the task was dispatched with
+    """
+
+    kwargs: dict
+    """
+    Keyword arguments the task was dispatched with
+    """
+
+    metadata: Metadata
+    """
+    Metadata of the message
+    """
+
+    headers: dict
+    """
+    Custom headers sent with the message
+    """
+
+
+def task(
+    *args,
+    priority: Priority = Priority.default,
+    name: typing.Optional[str] = None,
+    max_lease_s: typing.Optional[float] = None,
+    max_concurrency: typing.Optional[int] = None,
+    rate_limit: typing.Optional[str] = None,
+    timeout: typing.Optional[float] = None,
+    batch_size: typing.Optional[int] = None,
+    batch_window_ms: typing.Optional[int] = None,
+    retry: typing.Optional[Backoff] = None,
+    max_attempts: typing.Optional[int] = None,
+) -> typing.Any:
     """
     Decorator for taskhawk task functions. Any function may be converted into a task by adding this decorator
     as such:
@@ -24,6 +87,42 @@ def task(*args, priority: Priority = Priority.default, name: typing.Optional[str
         def send_email(to: str, subject: str, from: str = None) -> None:
             ...
 
+    Coroutine functions (``async def``) may be tasks too. These are awaited by
+    :meth:`taskhawk.listen_for_messages_async`, and run on a new event loop by other consumers.
+
+    When consumers extend visibility automatically (see ``TASKHAWK_CONSUMER_LEASE_S``), ``max_lease_s`` caps how long
+    a message of this task is kept invisible, overriding ``TASKHAWK_CONSUMER_MAX_LEASE_S``.
+
+    ``max_concurrency`` limits how many messages of this task a consumer runs at once, and ``rate_limit`` how often,
+    e.g. ``"100/s"``, ``"10/m"`` or ``"500/h"``. Messages over either limit aren't run, and are instead redelivered
+    after a delay by extending their visibility timeout. Limits apply to each consumer process separately.
+
+    ``timeout`` is the number of seconds after which a running task is considered stuck. Its message is then nacked,
+    and the consumer replaces the stuck worker. See ``TASKHAWK_TASK_TIMEOUT_HOOK``.
+
+    ``batch_size`` makes this a batch task, which is called with a list of :class:`taskhawk.BatchItem` instead:
+
+    .. code:: python
+
+        @taskhawk.task(batch_size=100, batch_window_ms=500)
+        def index_documents(items: List[taskhawk.BatchItem]) -> Optional[Dict[int, Exception]]:
+            ...
+
+        index_documents.dispatch(document_id)
+
+    Each message is still dispatched on its own. Consumers collect messages of a batch task across pulls, and call it
+    once ``batch_size`` messages are waiting, or once the oldest has waited ``batch_window_ms`` milliseconds (one second
+    by default). The task may return a mapping of index to exception for items that failed, and only those messages
+    are retried. If it raises, every message in the batch fails with that exception. Batch tasks don't support
+    ``max_concurrency``, ``rate_limit`` or ``timeout``.
+
+    ``retry`` sets a retry policy, such as :class:`taskhawk.Backoff`, which delays retries of failed messages by how
+    many times they were delivered. Otherwise, failed messages are retried as soon as the provider redelivers them,
+    unless the task raises ``RetryException`` with a delay.
+
+    ``max_attempts`` is the number of times a message of this task is delivered before it's moved to the dead letter
+    queue, overriding ``TASKHAWK_CONSUMER_MAX_ATTEMPTS``.
+
     Additional methods available on tasks are described by :class:`taskhawk.Task` class
     """
 
@@ -34,8 +133,21 @@ def task(*args, priority: Priority = Priority.default, name: typing.Optional[str
             func = existing_task.fn
             raise ConfigurationError(f'Task named "{task_name}" already exists: {func.__module__}.{func.__name__}')
 
-        fn.task = Task(fn, priority, task_name)
+        fn.task = Task(
+            fn,
+            priority,
+            task_name,
+            max_lease_s=max_lease_s,
+            max_concurrency=max_concurrency,
+            rate_limit=rate_limit,
+            timeout=timeout,
+            batch_size=batch_size,
+            batch_window_ms=batch_window_ms,
+            retry=retry,
+            max_attempts=max_attempts,
+        )
         fn.dispatch = fn.task.dispatch
+        fn.dispatch_many = fn.task.dispatch_many
         fn.with_headers = fn.task.with_headers
         fn.with_priority = fn.task.with_priority
         _ALL_TASKS[fn.task.name] = fn.task
@@ -97,6 +209,35 @@ class AsyncInvocation:
         )
         return publish(message)
 
+    def dispatch_many(
+        self,
+        items: typing.Iterable,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        max_in_flight: int = DEFAULT_MAX_IN_FLIGHT,
+    ) -> DispatchResult:
+        """
+        Dispatch the task once for each item, publishing in batches where the provider supports them. Each item is a
+        tuple of arguments to pass to the task, or a single argument that isn't a tuple. Items are consumed lazily, so
+        these may come from a generator. Unlike `dispatch`, arguments aren't copied, and mustn't be modified while this
+        runs.
+
+        :param items: arguments for each invocation
+        :param chunk_size: number of messages built and published together
+        :param max_in_flight: number of chunks published at once
+        :returns: how many messages were published, and which ones failed
+        """
+        priority = self._priority or self._task.priority
+        messages = (
+            Message.new(
+                self._task.name,
+                priority,
+                item if isinstance(item, tuple) else (item,),
+                headers={**settings.TASKHAWK_DEFAULT_HEADERS(task=self._task), **self._headers},
+            )
+            for item in items
+        )
+        return publish_many(messages, chunk_size=chunk_size, max_in_flight=max_in_flight)
+
 
 class Task:
     """
@@ -122,13 +263,52 @@ class Task:
 
     """
 
-    def __init__(self, fn: typing.Callable, priority: Priority, name: str) -> None:
+    def __init__(
+        self,
+        fn: typing.Callable,
+        priority: Priority,
+        name: str,
+        max_lease_s: typing.Optional[float] = None,
+        max_concurrency: typing.Optional[int] = None,
+        rate_limit: typing.Optional[str] = None,
+        timeout: typing.Optional[float] = None,
+        batch_size: typing.Optional[int] = None,
+        batch_window_ms: typing.Optional[int] = None,
+        retry: typing.Optional[Backoff] = None,
+        max_attempts: typing.Optional[int] = None,
+    ) -> None:
+        if timeout is not None and timeout <= 0:
+            raise ConfigurationError("timeout must be greater than zero")
+        if max_attempts is not None and max_attempts <= 0:
+            raise ConfigurationError("max_attempts must be greater than zero")
+        if batch_size is not None:
+            if batch_size <= 0:
+                raise ConfigurationError("batch_size must be greater than zero")
+            if batch_window_ms is not None and batch_window_ms < 0:
+                raise ConfigurationError("batch_window_ms must not be negative")
+            if max_concurrency is not None or rate_limit is not None or timeout is not None:
+                raise ConfigurationError("Batch tasks don't support max_concurrency, rate_limit or timeout")
+        elif batch_window_ms is not None:
+            raise ConfigurationError("batch_window_ms requires batch_size")
         self._name = name
         self._fn = fn
         self._priority = priority
-        signature = inspect.signature(fn)
+        self._max_lease_s = max_lease_s
+        self._timeout = timeout
+        self._batch_size = batch_size
+        self._retry = retry
+        self._max_attempts = max_attempts
+        self._batch_window_ms = batch_window_ms if batch_window_ms is not None else DEFAULT_BATCH_WINDOW_MS
+        self._limiter: typing.Optional[TaskLimiter] = None
+        if max_concurrency is not None or rate_limit is not None:
+            self._limiter = TaskLimiter(max_concurrency=max_concurrency, rate_limit=rate_limit)
+        self._is_async = inspect.iscoroutinefunction(fn)
         self._accepts_metadata = False
         self._accepts_headers = False
+        if batch_size is not None:
+            # batch tasks get metadata and headers with each item
+            return
+        signature = inspect.signature(fn)
         for p in signature.parameters.values():
             # if **kwargs is specified, just pass all things by default since function can always inspect arg names
             if p.kind == inspect.Parameter.VAR_KEYWORD:
@@ -163,6 +343,55 @@ class Task:
         """
         return self._priority
 
+    @property
+    def max_lease_s(self) -> typing.Optional[float]:
+        """
+        :return: Maximum number of seconds a message's visibility is extended for, if set for this task
+        """
+        return self._max_lease_s
+
+    @property
+    def timeout(self) -> typing.Optional[float]:
+        """
+        :return: Number of seconds after which a running task is considered stuck, if set for this task
+        """
+        return self._timeout
+
+    @property
+    def batch_size(self) -> typing.Optional[int]:
+        """
+        :return: Maximum number of messages the task is called with at once, if this is a batch task
+        """
+        return self._batch_size
+
+    @property
+    def batch_window_ms(self) -> int:
+        """
+        :return: How long the oldest message of a batch waits for more messages, in milliseconds
+        """
+        return self._batch_window_ms
+
+    @property
+    def retry(self) -> typing.Optional[Backoff]:
+        """
+        :return: Retry policy for failed messages, if set for this task
+        """
+        return self._retry
+
+    @property
+    def max_attempts(self) -> typing.Optional[int]:
+        """
+        :return: Number of deliveries after which messages are moved to the dead letter queue, if set for this task
+        """
+        return self._max_attempts
+
+    @property
+    def limiter(self) -> typing.Optional[TaskLimiter]:
+        """
+        :return: Limiter that enforces ``max_concurrency`` and ``rate_limit``, if either is set for this task
+        """
+        return self._limiter
+
     @property
     def fn(self) -> typing.Callable:
         """ "
@@ -170,6 +399,13 @@ class Task:
         """
         return self._fn
 
+    @property
+    def is_async(self) -> bool:
+        """
+        :return: Flag indicating if task function is a coroutine function
+        """
+        return self._is_async
+
     @property
     def accepts_metadata(self) -> bool:
         """
@@ -211,18 +447,104 @@ class Task:
         """
         AsyncInvocation(self).dispatch(*args, **kwargs)
 
-    def call(self, message: "Message") -> None:
+    def dispatch_many(
+        self,
+        items: typing.Iterable,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        max_in_flight: int = DEFAULT_MAX_IN_FLIGHT,
+    ) -> DispatchResult:
         """
-        Calls the task with this message
-        :param message: The message
+        Dispatch task for async execution once for each item, publishing in batches where the provider supports them
+
+        .. code:: python
+
+            result = send_push.dispatch_many(user_ids)
+            result = send_email.dispatch_many((user.email, subject) for user in users)
+
+        :param items: arguments for each invocation, as a tuple of arguments or a single argument that isn't a tuple
+        :param chunk_size: number of messages built and published together
+        :param max_in_flight: number of chunks published at once
+        :returns: how many messages were published, and which ones failed
         """
+        return AsyncInvocation(self).dispatch_many(items, chunk_size=chunk_size, max_in_flight=max_in_flight)
+
+    def _call_args(self, message: "Message") -> typing.Tuple[list, dict]:
         args = copy.deepcopy(message.args)
         kwargs = copy.deepcopy(message.kwargs)
         if self.accepts_metadata:
             kwargs["metadata"] = message.metadata
         if self.accepts_headers:
             kwargs["headers"] = copy.deepcopy(message.headers)
-        self.fn(*args, **kwargs)
+        return args, kwargs
+
+    @staticmethod
+    def _batch_items(messages: typing.List["Message"]) -> typing.List[BatchItem]:
+        return [
+            BatchItem(copy.deepcopy(m.args), copy.deepcopy(m.kwargs), m.metadata, copy.deepcopy(m.headers))
+            for m in messages
+        ]
+
+    def call_batch(self, messages: typing.List["Message"]) -> typing.Dict[int, BaseException]:
+        """
+        Calls a batch task with these messages. Coroutine tasks are run to completion on a new event loop.
+        :param messages: The messages
+        :return: exceptions of messages that failed, keyed by index
+        """
+        try:
+            if self.is_async:
+                failures = _run_coroutine(self.fn(self._batch_items(messages)))
+            else:
+                failures = self.fn(self._batch_items(messages))
+        except Exception as e:
+            return {index: e for index in range(len(messages))}
+        return dict(failures or {})
+
+    async def call_batch_async(self, messages: typing.List["Message"]) -> typing.Dict[int, BaseException]:
+        """
+        Same as `call_batch`, but from an event loop. See `call_async`.
+        """
+        try:
+            if self.is_async:
+                failures = await self.fn(self._batch_items(messages))
+            else:
+                failures = await asyncio.to_thread(self.fn, self._batch_items(messages))
+        except Exception as e:
+            return {index: e for index in range(len(messages))}
+        return dict(failures or {})
+
+    def call(self, message: "Message") -> None:
+        """
+        Calls the task with this message. Coroutine tasks are run to completion on a new event loop. Batch tasks are
+        called with a batch of just this message.
+        :param message: The message
+        """
+        if self.batch_size is not None:
+            error = self.call_batch([message]).get(0)
+            if error is not None:
+                raise error
+            return
+        args, kwargs = self._call_args(message)
+        if self.is_async:
+            _run_coroutine(self.fn(*args, **kwargs))
+        else:
+            self.fn(*args, **kwargs)
+
+    async def call_async(self, message: "Message") -> None:
+        """
+        Calls the task with this message from an event loop. Coroutine tasks are awaited, and other tasks are run on
+        the event loop's default executor so they don't block the loop.
+        :param message: The message
+        """
+        if self.batch_size is not None:
+            error = (await self.call_batch_async([message])).get(0)
+            if error is not None:
+                raise error
+            return
+        args, kwargs = self._call_args(message)
+        if self.is_async:
+            await self.fn(*args, **kwargs)
+        else:
+            await asyncio.to_thread(self.fn, *args, **kwargs)
 
     def __str__(self) -> str:
         return f"Taskhawk task: {self.name}"
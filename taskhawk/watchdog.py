@@ -0,0 +1,166 @@
+import logging
+import sys
+import threading
+import time
+import traceback
+import typing
+from contextvars import ContextVar
+from typing import Callable, Dict, List, Optional
+
+from taskhawk.conf import settings
+
+if typing.TYPE_CHECKING:  # pragma: no cover
+    from taskhawk.backends.base import TaskhawkConsumerBaseBackend
+    from taskhawk.lease import Lease
+
+
+logger = logging.getLogger(__name__)
+
+
+def report_timeout(task_name: str, message_id: str, timeout_s: float) -> None:
+    """
+    Calls ``TASKHAWK_TASK_TIMEOUT_HOOK`` for a task that ran past its timeout
+    """
+    try:
+        settings.TASKHAWK_TASK_TIMEOUT_HOOK(task_name=task_name, message_id=message_id, timeout_s=timeout_s)
+    except Exception:
+        logger.exception('Exception in task timeout hook')
+
+
+class Watch:
+    """
+    Tracks a message that's being processed by a thread
+    """
+
+    def __init__(
+        self, consumer_backend: 'TaskhawkConsumerBaseBackend', queue_message, lease: Optional['Lease'] = None
+    ) -> None:
+        self.consumer_backend = consumer_backend
+        self.queue_message = queue_message
+        self.lease = lease
+        self.thread_id = threading.get_ident()
+        self.started_at = time.monotonic()
+        self.task_name: Optional[str] = None
+        self.message_id: Optional[str] = None
+        self.timeout_s: Optional[float] = None
+        self.timed_out = False
+
+    @property
+    def deadline(self) -> Optional[float]:
+        """
+        Time after which the task is considered stuck, or None if its task doesn't have a timeout
+        """
+        if self.timeout_s is None:
+            return None
+        return self.started_at + self.timeout_s
+
+
+_current_watch: ContextVar[Optional[Watch]] = ContextVar('taskhawk_current_watch', default=None)
+
+
+class Watchdog:
+    """
+    Bounds how long tasks run. Threads can't be interrupted, so once a task runs past its timeout, the watchdog logs
+    the stack trace of the thread it's stuck on, reports it to ``TASKHAWK_TASK_TIMEOUT_HOOK``, and nacks the message so
+    another consumer picks it up. The task's outcome is ignored. `on_timeout` is then called with the id of the stuck
+    thread, so that the consumer can replace it.
+    """
+
+    def __init__(self, on_timeout: Optional[Callable[[int], None]] = None) -> None:
+        self._on_timeout = on_timeout
+        self._watches: Dict[int, Watch] = {}
+        self._stopped = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='taskhawk-watchdog', daemon=True)
+
+    def start(self) -> 'Watchdog':
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def watch(self, consumer_backend: 'TaskhawkConsumerBaseBackend', queue_message, lease=None) -> Watch:
+        """
+        Starts tracking a message that's processed by the current thread
+        """
+        watch = Watch(consumer_backend, queue_message, lease)
+        with self._cond:
+            self._watches[id(watch)] = watch
+        return watch
+
+    def set_timeout(self, watch: Watch, task_name: str, message_id: str, timeout_s: float) -> None:
+        """
+        Sets the timeout of a watched message, once its task is known
+        """
+        with self._cond:
+            watch.task_name = task_name
+            watch.message_id = message_id
+            watch.timeout_s = timeout_s
+            self._cond.notify_all()
+
+    def unwatch(self, watch: Watch) -> None:
+        """
+        Stops tracking a message, because it was processed
+        """
+        with self._cond:
+            self._watches.pop(id(watch), None)
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._stopped:
+                    deadlines = [watch.deadline for watch in self._watches.values() if watch.deadline is not None]
+                    timeout = None
+                    if deadlines:
+                        timeout = min(deadlines) - time.monotonic()
+                        if timeout <= 0:
+                            break
+                    self._cond.wait(timeout)
+                if self._stopped:
+                    return
+                expired = self._take_expired()
+            for watch in expired:
+                self._expire(watch)
+
+    def _take_expired(self) -> List[Watch]:
+        now = time.monotonic()
+        expired = []
+        for key, watch in list(self._watches.items()):
+            deadline = watch.deadline
+            if deadline is not None and deadline <= now:
+                watch.timed_out = True
+                del self._watches[key]
+                expired.append(watch)
+        return expired
+
+    def _expire(self, watch: Watch) -> None:
+        frame = sys._current_frames().get(watch.thread_id)
+        logger.error(
+            'Task timed out, releasing its message',
+            extra={
+                'task': watch.task_name,
+                'message_id': watch.message_id,
+                'timeout_s': watch.timeout_s,
+                'stack': ''.join(traceback.format_stack(frame)) if frame is not None else None,
+            },
+        )
+        report_timeout(typing.cast(str, watch.task_name), typing.cast(str, watch.message_id), watch.timeout_s or 0)
+
+        consumer_backend = watch.consumer_backend
+        lease_manager = consumer_backend.lease_manager
+        if watch.lease is not None and lease_manager is not None:
+            # stop extending visibility, so the nack isn't undone
+            lease_manager.release(watch.lease)
+        try:
+            consumer_backend.nack_message(watch.queue_message)
+            consumer_backend.flush()
+        except Exception:
+            logger.exception('Exception while nacking message', extra={'queue_message': watch.queue_message})
+
+        if self._on_timeout is not None:
+            self._on_timeout(watch.thread_id)
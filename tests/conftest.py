@@ -10,7 +10,7 @@ import pytest
 import tests.tasks  # noqa
 import taskhawk.conf
 from taskhawk.backends.base import TaskhawkBaseBackend, TaskhawkPublisherBaseBackend
-from taskhawk.backends.utils import get_publisher_backend, get_consumer_backend
+from taskhawk.backends.utils import get_blob_store, get_publisher_backend, get_consumer_backend
 from taskhawk.models import Priority, Message
 
 
@@ -43,6 +43,7 @@ def settings():
     # since consumer/publisher settings may have changed
     get_publisher_backend.cache_clear()
     get_consumer_backend.cache_clear()
+    get_blob_store.cache_clear()
 
     try:
         yield taskhawk.conf.settings._user_settings
@@ -53,6 +54,7 @@ def settings():
         # since consumer/publisher settings may have changed
         get_publisher_backend.cache_clear()
         get_consumer_backend.cache_clear()
+        get_blob_store.cache_clear()
 
 
 @pytest.fixture(name='message_data')
@@ -3,6 +3,7 @@ from time import time
 from unittest import mock
 
 import arrow
+from google.cloud.pubsub_v1.subscriber.message import Message as StreamingMessage
 from google.pubsub_v1 import ReceivedMessage, PubsubMessage
 
 from taskhawk.models import Message
@@ -18,3 +19,14 @@ def build_gcp_received_message(message: Message) -> ReceivedMessage:
     queue_message.message.publish_time = arrow.utcnow().datetime
     queue_message.delivery_attempt = 1
     return queue_message
+
+
+def build_gcp_streaming_message(message: Message) -> StreamingMessage:
+    queue_message = mock.create_autospec(StreamingMessage, instance=True)
+    queue_message.ack_id = "dummy_ack_id"
+    queue_message.message_id = str(time())
+    queue_message.data = json.dumps(message.as_dict()).encode()
+    queue_message.attributes = message.as_dict()['headers']
+    queue_message.publish_time = arrow.utcnow().datetime
+    queue_message.delivery_attempt = 1
+    return queue_message
@@ -1,4 +1,5 @@
 import logging
+from typing import Dict, List, Optional
 
 import taskhawk
 
@@ -17,3 +18,13 @@ def send_email(
     logging.info(f"Going to send email for request: {headers['request_id']} with id: {metadata.id}")
     _send_email(to, subject, from_email=from_email, headers=headers, metadata=metadata)
     logging.info(f"Sent email to {to}, with subject: {subject}, from: {from_email or 'default@email.com'}")
+
+
+def _index_documents(items: List[taskhawk.BatchItem]) -> Optional[Dict[int, Exception]]:
+    # inner fn to help w mocking
+    return None
+
+
+@taskhawk.task(batch_size=2)
+def index_documents(items: List[taskhawk.BatchItem]) -> Optional[Dict[int, Exception]]:
+    return _index_documents(items)
@@ -0,0 +1,63 @@
+import pytest
+
+from taskhawk.adaptive import AdaptivePullController
+
+
+def _controller(**kwargs):
+    params = dict(num_messages=1, min_messages=1, max_messages=10, min_wait_s=1, max_wait_s=20, visibility_timeout_s=30)
+    params.update(kwargs)
+    return AdaptivePullController(**params)
+
+
+def test_full_batches_grow_batch_size():
+    controller = _controller()
+
+    for expected in (2, 4, 8, 10, 10):
+        controller.record(controller.batch_size, controller.batch_size, 0.01)
+        assert controller.batch_size == expected
+
+
+def test_partial_batches_shrink_batch_size():
+    controller = _controller(num_messages=10)
+
+    controller.record(10, 3, 0.01)
+    assert controller.batch_size == 9
+
+    controller = _controller(num_messages=1)
+    controller.record(1, 0, 0)
+    assert controller.batch_size == 1
+
+
+def test_batch_size_fits_in_visibility_timeout():
+    controller = _controller(num_messages=10)
+
+    # 2 seconds per message means only 7 messages can be processed in half the visibility timeout
+    controller.record(10, 10, 20)
+    assert controller.batch_size == 7
+
+    controller.record(7, 7, 14)
+    assert controller.batch_size == 7
+    assert controller.message_duration_s == pytest.approx(2)
+
+
+def test_wait_time_follows_empty_rate():
+    controller = _controller(max_wait_s=20, min_wait_s=2)
+    assert controller.wait_time_s == 20
+
+    for _ in range(20):
+        controller.record(1, 1, 0.01)
+    assert controller.wait_time_s == 2
+    assert controller.empty_rate < 0.1
+
+    for _ in range(20):
+        controller.record(1, 0, 0)
+    assert controller.wait_time_s == 20
+
+
+def test_invalid_bounds():
+    with pytest.raises(ValueError):
+        _controller(min_messages=0)
+    with pytest.raises(ValueError):
+        _controller(min_messages=11)
+    with pytest.raises(ValueError):
+        _controller(min_wait_s=30)
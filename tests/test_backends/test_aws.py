@@ -1,4 +1,5 @@
 import json
+import threading
 from unittest import mock
 
 import funcy
@@ -10,8 +11,10 @@ try:
 except ImportError:
     pass
 from taskhawk.backends.exceptions import PartialFailure
+from taskhawk.compression import compress_payload, decompress_payload
 from taskhawk.conf import settings
 from taskhawk.models import Priority, Message
+from taskhawk.retry import Backoff
 
 aws = pytest.importorskip('taskhawk.backends.aws')
 
@@ -56,6 +59,41 @@ class TestSNSPublisher:
             MessageAttributes={k: {'DataType': 'String', 'StringValue': str(v)} for k, v in message.headers.items()},
         )
 
+    def test_publish_compressed(self, mock_boto3, message, settings):
+        settings.TASKHAWK_COMPRESSION = {'algorithm': 'zlib', 'min_bytes': 0}
+        message.kwargs['body'] = 'Hello! ' * 1000
+        sns_publisher = aws.AWSSNSPublisherBackend(priority=message.priority)
+
+        sns_publisher.publish(message)
+
+        kwargs = sns_publisher.sns_client.publish.call_args[1]
+        assert kwargs['MessageAttributes']['taskhawk-encoding'] == {'DataType': 'String', 'StringValue': 'zlib'}
+        assert len(kwargs['Message']) < 1000
+        assert decompress_payload(kwargs['Message'], {'taskhawk-encoding': 'zlib'}) == sns_publisher.message_payload(
+            message.as_dict()
+        )
+
+    def test_publish_many(self, mock_boto3, message, message_data):
+        sns_publisher = aws.AWSSNSPublisherBackend(priority=message.priority)
+        sns_publisher.sns_client.publish_batch.side_effect = lambda TopicArn, PublishBatchRequestEntries: {
+            'Successful': [
+                {'Id': entry['Id'], 'MessageId': f'id-{entry["Id"]}'} for entry in PublishBatchRequestEntries
+            ]
+        }
+        messages = [Message({**message_data, 'id': str(i)}) for i in range(12)]
+        # can't be serialized
+        messages[1] = Message({**message_data, 'args': [object()]})
+
+        futures = sns_publisher.publish_many(messages)
+
+        assert isinstance(futures[1].exception(), TypeError)
+        assert [future.result() for i, future in enumerate(futures) if i != 1] == [f'id-{i}' for i in range(10)] + [
+            'id-0'
+        ]
+        assert [
+            len(call[1]['PublishBatchRequestEntries']) for call in sns_publisher.sns_client.publish_batch.call_args_list
+        ] == [10, 1]
+
     @mock.patch('tests.tasks._send_email', autospec=True)
     def test_sync_mode(self, mock_send_email, mock_boto3, message, settings):
         settings.TASKHAWK_PUBLISHER_BACKEND = 'taskhawk.backends.aws.AWSSNSPublisherBackend'
@@ -71,6 +109,146 @@ class TestSNSPublisher:
         assert mock_send_email.call_args[1]['headers'] == message.headers
         assert mock_send_email.call_args[1]['metadata'] == message.metadata
 
+    @mock.patch('tests.tasks._send_email', autospec=True)
+    def test_sync_mode_with_retry_policy(self, mock_send_email, mock_boto3, message, settings):
+        settings.TASKHAWK_PUBLISHER_BACKEND = 'taskhawk.backends.aws.AWSSNSPublisherBackend'
+        settings.TASKHAWK_CONSUMER_BACKEND = 'taskhawk.backends.aws.AWSSQSConsumerBackend'
+        settings.TASKHAWK_SYNC = True
+        settings.TASKHAWK_CONSUMER_MAX_ATTEMPTS = 1
+        mock_send_email.side_effect = ValueError('fail')
+        message.task._retry = Backoff(base=2, max=3600, jitter=False)
+        publisher = aws.AWSSNSPublisherBackend(priority=message.priority)
+        try:
+            # the task's exception is raised, rather than the message being retried or dead-lettered
+            with pytest.raises(ValueError):
+                publisher.publish(message)
+        finally:
+            message.task._retry = None
+
+        mock_send_email.assert_called_once()
+
+
+class TestSNSAsyncPublisher:
+    def test_publish(self, mock_boto3, message):
+        publisher = aws.AWSSNSAsyncPublisherBackend(priority=message.priority)
+        publisher.sns_client.publish.return_value = {'PublishResponse': {'PublishResult': {'MessageId': 'id'}}}
+
+        future = publisher.publish(message)
+
+        assert future.result(timeout=1) == 'id'
+        publisher.sns_client.publish.assert_called_once_with(
+            TopicArn=publisher.topic_name,
+            Message=publisher.message_payload(message.as_dict()),
+            MessageAttributes={k: {'DataType': 'String', 'StringValue': str(v)} for k, v in message.headers.items()},
+        )
+
+    def test_blocks_while_queue_is_full(self, mock_boto3, message, settings):
+        settings.AWS_SNS_ASYNC_PUBLISH_MAX_WORKERS = 1
+        settings.AWS_SNS_ASYNC_PUBLISH_MAX_PENDING = 0
+        publisher = aws.AWSSNSAsyncPublisherBackend(priority=message.priority)
+        unblock = threading.Event()
+        publisher.sns_client.publish.side_effect = lambda **_: unblock.wait(1) and {
+            'PublishResponse': {'PublishResult': {'MessageId': 'id'}}
+        }
+        publisher.publish(message)
+        published = threading.Event()
+
+        thread = threading.Thread(target=lambda: publisher.publish(message) and published.set())
+        thread.start()
+        assert not published.wait(0.1)
+
+        unblock.set()
+        thread.join(timeout=1)
+        assert published.is_set()
+        publisher.flush()
+        assert publisher.sns_client.publish.call_count == 2
+
+
+class TestSNSBatchPublisher:
+    @pytest.fixture
+    def publisher(self, mock_boto3, settings):
+        # batches are only sent by flush
+        settings.AWS_SNS_PUBLISH_BATCH_MAX_LATENCY_S = 60
+        return aws.AWSSNSBatchPublisherBackend(priority=Priority.default)
+
+    def test_publish(self, publisher, message):
+        publisher.sns_client.publish_batch.return_value = {
+            'Successful': [{'Id': '0', 'MessageId': 'id-0'}, {'Id': '1', 'MessageId': 'id-1'}],
+            'Failed': [],
+        }
+
+        futures = [publisher.publish(message), publisher.publish(message)]
+        publisher.flush()
+
+        assert [future.result(timeout=1) for future in futures] == ['id-0', 'id-1']
+        entry = {
+            'Message': publisher.message_payload(message.as_dict()),
+            'MessageAttributes': {k: {'DataType': 'String', 'StringValue': str(v)} for k, v in message.headers.items()},
+        }
+        publisher.sns_client.publish_batch.assert_called_once_with(
+            TopicArn=publisher.topic_name,
+            PublishBatchRequestEntries=[{'Id': '0', **entry}, {'Id': '1', **entry}],
+        )
+
+    def test_partial_failure(self, publisher, message):
+        publisher.sns_client.publish_batch.return_value = {
+            'Successful': [],
+            'Failed': [
+                {'Id': '0', 'Code': 'InternalError', 'SenderFault': False},
+                {'Id': '1', 'Code': 'InvalidParameter', 'SenderFault': True},
+            ],
+        }
+        publisher.sns_client.publish.return_value = {'MessageId': 'id-0'}
+
+        futures = [publisher.publish(message), publisher.publish(message)]
+        publisher.flush()
+
+        # only entries that failed on the server's side are retried
+        assert futures[0].result(timeout=1) == 'id-0'
+        publisher.sns_client.publish.assert_called_once()
+        with pytest.raises(PartialFailure):
+            futures[1].result(timeout=1)
+
+    def test_splits_large_batches(self, publisher, message):
+        publisher.sns_client.publish_batch.side_effect = lambda TopicArn, PublishBatchRequestEntries: {
+            'Successful': [{'Id': entry['Id'], 'MessageId': 'id'} for entry in PublishBatchRequestEntries]
+        }
+        message.kwargs['body'] = 'x' * 100 * 1024
+
+        futures = [publisher.publish(message) for _ in range(3)]
+        publisher.flush()
+
+        assert [future.result(timeout=1) for future in futures] == ['id', 'id', 'id']
+        assert [
+            len(call[1]['PublishBatchRequestEntries']) for call in publisher.sns_client.publish_batch.call_args_list
+        ] == [2, 1]
+
+    def test_retries_batch_request(self, publisher, message):
+        publisher.sns_client.publish_batch.side_effect = [
+            Exception("oops"),
+            {'Successful': [{'Id': '0', 'MessageId': 'id-0'}], 'Failed': []},
+        ]
+
+        future = publisher.publish(message)
+        publisher.flush()
+
+        assert future.result(timeout=1) == 'id-0'
+        assert publisher.sns_client.publish_batch.call_count == 2
+        publisher.sns_client.publish.assert_not_called()
+
+    @mock.patch('taskhawk.backends.aws.atexit', autospec=True)
+    def test_flushes_at_exit(self, mock_atexit, mock_boto3, settings, message):
+        settings.AWS_SNS_PUBLISH_BATCH_MAX_LATENCY_S = 60
+        publisher = aws.AWSSNSBatchPublisherBackend(priority=Priority.default)
+        mock_atexit.register.assert_called_once_with(publisher.flush)
+        publisher.sns_client.publish_batch.return_value = {'Successful': [{'Id': '0', 'MessageId': 'id-0'}]}
+
+        future = publisher.publish(message)
+        publisher.close()
+
+        assert future.result(timeout=1) == 'id-0'
+        mock_atexit.unregister.assert_called_once_with(publisher.flush)
+
 
 pre_process_hook = mock.MagicMock()
 post_process_hook = mock.MagicMock()
@@ -123,6 +301,18 @@ class TestSQSConsumer:
             endpoint_url=settings.AWS_ENDPOINT_SQS,
         )
 
+    def test_resource_per_thread(self, mock_boto3, consumer):
+        mock_boto3.resource.side_effect = lambda *args, **kwargs: mock.MagicMock()
+        resources = []
+
+        thread = threading.Thread(target=lambda: resources.append(consumer.sqs_resource))
+        thread.start()
+        thread.join()
+
+        assert consumer.sqs_resource is consumer.sqs_resource
+        assert consumer.sqs_resource is not resources[0]
+        assert mock_boto3.resource.call_count == 2
+
     def test_pull_messages(self, mock_boto3, consumer):
         num_messages = 1
         visibility_timeout = 10
@@ -135,10 +325,24 @@ class TestSQSConsumer:
         queue.receive_messages.assert_called_once_with(
             MaxNumberOfMessages=1,
             MessageAttributeNames=['All'],
+            AttributeNames=['ApproximateReceiveCount'],
             VisibilityTimeout=visibility_timeout,
             WaitTimeSeconds=consumer.WAIT_TIME_SECONDS,
         )
 
+    def test_pull_messages_with_wait_time(self, mock_boto3, consumer):
+        queue = mock.MagicMock()
+        consumer.sqs_resource.get_queue_by_name = mock.MagicMock(return_value=queue)
+
+        consumer.pull_messages(10, wait_time_s=2)
+
+        queue.receive_messages.assert_called_once_with(
+            MaxNumberOfMessages=10,
+            MessageAttributeNames=['All'],
+            AttributeNames=['ApproximateReceiveCount'],
+            WaitTimeSeconds=2,
+        )
+
     def test_extend_visibility_timeout_with_metadata(self, mock_boto3, consumer):
         visibility_timeout_s = 10
         receipt = "receipt"
@@ -179,6 +383,99 @@ class TestSQSConsumer:
         consumer.sqs_client.get_queue_url.assert_not_called()
         consumer.sqs_client.change_message_visibility.assert_not_called()
 
+    def test_queue_url_cached(self, mock_boto3, consumer):
+        consumer.sqs_client.get_queue_url = mock.MagicMock(return_value={"QueueUrl": "DummyQueueUrl"})
+
+        assert consumer.queue_url == 'DummyQueueUrl'
+        assert consumer.queue_url == 'DummyQueueUrl'
+
+        consumer.sqs_client.get_queue_url.assert_called_once_with(QueueName=consumer.queue_name)
+
+    def test_batched_delete_and_nack(self, mock_boto3, settings):
+        settings.AWS_SQS_ACK_BATCH_MAX_MESSAGES = 10
+        settings.AWS_SQS_ACK_BATCH_MAX_LATENCY_S = 60
+        consumer = aws.AWSSQSConsumerBackend(priority=Priority.default)
+        consumer.sqs_client.get_queue_url = mock.MagicMock(return_value={"QueueUrl": "DummyQueueUrl"})
+        consumer.sqs_client.delete_message_batch.return_value = {'Successful': [], 'Failed': []}
+        consumer.sqs_client.change_message_visibility_batch.return_value = {'Successful': [], 'Failed': []}
+        queue_messages = [mock.MagicMock(receipt_handle=f'receipt-{i}') for i in range(3)]
+
+        consumer.delete_message(queue_messages[0])
+        consumer.delete_message(queue_messages[1])
+        consumer.nack_message(queue_messages[2])
+        consumer.flush()
+
+        consumer.sqs_client.delete_message_batch.assert_called_once_with(
+            QueueUrl='DummyQueueUrl',
+            Entries=[{'Id': '0', 'ReceiptHandle': 'receipt-0'}, {'Id': '1', 'ReceiptHandle': 'receipt-1'}],
+        )
+        consumer.sqs_client.change_message_visibility_batch.assert_called_once_with(
+            QueueUrl='DummyQueueUrl', Entries=[{'Id': '0', 'ReceiptHandle': 'receipt-2', 'VisibilityTimeout': 0}]
+        )
+        for queue_message in queue_messages:
+            queue_message.delete.assert_not_called()
+            queue_message.change_visibility.assert_not_called()
+
+    def test_batched_delete_retries_failed_entries(self, mock_boto3, settings):
+        settings.AWS_SQS_ACK_BATCH_MAX_MESSAGES = 10
+        consumer = aws.AWSSQSConsumerBackend(priority=Priority.default)
+        consumer.sqs_client.get_queue_url = mock.MagicMock(return_value={"QueueUrl": "DummyQueueUrl"})
+        consumer.sqs_client.delete_message_batch.return_value = {
+            'Successful': [{'Id': '0'}],
+            'Failed': [{'Id': '1', 'Code': 'InternalError', 'SenderFault': False}],
+        }
+        consumer.sqs_client.delete_message.side_effect = RuntimeError('fail')
+
+        failures = consumer._delete_messages(['receipt-0', 'receipt-1'])
+
+        consumer.sqs_client.delete_message.assert_called_once_with(QueueUrl='DummyQueueUrl', ReceiptHandle='receipt-1')
+        assert list(failures) == [1]
+
+    def test_extend_visibility_timeouts(self, mock_boto3, consumer):
+        consumer.sqs_client.get_queue_url = mock.MagicMock(return_value={"QueueUrl": "DummyQueueUrl"})
+        consumer.sqs_client.change_message_visibility_batch.return_value = {'Successful': [], 'Failed': []}
+        queue_messages = [mock.MagicMock(receipt_handle=f'receipt-{i}') for i in range(12)]
+
+        failures = consumer.extend_visibility_timeouts(queue_messages, 30)
+
+        assert failures == {}
+        assert consumer.sqs_client.change_message_visibility_batch.call_count == 2
+        consumer.sqs_client.change_message_visibility_batch.assert_called_with(
+            QueueUrl='DummyQueueUrl',
+            Entries=[
+                {'Id': '0', 'ReceiptHandle': 'receipt-10', 'VisibilityTimeout': 30},
+                {'Id': '1', 'ReceiptHandle': 'receipt-11', 'VisibilityTimeout': 30},
+            ],
+        )
+
+    def test_extend_visibility_timeouts_failure(self, mock_boto3, consumer):
+        consumer.sqs_client.get_queue_url = mock.MagicMock(return_value={"QueueUrl": "DummyQueueUrl"})
+        error = RuntimeError('fail')
+        consumer.sqs_client.change_message_visibility_batch.side_effect = [
+            {'Successful': [], 'Failed': []},
+            error,
+        ]
+        queue_messages = [mock.MagicMock(receipt_handle=f'receipt-{i}') for i in range(11)]
+
+        assert consumer.extend_visibility_timeouts(queue_messages, 30) == {10: error}
+
+    def test_fetch_and_process_messages_batched_delete(self, mock_boto3, settings, message_data):
+        settings.AWS_SQS_ACK_BATCH_MAX_MESSAGES = 10
+        settings.AWS_SQS_ACK_BATCH_MAX_LATENCY_S = 60
+        consumer = aws.AWSSQSConsumerBackend(priority=Priority.default)
+        consumer.sqs_client.get_queue_url = mock.MagicMock(return_value={"QueueUrl": "DummyQueueUrl"})
+        consumer.sqs_client.delete_message_batch.return_value = {'Successful': [], 'Failed': []}
+        queue_messages = [mock.MagicMock(receipt_handle=f'receipt-{i}') for i in range(3)]
+        consumer.pull_messages = mock.MagicMock(return_value=queue_messages)
+        consumer.process_message = mock.MagicMock()
+
+        consumer.fetch_and_process_messages(num_messages=10)
+
+        consumer.sqs_client.delete_message_batch.assert_called_once_with(
+            QueueUrl='DummyQueueUrl',
+            Entries=[{'Id': str(i), 'ReceiptHandle': f'receipt-{i}'} for i in range(3)],
+        )
+
     def test_success_requeue_dead_letter(self, mock_boto3):
         consumer = aws.AWSSQSConsumerBackend(priority=Priority.default, dlq=True)
         num_messages = 3
@@ -238,6 +535,37 @@ class TestSQSConsumer:
         with pytest.raises(PartialFailure):
             consumer.requeue_dead_letter(num_messages=num_messages, visibility_timeout=visibility_timeout)
 
+    def test_delivery_attempt(self, mock_boto3, consumer):
+        queue_message = mock.MagicMock()
+        queue_message.attributes = {'ApproximateReceiveCount': '3'}
+
+        _, metadata = consumer._decode_queue_message(queue_message)
+
+        assert metadata.receive_count == 3
+        assert consumer.delivery_attempt(metadata) == 3
+
+    def test_decode_compressed(self, mock_boto3, consumer, message_data):
+        message_json = json.dumps({**message_data, 'kwargs': {'body': 'Hello! ' * 100}})
+        queue_message = mock.MagicMock()
+        queue_message.attributes = {}
+        queue_message.body, encoding = compress_payload(message_json, {'min_bytes': 0})
+        assert encoding is not None
+        queue_message.message_attributes = {'taskhawk-encoding': {'DataType': 'String', 'StringValue': encoding}}
+
+        assert consumer._decode_queue_message(queue_message)[0] == message_json
+
+    def test_send_to_dead_letter(self, mock_boto3, consumer):
+        consumer.sqs_client.get_queue_url.return_value = {'QueueUrl': 'dlq-url'}
+
+        consumer.send_to_dead_letter('{"id": "1"}', {'request_id': '2'})
+
+        consumer.sqs_client.get_queue_url.assert_called_once_with(QueueName='TASKHAWK-DEV-RTEP-DLQ')
+        consumer.sqs_client.send_message.assert_called_once_with(
+            QueueUrl='dlq-url',
+            MessageBody='{"id": "1"}',
+            MessageAttributes={'request_id': {'DataType': 'String', 'StringValue': '2'}},
+        )
+
     def test_fetch_and_process_messages_success(self, mock_boto3, settings, message_data, consumer, reset_mocks):
         settings.TASKHAWK_PRE_PROCESS_HOOK = 'tests.test_backends.test_aws.pre_process_hook'
         settings.TASKHAWK_POST_PROCESS_HOOK = 'tests.test_backends.test_aws.post_process_hook'
@@ -251,6 +579,9 @@ class TestSQSConsumer:
         queue_message.receipt_handle = "dummy receipt"
         queue.receive_messages = mock.MagicMock(return_value=[queue_message])
         message_mock = mock.MagicMock()
+        message_mock.task.limiter = None
+        message_mock.task.max_attempts = None
+        message_mock.claim_check = None
         consumer._build_message = mock.MagicMock(return_value=message_mock)
         consumer.process_message = mock.MagicMock(wraps=consumer.process_message)
         consumer.message_handler = mock.MagicMock(wraps=consumer.message_handler)
@@ -261,6 +592,7 @@ class TestSQSConsumer:
         queue.receive_messages.assert_called_once_with(
             MaxNumberOfMessages=num_messages,
             MessageAttributeNames=['All'],
+            AttributeNames=['ApproximateReceiveCount'],
             VisibilityTimeout=visibility_timeout,
             WaitTimeSeconds=consumer.WAIT_TIME_SECONDS,
         )
@@ -297,3 +629,18 @@ class TestSNSConsumer:
             pre_process_hook.assert_called_once_with(sns_record=sns_record)
             post_process_hook.assert_called_once_with(sns_record=sns_record)
             call_task_mock.assert_called_once_with()
+
+
+class TestS3BlobStore:
+    def test_put_get_delete(self):
+        store = aws.S3BlobStore('taskhawk-blobs', prefix='taskhawk/')
+        store._s3_client = mock.MagicMock()
+        store._s3_client.get_object.return_value = {'Body': mock.MagicMock(read=mock.MagicMock(return_value=b'data'))}
+
+        store.put('key', b'data')
+        assert store.get('key') == b'data'
+        store.delete('key')
+
+        store._s3_client.put_object.assert_called_once_with(Bucket='taskhawk-blobs', Key='taskhawk/key', Body=b'data')
+        store._s3_client.get_object.assert_called_once_with(Bucket='taskhawk-blobs', Key='taskhawk/key')
+        store._s3_client.delete_object.assert_called_once_with(Bucket='taskhawk-blobs', Key='taskhawk/key')
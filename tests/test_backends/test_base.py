@@ -1,5 +1,9 @@
+import asyncio
 import json
 import math
+import threading
+import time
+from concurrent.futures import Future
 from decimal import Decimal
 from unittest import mock
 
@@ -7,9 +11,20 @@ import pytest
 
 from taskhawk.backends.base import TaskhawkBaseBackend, TaskhawkConsumerBaseBackend, TaskhawkPublisherBaseBackend
 from taskhawk.models import Message, ValidationError, Priority
-from taskhawk.exceptions import LoggingException, RetryException, IgnoreException
+from taskhawk.exceptions import ConfigurationError, LoggingException, RetryException, IgnoreException, TaskTimeout
 from taskhawk.backends import base
 from taskhawk.backends.utils import get_consumer_backend, get_publisher_backend
+from taskhawk.backpressure import Backpressure
+from taskhawk.batches import TaskBatches
+from taskhawk.circuit import CircuitBreakers
+from taskhawk.claim_check import CLAIM_CHECK_VERSION
+from taskhawk.concurrency import BoundedExecutor
+from taskhawk.dedup import MemoryDedupCache
+from taskhawk.drain import Drain
+from taskhawk.lease import Lease, LeaseManager, _current_lease, current_lease
+from taskhawk.limits import TaskLimiter
+from taskhawk.retry import ATTEMPT_HEADER, RETRY_AT_HEADER, Backoff
+from taskhawk.watchdog import Watchdog
 
 
 class MockBackend(TaskhawkConsumerBaseBackend, TaskhawkPublisherBaseBackend):
@@ -64,9 +79,219 @@ class TestMessageHandler:
         with pytest.raises(mock_call_task.side_effect):
             consumer_backend.message_handler(json.dumps(message_data), None)
 
+    def test_skips_duplicate(self, mock_call_task, message_data, message, consumer_backend):
+        consumer_backend.dedup_cache = MemoryDedupCache()
+        try:
+            consumer_backend.message_handler(json.dumps(message_data), None)
+            consumer_backend.message_handler(json.dumps(message_data), None)
+        finally:
+            consumer_backend.dedup_cache = None
+
+        mock_call_task.assert_called_once_with(message)
+
+    def test_dedup_ignores_failed_messages(self, mock_call_task, message_data, message, consumer_backend):
+        mock_call_task.side_effect = Exception
+        consumer_backend.dedup_cache = MemoryDedupCache()
+        try:
+            for _ in range(2):
+                with pytest.raises(Exception):
+                    consumer_backend.message_handler(json.dumps(message_data), None)
+        finally:
+            consumer_backend.dedup_cache = None
+
+        assert mock_call_task.call_count == 2
+
+    def test_defers_while_circuit_is_open(self, mock_call_task, message_data, message, consumer_backend):
+        mock_call_task.side_effect = Exception
+        consumer_backend.circuit_breakers = CircuitBreakers({'min_calls': 2, 'open_s': 30})
+        try:
+            for _ in range(2):
+                with pytest.raises(Exception):
+                    consumer_backend.message_handler(json.dumps(message_data), None)
+
+            with pytest.raises(RetryException) as exc:
+                consumer_backend.message_handler(json.dumps(message_data), None)
+        finally:
+            consumer_backend.circuit_breakers = None
+
+        assert exc.value.delay_seconds == 30
+        assert mock_call_task.call_count == 2
+
+    def test_deferral_is_capped_at_max_visibility(self, mock_call_task, message_data, consumer_backend):
+        mock_call_task.side_effect = Exception
+        consumer_backend.circuit_breakers = CircuitBreakers({'min_calls': 1, 'open_s': 3600})
+        consumer_backend.MAX_VISIBILITY_TIMEOUT_S = 600
+        try:
+            with pytest.raises(Exception):
+                consumer_backend.message_handler(json.dumps(message_data), None)
+
+            with pytest.raises(RetryException) as exc:
+                consumer_backend.message_handler(json.dumps(message_data), None)
+        finally:
+            consumer_backend.circuit_breakers = None
+            del consumer_backend.MAX_VISIBILITY_TIMEOUT_S
+
+        assert exc.value.delay_seconds == 600
+
+    def test_backs_off(self, mock_call_task, message_data, message, consumer_backend):
+        mock_call_task.side_effect = Exception
+        message.task._retry = Backoff(base=2, max=3600, jitter=False)
+        consumer_backend.delivery_attempt = mock.MagicMock(return_value=3)
+        try:
+            with pytest.raises(RetryException) as exc:
+                consumer_backend.message_handler(json.dumps(message_data), None)
+        finally:
+            message.task._retry = None
+
+        assert exc.value.delay_seconds == 8
+        consumer_backend.delivery_attempt.assert_called_once_with(None)
+
+    @mock.patch('taskhawk.publisher.publish', autospec=True)
+    def test_republishes_long_retry(self, mock_publish, mock_call_task, message_data, message, consumer_backend):
+        mock_call_task.side_effect = Exception
+        message.task._retry = Backoff(base=2, max=3600, jitter=False)
+        consumer_backend.delivery_attempt = mock.MagicMock(return_value=3)
+        consumer_backend.MAX_VISIBILITY_TIMEOUT_S = 5
+        try:
+            with pytest.raises(IgnoreException):
+                consumer_backend.message_handler(json.dumps(message_data), None)
+        finally:
+            message.task._retry = None
+            del consumer_backend.MAX_VISIBILITY_TIMEOUT_S
+
+        mock_publish.assert_called_once()
+        retry_message = mock_publish.call_args[0][0]
+        assert retry_message.id == message.id
+        assert list(retry_message.args) == message.args
+        assert retry_message.headers[ATTEMPT_HEADER] == '3'
+        assert int(retry_message.headers[RETRY_AT_HEADER]) > time.time() * 1000
+
+    @mock.patch('taskhawk.publisher.publish', autospec=True)
+    def test_defers_until_due(self, mock_publish, mock_call_task, message_data, consumer_backend):
+        message_data['headers'][RETRY_AT_HEADER] = str(int((time.time() + 300) * 1000))
+        consumer_backend.MAX_VISIBILITY_TIMEOUT_S = 600
+        try:
+            with pytest.raises(RetryException) as exc:
+                consumer_backend.message_handler(json.dumps(message_data), None)
+            assert 299 <= exc.value.delay_seconds <= 300
+
+            # further away than visibility can be extended, so it's re-published again
+            message_data['headers'][RETRY_AT_HEADER] = str(int((time.time() + 3600) * 1000))
+            with pytest.raises(IgnoreException):
+                consumer_backend.message_handler(json.dumps(message_data), None)
+        finally:
+            del consumer_backend.MAX_VISIBILITY_TIMEOUT_S
+
+        mock_publish.assert_called_once()
+        assert mock_publish.call_args[0][0].headers == message_data['headers']
+        mock_call_task.assert_not_called()
+
+        message_data['headers'][RETRY_AT_HEADER] = str(int((time.time() - 1) * 1000))
+        consumer_backend.message_handler(json.dumps(message_data), None)
+        mock_call_task.assert_called_once()
+
+    def test_dead_letters_last_attempt(self, mock_call_task, message_data, message, consumer_backend):
+        mock_call_task.side_effect = Exception
+        message_data['headers'][ATTEMPT_HEADER] = '2'
+        message_data['headers'][RETRY_AT_HEADER] = str(int((time.time() - 1) * 1000))
+        consumer_backend.delivery_attempt = mock.MagicMock(return_value=2)
+        consumer_backend.send_to_dead_letter = mock.MagicMock()
+        message.task._max_attempts = 3
+        try:
+            with pytest.raises(IgnoreException):
+                consumer_backend.message_handler(json.dumps(message_data), None)
+        finally:
+            message.task._max_attempts = None
+
+        mock_call_task.assert_called_once()
+        consumer_backend.send_to_dead_letter.assert_called_once()
+        payload, headers = consumer_backend.send_to_dead_letter.call_args[0]
+        assert headers == {'request_id': message_data['headers']['request_id']}
+        assert json.loads(payload) == {**message_data, 'headers': headers}
+
+    def test_dead_letters_exhausted_message(self, mock_call_task, message_data, consumer_backend, settings):
+        settings.TASKHAWK_CONSUMER_MAX_ATTEMPTS = 3
+        consumer_backend.delivery_attempt = mock.MagicMock(return_value=4)
+        consumer_backend.send_to_dead_letter = mock.MagicMock()
+
+        with pytest.raises(IgnoreException):
+            consumer_backend.message_handler(json.dumps(message_data), None)
+
+        mock_call_task.assert_not_called()
+        consumer_backend.send_to_dead_letter.assert_called_once()
+
+    @mock.patch('taskhawk.publisher.publish', autospec=True)
+    def test_deferral_isnt_an_attempt(
+        self, mock_publish, mock_call_task, message_data, message, consumer_backend, settings
+    ):
+        settings.TASKHAWK_CONSUMER_MAX_ATTEMPTS = 3
+        consumer_backend.delivery_attempt = mock.MagicMock(return_value=3)
+        consumer_backend.send_to_dead_letter = mock.MagicMock()
+        limiter = TaskLimiter(max_concurrency=1)
+        message.task._limiter = limiter
+        try:
+            assert limiter.acquire() is None
+            with pytest.raises(IgnoreException):
+                consumer_backend.message_handler(json.dumps(message_data), None)
+        finally:
+            message.task._limiter = None
+
+        mock_call_task.assert_not_called()
+        consumer_backend.send_to_dead_letter.assert_not_called()
+        # re-published, so that the provider's delivery count starts over, with the two attempts that did run
+        mock_publish.assert_called_once()
+        headers = mock_publish.call_args[0][0].headers
+        assert headers[ATTEMPT_HEADER] == '2'
+        assert int(headers[RETRY_AT_HEADER]) > time.time() * 1000
+
+    def test_no_dead_letter_for_sync_dispatch(self, mock_call_task, message_data, consumer_backend, settings):
+        mock_call_task.side_effect = ValueError
+        settings.TASKHAWK_CONSUMER_MAX_ATTEMPTS = 1
+        consumer_backend.delivery_attempt = mock.MagicMock(return_value=5)
+        consumer_backend.send_to_dead_letter = mock.MagicMock()
+
+        token = base._sync_dispatch.set(True)
+        try:
+            with pytest.raises(ValueError):
+                consumer_backend.message_handler(json.dumps(message_data), None)
+        finally:
+            base._sync_dispatch.reset(token)
+
+        mock_call_task.assert_called_once()
+        consumer_backend.send_to_dead_letter.assert_not_called()
+
+    def test_retries_if_dead_letter_fails(self, mock_call_task, message_data, consumer_backend, settings):
+        mock_call_task.side_effect = Exception
+        settings.TASKHAWK_CONSUMER_MAX_ATTEMPTS = 1
+        consumer_backend.send_to_dead_letter = mock.MagicMock(side_effect=NotImplementedError)
+
+        with pytest.raises(RetryException):
+            consumer_backend.message_handler(json.dumps(message_data), None)
+
+        consumer_backend.send_to_dead_letter.assert_called_once()
+
+    def test_defers_over_limit(self, mock_call_task, message_data, message, consumer_backend):
+        limiter = TaskLimiter(max_concurrency=1)
+        message.task._limiter = limiter
+        try:
+            assert limiter.acquire() is None
+            with pytest.raises(RetryException) as exc:
+                consumer_backend.message_handler(json.dumps(message_data), None)
+            assert exc.value.delay_seconds == 1
+            mock_call_task.assert_not_called()
+
+            limiter.release()
+            consumer_backend.message_handler(json.dumps(message_data), None)
+            mock_call_task.assert_called_once_with(message)
+            # slot is released once the task is done
+            assert limiter.acquire() is None
+        finally:
+            message.task._limiter = None
+
 
 pre_process_hook = mock.MagicMock()
 post_process_hook = mock.MagicMock()
+timeout_hook = mock.MagicMock()
 
 
 class TestFetchAndProcessMessages:
@@ -89,6 +314,118 @@ class TestFetchAndProcessMessages:
             [mock.call(x) for x in consumer_backend.pull_messages.return_value]
         )
 
+    def test_success_with_executor(self, consumer_backend):
+        queue_messages = [mock.MagicMock(), mock.MagicMock()]
+        consumer_backend.pull_messages = mock.MagicMock(return_value=queue_messages)
+        consumer_backend.process_message = mock.MagicMock()
+        consumer_backend.delete_message = mock.MagicMock()
+        executor = BoundedExecutor(2)
+
+        consumer_backend.fetch_and_process_messages(10, 4, executor=executor)
+        executor.shutdown()
+
+        # only as many messages as there are free slots are pulled
+        consumer_backend.pull_messages.assert_called_once_with(2, 4)
+        consumer_backend.process_message.assert_has_calls([mock.call(x) for x in queue_messages], any_order=True)
+        consumer_backend.delete_message.assert_has_calls([mock.call(x) for x in queue_messages], any_order=True)
+
+    def test_success_with_backpressure(self, consumer_backend):
+        backpressure = Backpressure(max_bytes=100)
+        backpressure.acquire(mock.MagicMock(), 60)
+        queue_message = mock.MagicMock()
+        consumer_backend.pull_messages = mock.MagicMock(return_value=[queue_message])
+        consumer_backend.message_size = mock.MagicMock(return_value=20)
+        consumer_backend.process_message = mock.MagicMock(
+            side_effect=lambda _: bytes_in_flight.append(backpressure.bytes_in_flight)
+        )
+        consumer_backend.delete_message = mock.MagicMock()
+        bytes_in_flight = []
+
+        with mock.patch('taskhawk.backends.base.BACKPRESSURE_WAIT_S', 0.01):
+            consumer_backend.fetch_and_process_messages(10, 4, backpressure=backpressure)
+
+        # 40 bytes left at 60 bytes per message
+        consumer_backend.pull_messages.assert_not_called()
+
+        backpressure = Backpressure(max_bytes=100)
+        consumer_backend.fetch_and_process_messages(10, 4, backpressure=backpressure)
+
+        consumer_backend.pull_messages.assert_called_once_with(10, 4)
+        assert bytes_in_flight == [20]
+        assert backpressure.bytes_in_flight == 0
+
+    @mock.patch('tests.tasks._index_documents', autospec=True)
+    def test_batch_task(self, mock_index_documents, consumer_backend, message_data):
+        mock_index_documents.return_value = {1: RetryException(delay_seconds=60)}
+        queue_messages = [mock.MagicMock(), mock.MagicMock()]
+        payloads = {
+            id(queue_message): json.dumps({**message_data, 'task': 'tests.tasks.index_documents', 'args': [i]})
+            for i, queue_message in enumerate(queue_messages)
+        }
+        consumer_backend.pull_messages = mock.MagicMock(return_value=queue_messages)
+        consumer_backend._decode_queue_message = mock.MagicMock(side_effect=lambda qm: (payloads[id(qm)], None))
+        consumer_backend.delete_message = mock.MagicMock()
+        consumer_backend.extend_visibility_timeout = mock.MagicMock()
+        consumer_backend.task_batches = TaskBatches()
+
+        try:
+            consumer_backend.fetch_and_process_messages(2)
+            consumer_backend.task_batches.flush()
+        finally:
+            consumer_backend.task_batches = None
+
+        mock_index_documents.assert_called_once()
+        assert [item.args for item in mock_index_documents.call_args[0][0]] == [[0], [1]]
+        consumer_backend.delete_message.assert_called_once_with(queue_messages[0])
+        consumer_backend.extend_visibility_timeout.assert_called_once_with(60, queue_message=queue_messages[1])
+
+    @mock.patch('tests.tasks._index_documents', autospec=True)
+    def test_batched_message_is_counted_until_settled(self, mock_index_documents, consumer_backend, message_data):
+        mock_index_documents.return_value = None
+        queue_message = mock.MagicMock()
+        payload = json.dumps({**message_data, 'task': 'tests.tasks.index_documents'})
+        consumer_backend._decode_queue_message = mock.MagicMock(return_value=(payload, None))
+        consumer_backend.message_size = mock.MagicMock(return_value=10)
+        consumer_backend.delete_message = mock.MagicMock()
+        consumer_backend.task_batches = TaskBatches()
+        executor = BoundedExecutor(1)
+        backpressure = Backpressure(max_bytes=1000)
+        drain = Drain(threading.Event(), None)
+
+        try:
+            (future,) = consumer_backend.process_queue_messages(
+                [queue_message], executor=executor, drain=drain, backpressure=backpressure
+            )
+            future.result(timeout=1)
+            # handed off to its batch, but still held until the batch ran
+            assert executor.wait_for_capacity(timeout=0.05) == 0
+            assert backpressure.bytes_in_flight == 10
+            assert drain.in_flight == 1
+
+            consumer_backend.task_batches.flush()
+        finally:
+            consumer_backend.task_batches = None
+
+        consumer_backend.delete_message.assert_called_once_with(queue_message)
+        assert executor.wait_for_capacity(timeout=1) == 1
+        assert backpressure.bytes_in_flight == 0
+        assert drain.in_flight == 0
+        executor.shutdown()
+
+    def test_preserves_messages_with_executor(self, consumer_backend):
+        queue_message = mock.MagicMock()
+        consumer_backend.pull_messages = mock.MagicMock(return_value=[queue_message])
+        consumer_backend.process_message = mock.MagicMock(side_effect=Exception)
+        consumer_backend.nack_message = mock.MagicMock()
+        consumer_backend.delete_message = mock.MagicMock()
+        executor = BoundedExecutor(2)
+
+        consumer_backend.fetch_and_process_messages(executor=executor)
+        executor.shutdown()
+
+        consumer_backend.nack_message.assert_called_once_with(queue_message)
+        consumer_backend.delete_message.assert_not_called()
+
     @pytest.mark.parametrize(
         'exception,call_kwargs',
         [
@@ -228,6 +565,232 @@ class TestFetchAndProcessMessages:
             logging_mock.assert_called_once()
 
 
+class TestLease:
+    def test_lease_held_while_processing(self, consumer_backend, message):
+        queue_message = mock.MagicMock()
+        consumer_backend.lease_manager = lease_manager = mock.MagicMock()
+        consumer_backend._decode_queue_message = mock.MagicMock(return_value=(json.dumps(message.as_dict()), None))
+        consumer_backend.delete_message = mock.MagicMock()
+        leases = []
+
+        def _call_task(message_):
+            leases.append(current_lease())
+
+        with mock.patch('taskhawk.backends.base.Message.call_task', autospec=True, side_effect=_call_task):
+            consumer_backend._process_queue_message(queue_message)
+
+        lease_manager.acquire.assert_called_once_with(queue_message)
+        assert leases == [lease_manager.acquire.return_value]
+        lease_manager.release.assert_called_once_with(lease_manager.acquire.return_value)
+        assert current_lease() is None
+
+    def test_lease_released_before_nack(self, consumer_backend):
+        queue_message = mock.MagicMock()
+        consumer_backend.lease_manager = lease_manager = mock.MagicMock()
+        consumer_backend.process_message = mock.MagicMock(side_effect=Exception)
+        consumer_backend.nack_message = mock.MagicMock(side_effect=lambda _: lease_manager.release.assert_called_once())
+
+        consumer_backend._process_queue_message(queue_message)
+
+        consumer_backend.nack_message.assert_called_once_with(queue_message)
+
+    def test_queued_messages_are_leased_from_when_they_were_pulled(self, consumer_backend):
+        queue_messages = [mock.MagicMock(), mock.MagicMock()]
+        extended = threading.Event()
+        consumer_backend.extend_visibility_timeouts = mock.MagicMock(
+            side_effect=lambda extended_messages, _: (queue_messages[1] in extended_messages and extended.set()) or {}
+        )
+        # the first message holds the only worker for longer than the lease, while the second one waits its turn
+        consumer_backend.process_message = mock.MagicMock(side_effect=lambda _: extended.wait(timeout=5))
+        consumer_backend.delete_message = mock.MagicMock()
+        consumer_backend.lease_manager = lease_manager = LeaseManager(consumer_backend, 1).start()
+        executor = BoundedExecutor(1, max_in_flight=2)
+
+        consumer_backend.process_queue_messages(queue_messages, executor=executor)
+        executor.shutdown(wait=True)
+        lease_manager.stop()
+
+        assert extended.is_set()
+        assert consumer_backend.delete_message.call_count == 2
+        assert lease_manager._leases == {}
+
+    def test_task_max_lease(self, consumer_backend, message):
+        lease = Lease(mock.MagicMock(), 10, 3600)
+        message.task._max_lease_s = 60
+        token = _current_lease.set(lease)
+        try:
+            consumer_backend._prepare_message(json.dumps(message.as_dict()), None)
+        finally:
+            _current_lease.reset(token)
+            message.task._max_lease_s = None
+
+        assert lease.max_lease_s == 60
+
+    def test_extend_visibility_timeouts(self):
+        consumer_backend = MockBackend(Priority.default)
+        queue_messages = [mock.MagicMock(), mock.MagicMock()]
+        error = RuntimeError('fail')
+        consumer_backend.extend_visibility_timeout = mock.MagicMock(side_effect=[None, error])
+
+        assert consumer_backend.extend_visibility_timeouts(queue_messages, 30) == {1: error}
+        consumer_backend.extend_visibility_timeout.assert_has_calls(
+            [mock.call(30, queue_message=queue_message) for queue_message in queue_messages]
+        )
+
+
+class TestDrain:
+    def test_not_started_messages_are_nacked(self, consumer_backend):
+        queue_messages = [mock.MagicMock(), mock.MagicMock()]
+        shutdown_event = threading.Event()
+        consumer_backend.process_message = mock.MagicMock(side_effect=lambda _: shutdown_event.set())
+        consumer_backend.nack_message = mock.MagicMock()
+        consumer_backend.delete_message = mock.MagicMock()
+
+        consumer_backend.process_queue_messages(queue_messages, drain=Drain(shutdown_event, None))
+
+        consumer_backend.process_message.assert_called_once_with(queue_messages[0])
+        consumer_backend.delete_message.assert_called_once_with(queue_messages[0])
+        consumer_backend.nack_message.assert_called_once_with(queue_messages[1])
+
+    def test_released_messages_are_left_alone(self, consumer_backend):
+        queue_message = mock.MagicMock()
+        drain = Drain(threading.Event(), None)
+        consumer_backend.process_message = mock.MagicMock(side_effect=lambda _: drain.release_in_flight())
+        consumer_backend.nack_message = mock.MagicMock()
+        consumer_backend.delete_message = mock.MagicMock()
+
+        consumer_backend._process_queue_message(queue_message, drain)
+
+        # nacked once when released, and not acked after the task finished
+        consumer_backend.nack_message.assert_called_once_with(queue_message)
+        consumer_backend.delete_message.assert_not_called()
+        assert drain.in_flight == 0
+
+
+class TestWatchdog:
+    def test_timed_out_messages_are_left_alone(self, consumer_backend, message):
+        queue_message = mock.MagicMock()
+        consumer_backend._decode_queue_message = mock.MagicMock(return_value=(json.dumps(message.as_dict()), None))
+        consumer_backend.nack_message = mock.MagicMock()
+        consumer_backend.delete_message = mock.MagicMock()
+        timed_out = threading.Event()
+        consumer_backend.watchdog = Watchdog(lambda _: timed_out.set()).start()
+        message.task._timeout = 0.1
+        try:
+            with mock.patch('taskhawk.backends.base.Message.call_task', side_effect=lambda: timed_out.wait(2)):
+                consumer_backend._process_queue_message(queue_message)
+        finally:
+            message.task._timeout = None
+            consumer_backend.watchdog.stop()
+            consumer_backend.watchdog = None
+
+        assert timed_out.is_set()
+        # nacked once by the watchdog, and not acked after the task finished
+        consumer_backend.nack_message.assert_called_once_with(queue_message)
+        consumer_backend.delete_message.assert_not_called()
+
+
+class TestProcessQueueMessageAsync:
+    def test_success(self, consumer_backend, message):
+        queue_message = mock.MagicMock()
+        consumer_backend._decode_queue_message = mock.MagicMock(return_value=(json.dumps(message.as_dict()), None))
+        consumer_backend.delete_message = mock.MagicMock()
+
+        with mock.patch('taskhawk.backends.base.Message.call_task_async', autospec=True) as mock_call_task_async:
+            asyncio.run(consumer_backend._process_queue_message_async(queue_message))
+
+        mock_call_task_async.assert_called_once_with(message)
+        consumer_backend.delete_message.assert_called_once_with(queue_message)
+
+    def test_hooks_run_off_event_loop(self, consumer_backend, message, settings):
+        settings.TASKHAWK_PRE_PROCESS_HOOK = 'tests.test_backends.test_base.pre_process_hook'
+        settings.TASKHAWK_POST_PROCESS_HOOK = 'tests.test_backends.test_base.post_process_hook'
+        threads = []
+        pre_process_hook.reset_mock()
+        pre_process_hook.side_effect = lambda **_: threads.append(threading.current_thread())
+        post_process_hook.reset_mock()
+        post_process_hook.side_effect = lambda **_: threads.append(threading.current_thread())
+        consumer_backend._decode_queue_message = mock.MagicMock(return_value=(json.dumps(message.as_dict()), None))
+        consumer_backend.delete_message = mock.MagicMock()
+
+        with mock.patch('taskhawk.backends.base.Message.call_task_async', autospec=True):
+            asyncio.run(consumer_backend._process_queue_message_async(mock.MagicMock()))
+
+        assert len(threads) == 2
+        assert threading.main_thread() not in threads
+        pre_process_hook.side_effect = None
+        post_process_hook.side_effect = None
+
+    @pytest.mark.parametrize(
+        'exception,settle_method',
+        [
+            (Exception(), 'nack_message'),
+            (LoggingException("foo"), 'nack_message'),
+            (RetryException(delay_seconds=60), 'extend_visibility_timeout'),
+            (RetryException(), 'nack_message'),
+        ],
+    )
+    def test_preserves_messages(self, consumer_backend, exception, settle_method):
+        queue_message = mock.MagicMock()
+        consumer_backend.process_message_async = mock.AsyncMock(side_effect=exception)
+        consumer_backend.nack_message = mock.MagicMock()
+        consumer_backend.extend_visibility_timeout = mock.MagicMock()
+        consumer_backend.delete_message = mock.MagicMock()
+
+        asyncio.run(consumer_backend._process_queue_message_async(queue_message))
+
+        getattr(consumer_backend, settle_method).assert_called_once()
+        consumer_backend.delete_message.assert_not_called()
+
+    def test_timeout(self, consumer_backend, message, settings):
+        settings.TASKHAWK_TASK_TIMEOUT_HOOK = 'tests.test_backends.test_base.timeout_hook'
+        timeout_hook.reset_mock()
+        message.task._timeout = 0.1
+
+        async def _stuck():
+            await asyncio.sleep(2)
+
+        try:
+            with mock.patch('taskhawk.backends.base.Message.call_task_async', side_effect=_stuck), pytest.raises(
+                TaskTimeout
+            ):
+                asyncio.run(consumer_backend.message_handler_async(json.dumps(message.as_dict()), None))
+        finally:
+            message.task._timeout = None
+
+        timeout_hook.assert_called_once_with(task_name=message.task_name, message_id=message.id, timeout_s=0.1)
+
+    def test_blocking_calls_run_off_the_loop(self, consumer_backend, message, settings):
+        settings.TASKHAWK_CONSUMER_MAX_ATTEMPTS = 1
+        main_thread = threading.current_thread()
+        threads = []
+        consumer_backend.dedup_cache = mock.MagicMock()
+        consumer_backend.dedup_cache.seen.side_effect = lambda _: threads.append(threading.current_thread()) or False
+        consumer_backend.send_to_dead_letter = mock.MagicMock(
+            side_effect=lambda *_: threads.append(threading.current_thread())
+        )
+
+        try:
+            with mock.patch('taskhawk.backends.base.Message.call_task_async', side_effect=Exception), pytest.raises(
+                IgnoreException
+            ):
+                asyncio.run(consumer_backend.message_handler_async(json.dumps(message.as_dict()), None))
+        finally:
+            consumer_backend.dedup_cache = None
+
+        assert len(threads) == 2
+        assert main_thread not in threads
+
+    def test_ignore_exception(self, consumer_backend):
+        queue_message = mock.MagicMock()
+        consumer_backend.process_message_async = mock.AsyncMock(side_effect=IgnoreException)
+        consumer_backend.delete_message = mock.MagicMock()
+
+        asyncio.run(consumer_backend._process_queue_message_async(queue_message))
+
+        consumer_backend.delete_message.assert_called_once_with(queue_message)
+
+
 @pytest.mark.parametrize('value', [1469056316326, 1469056316326.123])
 def test__convert_to_json_decimal(value, message_data):
     backend = TaskhawkBaseBackend()
@@ -253,6 +816,114 @@ def test__convert_to_json_non_serializable(message_data):
         backend.message_payload(message.as_dict())
 
 
+@mock.patch('tests.tasks._send_email', autospec=True)
+class TestClaimCheck:
+    @pytest.fixture(autouse=True)
+    def claim_check(self, settings, tmp_path):
+        settings.TASKHAWK_CLAIM_CHECK = {
+            'store': 'taskhawk.claim_check.FileBlobStore',
+            'options': {'path': str(tmp_path)},
+            'min_bytes': 100,
+        }
+
+    @staticmethod
+    def _publish(message, publisher_backend):
+        publisher_backend.publish(message)
+        return publisher_backend._publish.call_args[0][1]
+
+    def test_round_trip(self, mock_send_email, message, mock_publisher_backend, consumer_backend, tmp_path):
+        payload = self._publish(message, mock_publisher_backend)
+
+        body = json.loads(payload)
+        assert body['args'] == [] and body['kwargs'] == {}
+        assert (tmp_path / body['claim_check']['key']).exists()
+
+        consumer_backend.process_message = lambda queue_message: consumer_backend.message_handler(payload, None)
+        consumer_backend.delete_message = mock.MagicMock()
+        consumer_backend._process_queue_message(mock.MagicMock())
+
+        mock_send_email.assert_called_once()
+        assert list(mock_send_email.call_args[0]) == message.args
+        assert mock_send_email.call_args[1]['from_email'] == message.kwargs['from_email']
+        consumer_backend.delete_message.assert_called_once()
+        assert not (tmp_path / body['claim_check']['key']).exists()
+
+    @pytest.mark.parametrize('ack_error', [None, Exception("oops")])
+    def test_batched_ack(self, mock_send_email, message, mock_publisher_backend, consumer_backend, tmp_path, ack_error):
+        payload = self._publish(message, mock_publisher_backend)
+        key = json.loads(payload)['claim_check']['key']
+        ack: Future = Future()
+
+        consumer_backend.process_message = lambda queue_message: consumer_backend.message_handler(payload, None)
+        consumer_backend.delete_message = mock.MagicMock(return_value=ack)
+        consumer_backend._process_queue_message(mock.MagicMock())
+
+        # the ack was only buffered
+        assert (tmp_path / key).exists()
+        if ack_error is None:
+            ack.set_result(None)
+        else:
+            ack.set_exception(ack_error)
+        assert (tmp_path / key).exists() is (ack_error is not None)
+
+    def test_older_consumers_reject_offloaded_messages(
+        self, mock_send_email, message, mock_publisher_backend, consumer_backend
+    ):
+        payload = self._publish(message, mock_publisher_backend)
+
+        assert json.loads(payload)['metadata']['version'] == CLAIM_CHECK_VERSION
+        # consumers that don't know about claim checks only accept version 1.0
+        with mock.patch.object(Message, 'VERSIONS', ['1.0']), pytest.raises(ValidationError):
+            consumer_backend.message_handler(payload, None)
+
+        mock_send_email.assert_not_called()
+
+    def test_small_messages_arent_offloaded(self, mock_send_email, message, mock_publisher_backend, settings):
+        settings.TASKHAWK_CLAIM_CHECK = {**settings.TASKHAWK_CLAIM_CHECK, 'min_bytes': 10000}
+
+        assert json.loads(self._publish(message, mock_publisher_backend)) == message.as_dict()
+
+    def test_keeps_blob_of_failed_message(
+        self, mock_send_email, message, mock_publisher_backend, consumer_backend, tmp_path
+    ):
+        mock_send_email.side_effect = Exception
+        payload = self._publish(message, mock_publisher_backend)
+        key = json.loads(payload)['claim_check']['key']
+
+        consumer_backend.process_message = lambda queue_message: consumer_backend.message_handler(payload, None)
+        consumer_backend.nack_message = mock.MagicMock()
+        consumer_backend._process_queue_message(mock.MagicMock())
+
+        consumer_backend.nack_message.assert_called_once()
+        assert (tmp_path / key).exists()
+
+    @mock.patch('taskhawk.publisher.publish', autospec=True)
+    def test_deferred_message_keeps_blob(
+        self, mock_publish, mock_send_email, message, mock_publisher_backend, consumer_backend, tmp_path
+    ):
+        message_data = message.as_dict()
+        # further away than visibility can be extended, so it's re-published
+        message_data['headers'][RETRY_AT_HEADER] = str(int((time.time() + 86400) * 1000))
+        payload = self._publish(Message(message_data), mock_publisher_backend)
+        claim_check = json.loads(payload)['claim_check']
+
+        with pytest.raises(IgnoreException):
+            consumer_backend.message_handler(payload, None)
+
+        mock_send_email.assert_not_called()
+        assert mock_publish.call_args[0][0].as_dict()['claim_check'] == claim_check
+        assert (tmp_path / claim_check['key']).exists()
+
+    def test_requires_store(self, mock_send_email, message, mock_publisher_backend, consumer_backend):
+        payload = self._publish(message, mock_publisher_backend)
+
+        with mock.patch('taskhawk.backends.base.get_blob_store', return_value=None):
+            with pytest.raises(ConfigurationError):
+                consumer_backend.message_handler(payload, None)
+
+        mock_send_email.assert_not_called()
+
+
 class TestPublisher:
     def test_publish(self, message, mock_publisher_backend):
         message.validate()
@@ -0,0 +1,98 @@
+import threading
+from unittest import mock
+
+import pytest
+
+from taskhawk.backends import batching
+from taskhawk.backends.batching import Batcher
+
+
+def test_sends_full_batches():
+    flush_fn = mock.MagicMock(return_value=None)
+    batcher = Batcher(flush_fn, max_items=2, max_latency_s=60)
+
+    futures = [batcher.add(i) for i in range(4)]
+
+    for future in futures:
+        assert future.result(timeout=1) is None
+    flush_fn.assert_has_calls([mock.call([0, 1]), mock.call([2, 3])])
+
+
+def test_sends_partial_batch_after_latency():
+    sent = threading.Event()
+    flush_fn = mock.MagicMock(side_effect=lambda items: sent.set())
+    batcher = Batcher(flush_fn, max_items=10, max_latency_s=0.05)
+
+    future = batcher.add('a')
+
+    assert sent.wait(timeout=1)
+    future.result(timeout=1)
+    flush_fn.assert_called_once_with(['a'])
+
+
+def test_flush():
+    flush_fn = mock.MagicMock(return_value=None)
+    batcher = Batcher(flush_fn, max_items=2, max_latency_s=60)
+
+    futures = [batcher.add(i) for i in range(3)]
+    batcher.flush()
+
+    assert all(f.done() for f in futures)
+    assert sorted(item for c in flush_fn.call_args_list for item in c.args[0]) == [0, 1, 2]
+
+
+def test_max_pending_blocks_add():
+    sending = threading.Event()
+    release = threading.Event()
+
+    def _flush(items):
+        sending.set()
+        release.wait(timeout=5)
+
+    batcher = Batcher(_flush, max_items=1, max_latency_s=60, max_pending=1)
+    batcher.add(0)
+    assert sending.wait(timeout=1)
+    # the first item is being sent, so there's room for one more
+    batcher.add(1)
+    added = threading.Event()
+    threading.Thread(target=lambda: batcher.add(2) and added.set(), daemon=True).start()
+
+    assert not added.wait(timeout=0.1)
+    release.set()
+    assert added.wait(timeout=1)
+
+
+def test_partial_failure():
+    error = RuntimeError('fail')
+    batcher = Batcher(mock.MagicMock(return_value={1: error}), max_items=2, max_latency_s=60)
+
+    futures = [batcher.add(i) for i in range(2)]
+
+    assert futures[0].result(timeout=1) is None
+    assert futures[1].exception(timeout=1) is error
+
+
+def test_batch_failure():
+    error = RuntimeError('fail')
+    batcher = Batcher(mock.MagicMock(side_effect=error), max_items=2, max_latency_s=60)
+
+    with mock.patch.object(batching.logger, 'exception'):
+        futures = [batcher.add(i) for i in range(2)]
+        for future in futures:
+            assert future.exception(timeout=1) is error
+
+
+def test_log_failure():
+    future = mock.MagicMock()
+    future.exception.return_value = RuntimeError()
+
+    with mock.patch.object(batching.logger, 'error') as logging_mock:
+        batching.log_failure('failed', extra={'a': 'b'})(future)
+
+    logging_mock.assert_called_once_with('failed', exc_info=future.exception.return_value, extra={'a': 'b'})
+
+
+@pytest.mark.parametrize('max_items,max_latency_s', [(0, 1), (1, -1)])
+def test_invalid_params(max_items, max_latency_s):
+    with pytest.raises(ValueError):
+        Batcher(mock.MagicMock(), max_items, max_latency_s)
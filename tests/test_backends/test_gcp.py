@@ -6,13 +6,15 @@ import funcy
 import pytest
 
 try:
-    from google.api_core.exceptions import ServiceUnavailable
+    from google.api_core.exceptions import NotFound, ServiceUnavailable
     from taskhawk.backends.gcp import GoogleMetadata
-    from tests.helpers.gcp import build_gcp_received_message
+    from tests.helpers.gcp import build_gcp_received_message, build_gcp_streaming_message
 except ImportError:
     pass
+from taskhawk.compression import compress_payload
 from taskhawk.conf import settings
 from taskhawk.models import Priority
+from taskhawk.retry import Backoff
 
 gcp = pytest.importorskip('taskhawk.backends.gcp')
 
@@ -46,6 +48,24 @@ class TestPubSubPublisher:
         gcp_publisher = gcp.GooglePubSubPublisherBackend(priority=Priority.default)
         assert gcp_publisher.publisher == mock_pubsub_v1.PublisherClient()
 
+    def test_publisher_settings(self, mock_pubsub_v1, settings):
+        settings.TASKHAWK_PUBLISHER_GCP_BATCH_SETTINGS = {'max_messages': 500, 'max_latency': 0.05}
+        settings.TASKHAWK_PUBLISHER_GCP_FLOW_CONTROL = {'message_limit': 2000, 'limit_exceeded_behavior': 'BLOCK'}
+        gcp_publisher = gcp.GooglePubSubAsyncPublisherBackend(priority=Priority.default)
+
+        gcp_publisher.publisher
+
+        types = mock_pubsub_v1.types
+        types.BatchSettings.assert_called_once_with(max_messages=500, max_latency=0.05)
+        types.LimitExceededBehavior.assert_called_once_with('block')
+        types.PublishFlowControl.assert_called_once_with(
+            message_limit=2000, limit_exceeded_behavior=types.LimitExceededBehavior.return_value
+        )
+        types.PublisherOptions.assert_called_once_with(flow_control=types.PublishFlowControl.return_value)
+        mock_pubsub_v1.PublisherClient.assert_called_once_with(
+            batch_settings=types.BatchSettings.return_value, publisher_options=types.PublisherOptions.return_value
+        )
+
     def test_publish_success(self, mock_pubsub_v1, message):
         gcp_publisher = gcp.GooglePubSubPublisherBackend(priority=message.priority)
         message_data = json.dumps(message.as_dict())
@@ -81,6 +101,22 @@ class TestPubSubPublisher:
         assert mock_send_email.call_args[1]['headers'] == message.headers
         assert mock_send_email.call_args[1]['metadata'] == message.metadata
 
+    @mock.patch('tests.tasks._send_email', autospec=True)
+    def test_sync_mode_with_retry_policy(self, mock_send_email, mock_pubsub_v1, message, gcp_settings):
+        gcp_settings.TASKHAWK_SYNC = True
+        gcp_settings.TASKHAWK_CONSUMER_MAX_ATTEMPTS = 1
+        mock_send_email.side_effect = ValueError('fail')
+        message.task._retry = Backoff(base=2, max=3600, jitter=False)
+        publisher = gcp.GooglePubSubPublisherBackend(priority=message.priority)
+        try:
+            # the task's exception is raised, rather than the message being retried or dead-lettered
+            with pytest.raises(ValueError):
+                publisher.publish(message)
+        finally:
+            message.task._retry = None
+
+        mock_send_email.assert_called_once()
+
 
 pre_process_hook = mock.MagicMock()
 post_process_hook = mock.MagicMock()
@@ -132,6 +168,13 @@ class TestGCPConsumer:
             timeout=gcp_settings.GOOGLE_PUBSUB_READ_TIMEOUT_S,
         )
 
+    def test_pull_messages_with_wait_time(self, mock_pubsub_v1, gcp_consumer):
+        gcp_consumer.pull_messages(100, wait_time_s=2)
+
+        gcp_consumer.subscriber.pull.assert_called_once_with(
+            subscription=gcp_consumer._subscription_path, max_messages=100, retry=None, timeout=2
+        )
+
     def test_pull_messages_service_unavailable(self, mock_pubsub_v1, gcp_consumer, gcp_settings):
         num_messages = 1
         visibility_timeout = 10
@@ -147,6 +190,31 @@ class TestGCPConsumer:
             timeout=gcp_settings.GOOGLE_PUBSUB_READ_TIMEOUT_S,
         )
 
+    @pytest.mark.parametrize('delivery_attempt,expected', [(0, None), (3, 3)])
+    def test_delivery_attempt(self, gcp_consumer, delivery_attempt, expected):
+        metadata = GoogleMetadata('dummy_ack_id', arrow.utcnow().datetime, delivery_attempt)
+
+        assert gcp_consumer.delivery_attempt(metadata) == expected
+
+    def test_decode_compressed(self, gcp_consumer, message):
+        message.kwargs['body'] = 'Hello! ' * 100
+        queue_message = build_gcp_received_message(message)
+        message_json = queue_message.message.data.decode()
+        payload, encoding = compress_payload(message_json, {'min_bytes': 0})
+        assert encoding is not None
+        queue_message.message.data = payload.encode()
+        queue_message.message.attributes = {**message.headers, 'taskhawk-encoding': encoding}
+
+        assert gcp_consumer._decode_queue_message(queue_message)[0] == message_json
+
+    def test_send_to_dead_letter(self, mock_pubsub_v1, gcp_consumer):
+        gcp_consumer.send_to_dead_letter('{"id": "1"}', {'request_id': '2'})
+
+        gcp_consumer.publisher.publish.assert_called_once_with(
+            gcp_consumer._dlq_topic_path, data=b'{"id": "1"}', request_id='2'
+        )
+        gcp_consumer.publisher.publish.return_value.result.assert_called_once_with()
+
     def test_success_extend_visibility_timeout_with_metadata(self, mock_pubsub_v1, gcp_consumer):
         visibility_timeout_s = 10
         ack_id = "dummy_ack_id"
@@ -264,6 +332,59 @@ class TestGCPConsumer:
         pre_process_hook.assert_called_once_with(google_pubsub_message=queue_message)
         post_process_hook.assert_called_once_with(google_pubsub_message=queue_message)
 
+    def test_batched_acks(self, mock_pubsub_v1, gcp_settings, message):
+        gcp_settings.GOOGLE_PUBSUB_ACK_BATCH_MAX_MESSAGES = 100
+        gcp_settings.GOOGLE_PUBSUB_ACK_BATCH_MAX_LATENCY_S = 60
+        gcp_consumer = gcp.GooglePubSubConsumerBackend(priority=Priority.default)
+        queue_messages = [build_gcp_received_message(message) for _ in range(3)]
+        for i, queue_message in enumerate(queue_messages):
+            queue_message.ack_id = f'ack_id_{i}'
+
+        gcp_consumer.delete_message(queue_messages[0])
+        gcp_consumer.delete_message(queue_messages[1])
+        gcp_consumer.nack_message(queue_messages[2])
+        gcp_consumer.close()
+
+        gcp_consumer.subscriber.acknowledge.assert_called_once_with(
+            subscription=gcp_consumer._subscription_path, ack_ids=['ack_id_0', 'ack_id_1']
+        )
+        gcp_consumer.subscriber.modify_ack_deadline.assert_called_once_with(
+            subscription=gcp_consumer._subscription_path, ack_ids=['ack_id_2'], ack_deadline_seconds=0
+        )
+
+    def test_batched_acks_failure_logged(self, mock_pubsub_v1, gcp_settings, message):
+        gcp_settings.GOOGLE_PUBSUB_ACK_BATCH_MAX_MESSAGES = 100
+        gcp_settings.GOOGLE_PUBSUB_ACK_BATCH_MAX_LATENCY_S = 60
+        gcp_consumer = gcp.GooglePubSubConsumerBackend(priority=Priority.default)
+        gcp_consumer.subscriber.acknowledge.side_effect = ServiceUnavailable("foobar")
+        queue_message = build_gcp_received_message(message)
+
+        with mock.patch('taskhawk.backends.batching.logger') as logging_mock:
+            gcp_consumer.delete_message(queue_message)
+            gcp_consumer.close()
+
+        logging_mock.error.assert_called_once_with(
+            'Exception while deleting message', exc_info=mock.ANY, extra={'queue_message': queue_message}
+        )
+
+    def test_extend_visibility_timeouts(self, mock_pubsub_v1, gcp_consumer, message):
+        queue_messages = [build_gcp_received_message(message) for _ in range(2)]
+        for i, queue_message in enumerate(queue_messages):
+            queue_message.ack_id = f'ack_id_{i}'
+
+        assert gcp_consumer.extend_visibility_timeouts(queue_messages, 30) == {}
+
+        gcp_consumer.subscriber.modify_ack_deadline.assert_called_once_with(
+            subscription=gcp_consumer._subscription_path, ack_ids=['ack_id_0', 'ack_id_1'], ack_deadline_seconds=30
+        )
+
+    def test_extend_visibility_timeouts_failure(self, mock_pubsub_v1, gcp_consumer, message):
+        error = ServiceUnavailable("foobar")
+        gcp_consumer.subscriber.modify_ack_deadline.side_effect = error
+        queue_messages = [build_gcp_received_message(message) for _ in range(2)]
+
+        assert gcp_consumer.extend_visibility_timeouts(queue_messages, 30) == {0: error, 1: error}
+
     def test_error_count_increments(self, mock_pubsub_v1, gcp_settings, gcp_consumer):
         assert gcp_consumer.error_count == 0
 
@@ -315,3 +436,137 @@ class TestGCPConsumer:
                 for _ in range(3)
             ]
         )
+
+
+@pytest.fixture(name='gcp_streaming_consumer')
+def _gcp_streaming_consumer(mock_pubsub_v1):
+    gcp_consumer = gcp.GooglePubSubStreamingConsumerBackend(priority=Priority.default)
+    gcp_consumer.subscriber.subscribe.return_value.done.return_value = False
+    return gcp_consumer
+
+
+class TestGCPStreamingConsumer:
+    def test_pull_messages_starts_stream(self, mock_pubsub_v1, gcp_streaming_consumer, gcp_settings, message):
+        gcp_settings.GOOGLE_PUBSUB_FLOW_CONTROL = {'max_messages': 10, 'max_bytes': 1024}
+        queue_messages = [build_gcp_streaming_message(message) for _ in range(3)]
+
+        assert gcp_streaming_consumer.pull_messages(2, wait_time_s=0) == []
+
+        subscribe = gcp_streaming_consumer.subscriber.subscribe
+        subscribe.assert_called_once_with(
+            gcp_streaming_consumer._subscription_path,
+            callback=mock.ANY,
+            flow_control=mock_pubsub_v1.types.FlowControl.return_value,
+        )
+        mock_pubsub_v1.types.FlowControl.assert_called_once_with(max_messages=10, max_bytes=1024)
+        callback = subscribe.call_args[1]['callback']
+        for queue_message in queue_messages:
+            callback(queue_message)
+
+        assert gcp_streaming_consumer.pull_messages(2) == queue_messages[:2]
+        assert gcp_streaming_consumer.pull_messages(2) == queue_messages[2:]
+        subscribe.assert_called_once()
+
+    @pytest.mark.parametrize('max_outstanding, max_messages', [(None, 2), (8, 8)])
+    def test_default_flow_control_is_limited(
+        self, mock_pubsub_v1, gcp_streaming_consumer, gcp_settings, max_outstanding, max_messages
+    ):
+        gcp_settings.GOOGLE_PUBSUB_FLOW_CONTROL = {'max_bytes': 1024}
+        gcp_streaming_consumer.max_outstanding = max_outstanding
+
+        gcp_streaming_consumer.pull_messages(2, wait_time_s=0)
+
+        mock_pubsub_v1.types.FlowControl.assert_called_once_with(max_messages=max_messages, max_bytes=1024)
+        assert gcp_streaming_consumer._received.maxsize == max_messages
+
+    def test_pull_messages_restarts_stream(self, mock_pubsub_v1, gcp_streaming_consumer):
+        subscribe = gcp_streaming_consumer.subscriber.subscribe
+        gcp_streaming_consumer.pull_messages(1, wait_time_s=0)
+        subscribe.return_value.done.return_value = True
+
+        gcp_streaming_consumer.pull_messages(1, wait_time_s=0)
+
+        assert subscribe.call_count == 2
+        assert gcp_streaming_consumer.error_count == 1
+
+    def test_ack_nack(self, gcp_streaming_consumer, message):
+        queue_message = build_gcp_streaming_message(message)
+
+        assert gcp_streaming_consumer.delete_message(queue_message) is queue_message.ack_with_response.return_value
+        gcp_streaming_consumer.nack_message(queue_message)
+
+        queue_message.ack_with_response.assert_called_once_with()
+        queue_message.nack.assert_called_once_with()
+
+    def test_extend_visibility_timeout_with_queue_message(self, gcp_streaming_consumer, message):
+        queue_message = build_gcp_streaming_message(message)
+
+        gcp_streaming_consumer.extend_visibility_timeout(10, queue_message=queue_message)
+
+        queue_message.modify_ack_deadline.assert_called_once_with(10)
+        queue_message.drop.assert_called_once_with()
+
+    def test_extend_visibility_timeout_with_metadata(self, gcp_streaming_consumer):
+        metadata = GoogleMetadata("dummy_ack_id", arrow.utcnow().datetime, 1)
+
+        gcp_streaming_consumer.extend_visibility_timeout(10, metadata=metadata)
+
+        gcp_streaming_consumer.subscriber.modify_ack_deadline.assert_called_once_with(
+            subscription=gcp_streaming_consumer._subscription_path, ack_ids=["dummy_ack_id"], ack_deadline_seconds=10
+        )
+
+    def test_close_nacks_received_messages(self, gcp_streaming_consumer, message):
+        queue_message = build_gcp_streaming_message(message)
+        gcp_streaming_consumer.pull_messages(1, wait_time_s=0)
+        subscribe = gcp_streaming_consumer.subscriber.subscribe
+        subscribe.call_args[1]['callback'](queue_message)
+
+        gcp_streaming_consumer.close()
+
+        subscribe.return_value.cancel.assert_called_once_with()
+        gcp_streaming_consumer.subscriber.modify_ack_deadline.assert_called_once_with(
+            subscription=gcp_streaming_consumer._subscription_path,
+            ack_ids=[queue_message.ack_id],
+            ack_deadline_seconds=0,
+        )
+
+    def test_fetch_and_process_messages_success(self, gcp_streaming_consumer, gcp_settings, message, reset_mocks):
+        gcp_settings.TASKHAWK_PRE_PROCESS_HOOK = 'tests.test_backends.test_gcp.pre_process_hook'
+        gcp_settings.TASKHAWK_POST_PROCESS_HOOK = 'tests.test_backends.test_gcp.post_process_hook'
+        queue_message = build_gcp_streaming_message(message)
+        gcp_streaming_consumer.pull_messages(1, wait_time_s=0)
+        gcp_streaming_consumer.subscriber.subscribe.call_args[1]['callback'](queue_message)
+        gcp_streaming_consumer.message_handler = mock.MagicMock(wraps=gcp_streaming_consumer.message_handler)
+
+        gcp_streaming_consumer.fetch_and_process_messages(1)
+
+        gcp_streaming_consumer.message_handler.assert_called_once_with(
+            queue_message.data.decode(),
+            GoogleMetadata(queue_message.ack_id, queue_message.publish_time, queue_message.delivery_attempt),
+        )
+        queue_message.ack_with_response.assert_called_once_with()
+        pre_process_hook.assert_called_once_with(google_pubsub_message=queue_message)
+        post_process_hook.assert_called_once_with(google_pubsub_message=queue_message)
+
+
+class TestGCSBlobStore:
+    def test_put_get_delete(self):
+        store = gcp.GCSBlobStore('taskhawk-blobs', prefix='taskhawk/')
+        store._bucket = mock.MagicMock()
+        blob = store._bucket.blob.return_value
+        blob.download_as_bytes.return_value = b'data'
+
+        store.put('key', b'data')
+        assert store.get('key') == b'data'
+        store.delete('key')
+
+        store._bucket.blob.assert_called_with('taskhawk/key')
+        blob.upload_from_string.assert_called_once_with(b'data')
+        blob.delete.assert_called_once_with()
+
+    def test_delete_missing(self):
+        store = gcp.GCSBlobStore('taskhawk-blobs')
+        store._bucket = mock.MagicMock()
+        store._bucket.blob.return_value.delete.side_effect = NotFound('missing')
+
+        store.delete('key')
@@ -0,0 +1,75 @@
+from unittest import mock
+
+import pytest
+
+from taskhawk import backpressure as backpressure_module
+from taskhawk.backpressure import Backpressure, current_rss_bytes
+
+
+def test_sizes_pulls_to_fit_max_bytes():
+    backpressure = Backpressure(max_bytes=1000)
+    queue_messages = [mock.MagicMock(), mock.MagicMock()]
+
+    assert backpressure.capacity(10) == 10
+
+    backpressure.acquire(queue_messages[0], 200)
+    assert backpressure.bytes_in_flight == 200
+    # 800 bytes left at 200 bytes per message
+    assert backpressure.capacity(10) == 4
+
+    backpressure.acquire(queue_messages[1], 800)
+    assert backpressure.capacity(10, timeout=0.05) == 0
+
+    backpressure.release(queue_messages[1])
+    backpressure.release(queue_messages[1])
+    assert backpressure.bytes_in_flight == 200
+
+
+def test_allows_one_large_message():
+    backpressure = Backpressure(max_bytes=100)
+    queue_message = mock.MagicMock()
+    backpressure.acquire(queue_message, 500)
+    backpressure.release(queue_message)
+
+    assert backpressure.capacity(10) == 1
+
+
+@mock.patch('taskhawk.backpressure.current_rss_bytes')
+def test_pauses_over_max_rss(mock_current_rss_bytes):
+    mock_current_rss_bytes.return_value = 2000
+    backpressure = Backpressure(max_rss_bytes=1000)
+    backpressure.acquire(mock.MagicMock(), 100)
+
+    with mock.patch.object(backpressure_module.logger, 'warning') as logging_mock:
+        assert backpressure.capacity(10, timeout=0.05) == 0
+        assert backpressure.capacity(10, timeout=0.05) == 0
+    # logged once per pause
+    logging_mock.assert_called_once()
+
+    mock_current_rss_bytes.return_value = 500
+    assert backpressure.capacity(10) == 10
+
+
+@mock.patch('taskhawk.backpressure.current_rss_bytes', return_value=2000)
+def test_allows_one_message_over_max_rss_when_idle(_):
+    backpressure = Backpressure(max_rss_bytes=1000)
+
+    assert backpressure.capacity(10, timeout=0.05) == 1
+
+
+@mock.patch('taskhawk.backpressure.current_rss_bytes', return_value=None)
+def test_max_rss_unavailable(_):
+    backpressure = Backpressure(max_rss_bytes=1000)
+
+    assert backpressure.capacity(10, timeout=0) == 10
+
+
+def test_current_rss_bytes():
+    rss_bytes = current_rss_bytes()
+    assert rss_bytes is None or rss_bytes > 0
+
+
+@pytest.mark.parametrize('kwargs', [{'max_bytes': 0}, {'max_rss_bytes': -1}])
+def test_invalid(kwargs):
+    with pytest.raises(ValueError):
+        Backpressure(**kwargs)
@@ -0,0 +1,76 @@
+import threading
+from unittest import mock
+
+from taskhawk.batches import TaskBatches
+from taskhawk.drain import Drain
+from taskhawk.models import Message
+
+
+def _messages(message_data, count):
+    return [Message({**message_data, 'task': 'tests.tasks.index_documents', 'args': [i]}) for i in range(count)]
+
+
+@mock.patch('tests.tasks._index_documents', autospec=True)
+def test_full_batch_runs(mock_index_documents, message_data):
+    error = Exception()
+    mock_index_documents.return_value = {1: error}
+    consumer_backend = mock.MagicMock()
+    settled = threading.Semaphore(0)
+    consumer_backend._settle_batched.side_effect = lambda *_: settled.release()
+    messages = _messages(message_data, 2)
+    queue_messages = [mock.MagicMock(), mock.MagicMock()]
+    task_batches = TaskBatches()
+
+    for queue_message, message in zip(queue_messages, messages):
+        task_batches.add(consumer_backend, queue_message, message)
+
+    # batch_size is 2, so the batch runs without waiting for its window
+    assert settled.acquire(timeout=0.5) and settled.acquire(timeout=0.5)
+    mock_index_documents.assert_called_once()
+    assert [item.args for item in mock_index_documents.call_args[0][0]] == [[0], [1]]
+    consumer_backend._settle_batched.assert_has_calls(
+        [mock.call(queue_messages[0], messages[0], None), mock.call(queue_messages[1], messages[1], error)]
+    )
+
+
+@mock.patch('tests.tasks._index_documents', autospec=True)
+def test_flush(mock_index_documents, message_data):
+    mock_index_documents.return_value = None
+    consumer_backend = mock.MagicMock()
+    consumer_backend.lease_manager.acquire.return_value.max_lease_s = None
+    (message,) = _messages(message_data, 1)
+    queue_message = mock.MagicMock()
+    task_batches = TaskBatches()
+
+    settled = task_batches.add(consumer_backend, queue_message, message)
+    consumer_backend._settle_batched.assert_not_called()
+    assert not settled.done()
+    task_batches.flush()
+
+    assert settled.done()
+    mock_index_documents.assert_called_once()
+    lease = consumer_backend.lease_manager.acquire.return_value
+    consumer_backend.lease_manager.acquire.assert_called_once_with(queue_message, None)
+    consumer_backend.lease_manager.release.assert_called_once_with(lease)
+    consumer_backend._settle_batched.assert_called_once_with(queue_message, message, None)
+
+
+@mock.patch('tests.tasks._index_documents', autospec=True)
+def test_released_by_drain(mock_index_documents, message_data):
+    mock_index_documents.return_value = None
+    consumer_backend = mock.MagicMock()
+    consumer_backend.lease_manager = None
+    (message,) = _messages(message_data, 1)
+    queue_message = mock.MagicMock()
+    drain = Drain(threading.Event(), None)
+    drain.begin(consumer_backend, queue_message)
+    task_batches = TaskBatches()
+
+    settled = task_batches.add(consumer_backend, queue_message, message, drain)
+    # still waiting for its batch at the drain deadline
+    assert drain.release_in_flight() == [queue_message]
+    task_batches.flush()
+
+    assert settled.done()
+    consumer_backend.nack_message.assert_called_once_with(queue_message)
+    consumer_backend._settle_batched.assert_not_called()
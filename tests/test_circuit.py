@@ -0,0 +1,91 @@
+from unittest import mock
+
+import pytest
+
+from taskhawk.circuit import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitBreakers
+
+
+@pytest.fixture(name='now')
+def _now():
+    with mock.patch('taskhawk.circuit.time.monotonic', return_value=100.0) as monotonic:
+        yield monotonic
+
+
+def _breaker():
+    return CircuitBreaker('tests.tasks.send_email', error_rate=0.5, min_calls=4, window_s=10, open_s=30)
+
+
+def test_opens_at_error_rate(now):
+    breaker = _breaker()
+
+    for success in [True, False, False]:
+        assert breaker.allow() is None
+        breaker.record(success)
+    # not enough calls yet
+    assert breaker.state == CLOSED
+
+    assert breaker.allow() is None
+    breaker.record(True)
+    assert breaker.state == OPEN
+
+    now.return_value = 110.0
+    assert breaker.allow() == 20.0
+
+
+def test_window_expires_old_calls(now):
+    breaker = _breaker()
+    for _ in range(3):
+        breaker.record(False)
+
+    now.return_value = 111.0
+    breaker.record(False)
+
+    assert breaker.state == CLOSED
+
+
+def test_half_open_closes_after_successful_probes(now):
+    breaker = _breaker()
+    for _ in range(4):
+        breaker.record(False)
+
+    now.return_value = 130.0
+    assert [breaker.allow() for _ in range(4)] == [None, None, None, 30.0]
+    assert breaker.state == HALF_OPEN
+
+    for _ in range(3):
+        breaker.record(True)
+    assert breaker.state == CLOSED
+    assert breaker.allow() is None
+
+
+def test_half_open_reopens_on_failure(now):
+    breaker = _breaker()
+    for _ in range(4):
+        breaker.record(False)
+
+    now.return_value = 130.0
+    assert breaker.allow() is None
+    breaker.record(False)
+
+    assert breaker.state == OPEN
+    assert breaker.allow() == 30.0
+
+
+def test_half_open_replaces_lost_probes(now):
+    breaker = _breaker()
+    for _ in range(4):
+        breaker.record(False)
+
+    now.return_value = 130.0
+    for _ in range(3):
+        assert breaker.allow() is None
+
+    now.return_value = 160.0
+    assert breaker.allow() is None
+
+
+def test_circuit_breakers_per_task():
+    circuit_breakers = CircuitBreakers({'min_calls': 1})
+
+    assert circuit_breakers.get('a') is circuit_breakers.get('a')
+    assert circuit_breakers.get('a') is not circuit_breakers.get('b')
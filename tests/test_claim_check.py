@@ -0,0 +1,51 @@
+import json
+
+import pytest
+
+from taskhawk.claim_check import CLAIM_CHECK_VERSION, FileBlobStore, build_blob_store, check_in, check_out
+from taskhawk.compression import ZLIB
+
+
+def test_file_blob_store(tmp_path):
+    store = FileBlobStore(str(tmp_path))
+
+    store.put('message-id/blob', b'data')
+
+    assert store.get('message-id/blob') == b'data'
+    store.delete('message-id/blob')
+    with pytest.raises(FileNotFoundError):
+        store.get('message-id/blob')
+    # deleting again isn't an error
+    store.delete('message-id/blob')
+
+
+def test_file_blob_store_rejects_keys_outside_path(tmp_path):
+    store = FileBlobStore(str(tmp_path / 'blobs'))
+
+    with pytest.raises(ValueError):
+        store.put('../outside', b'data')
+
+
+def test_build_blob_store(tmp_path):
+    assert build_blob_store(None) is None
+    store = build_blob_store({'store': 'taskhawk.claim_check.FileBlobStore', 'options': {'path': str(tmp_path)}})
+    assert isinstance(store, FileBlobStore)
+
+
+@pytest.mark.parametrize('compression', [None, {'algorithm': ZLIB}])
+def test_round_trip(compression, message, tmp_path):
+    store = FileBlobStore(str(tmp_path))
+    message_body = message.as_dict()
+
+    body = check_in(store, message_body, json.dumps({'args': message.args, 'kwargs': message.kwargs}), compression)
+
+    assert body == {
+        **message_body,
+        'metadata': {**message_body['metadata'], 'version': CLAIM_CHECK_VERSION},
+        'args': [],
+        'kwargs': {},
+        'claim_check': body['claim_check'],
+    }
+    assert body['claim_check']['key'].startswith(f'{message.id}/')
+    assert body['claim_check']['encoding'] == (compression and ZLIB)
+    assert check_out(store, body['claim_check']) == (message.args, message.kwargs)
@@ -0,0 +1,60 @@
+import base64
+import json
+import os
+
+import pytest
+
+from taskhawk.compression import (
+    ENCODING_ATTRIBUTE,
+    HAVE_ZSTD,
+    ZLIB,
+    ZSTD,
+    compress_payload,
+    decompress_payload,
+)
+
+
+def _payload(size):
+    return json.dumps({'args': [{'id': i, 'name': f'document {i}'} for i in range(size)]})
+
+
+@pytest.mark.parametrize(
+    'algorithm', [ZLIB, pytest.param(ZSTD, marks=pytest.mark.skipif(not HAVE_ZSTD, reason='zstandard not installed'))]
+)
+def test_round_trip(algorithm):
+    payload = _payload(1000)
+
+    compressed, encoding = compress_payload(payload, {'algorithm': algorithm})
+
+    assert encoding == algorithm
+    assert len(compressed) < len(payload) / 4
+    assert decompress_payload(compressed, {ENCODING_ATTRIBUTE: encoding}) == payload
+
+
+def test_defaults_to_zlib():
+    # whether or not zstandard is installed, so consumers don't need it
+    assert compress_payload(_payload(1000), {})[1] == ZLIB
+
+
+def test_small_payloads_arent_compressed():
+    payload = _payload(10)
+
+    assert compress_payload(payload, {'algorithm': ZLIB, 'min_bytes': len(payload) + 1}) == (payload, None)
+    assert compress_payload(payload, None) == (payload, None)
+
+
+def test_incompressible_payloads_arent_compressed():
+    # base64 encoding would make it larger than it's now
+    payload = json.dumps({'args': [base64.b85encode(os.urandom(4096)).decode()]})
+
+    assert compress_payload(payload, {'algorithm': ZLIB}) == (payload, None)
+
+
+def test_uncompressed_payloads_pass_through():
+    assert decompress_payload('{}', {'request_id': '1'}) == '{}'
+    assert decompress_payload('{}', None) == '{}'
+
+
+def test_unknown_algorithm():
+    with pytest.raises(ValueError):
+        compress_payload(_payload(1000), {'algorithm': 'lz4'})
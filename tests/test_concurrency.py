@@ -0,0 +1,92 @@
+import threading
+from concurrent.futures import Future
+from unittest import mock
+
+import pytest
+
+from taskhawk import concurrency
+from taskhawk.concurrency import BoundedExecutor
+
+
+def test_submit_runs_callable():
+    executor = BoundedExecutor(2)
+    fn = mock.MagicMock(return_value=1)
+
+    future = executor.submit(fn, 'a', b='c')
+
+    assert future.result(timeout=1) == 1
+    fn.assert_called_once_with('a', b='c')
+    executor.shutdown()
+
+
+def test_caps_in_flight():
+    executor = BoundedExecutor(2)
+    release = threading.Event()
+
+    futures = [executor.submit(release.wait) for _ in range(2)]
+
+    assert executor.in_flight == 2
+    assert executor.wait_for_capacity(timeout=0.1) == 0
+
+    release.set()
+    for future in futures:
+        future.result(timeout=1)
+
+    assert executor.wait_for_capacity(timeout=1) == 2
+    executor.shutdown()
+
+
+def test_returned_future_holds_slot():
+    executor = BoundedExecutor(1)
+    handed_off: Future = Future()
+
+    executor.submit(lambda: handed_off).result(timeout=1)
+
+    assert executor.wait_for_capacity(timeout=0.1) == 0
+    handed_off.set_result(None)
+    assert executor.wait_for_capacity(timeout=1) == 1
+    executor.shutdown()
+
+
+def test_logs_exceptions():
+    executor = BoundedExecutor(1)
+
+    with mock.patch.object(concurrency.logger, 'error') as logging_mock:
+        future = executor.submit(mock.MagicMock(side_effect=RuntimeError))
+        executor.shutdown()
+
+    assert isinstance(future.exception(), RuntimeError)
+    logging_mock.assert_called_once()
+    assert executor.in_flight == 0
+
+
+def test_abandon_replaces_stuck_thread():
+    executor = BoundedExecutor(1)
+    release = threading.Event()
+    started = threading.Event()
+    thread_ids = []
+
+    def stuck():
+        thread_ids.append(threading.get_ident())
+        started.set()
+        release.wait()
+
+    stuck_future = executor.submit(stuck)
+    assert started.wait(timeout=1)
+
+    assert executor.abandon(thread_ids[0])
+    assert executor.in_flight == 0
+    # runs on a fresh thread while the stuck one is still busy
+    assert executor.submit(threading.get_ident).result(timeout=1) != thread_ids[0]
+    assert not executor.abandon(thread_ids[0])
+
+    release.set()
+    stuck_future.result(timeout=1)
+    executor.shutdown()
+    assert executor.in_flight == 0
+
+
+@pytest.mark.parametrize('max_workers,max_in_flight', [(0, None), (2, 1)])
+def test_invalid_params(max_workers, max_in_flight):
+    with pytest.raises(ValueError):
+        BoundedExecutor(max_workers, max_in_flight)
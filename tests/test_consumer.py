@@ -1,6 +1,17 @@
+import asyncio
+import os
+import signal
+import threading
+from concurrent.futures import Future
 from unittest import mock
 
-from taskhawk.consumer import process_messages_for_lambda_consumer, listen_for_messages
+from taskhawk import consumer
+from taskhawk.consumer import (
+    listen_for_messages,
+    listen_for_messages_async,
+    listen_for_messages_weighted,
+    process_messages_for_lambda_consumer,
+)
 from taskhawk.models import Priority
 
 
@@ -26,8 +37,11 @@ class TestListenForMessages:
 
         mock_get_backend.assert_called_once_with(priority=priority)
         mock_get_backend.return_value.fetch_and_process_messages.assert_called_once_with(
-            num_messages=num_messages, visibility_timeout=visibility_timeout_s
+            num_messages=num_messages,
+            visibility_timeout=visibility_timeout_s,
+            drain=mock.ANY,
         )
+        mock_get_backend.return_value.close.assert_called_once_with()
 
     def test_listen_for_messages_with_periodic_heartbeat_thread(self, mock_get_backend, settings):
         num_messages = 3
@@ -40,6 +54,342 @@ class TestListenForMessages:
 
         mock_get_backend.assert_called_once_with(priority=priority)
         mock_get_backend.return_value.fetch_and_process_messages.assert_called_once_with(
-            num_messages=num_messages, visibility_timeout=visibility_timeout_s
+            num_messages=num_messages,
+            visibility_timeout=visibility_timeout_s,
+            drain=mock.ANY,
         )
         mock_get_backend.return_value.call_heartbeat_hook.assert_called_once_with()
+
+    def test_listen_for_messages_with_older_backend_signature(self, mock_get_backend):
+        fetched = []
+
+        class Backend:
+            def fetch_and_process_messages(self, num_messages=1, visibility_timeout=None):
+                fetched.append((num_messages, visibility_timeout))
+
+            def close(self):
+                pass
+
+        mock_get_backend.return_value = Backend()
+
+        listen_for_messages(Priority.default, 3, 4, loop_count=1)
+
+        assert fetched == [(3, 4)]
+
+    def test_listen_for_messages_with_concurrency(self, mock_get_backend):
+        num_messages = 3
+        visibility_timeout_s = 4
+        loop_count = 1
+        priority = Priority.default
+
+        with mock.patch('taskhawk.consumer.BoundedExecutor', autospec=True) as mock_executor_cls:
+            listen_for_messages(priority, num_messages, visibility_timeout_s, loop_count, concurrency=5)
+
+        mock_executor_cls.assert_called_once_with(5)
+        mock_get_backend.return_value.fetch_and_process_messages.assert_called_once_with(
+            num_messages=num_messages,
+            visibility_timeout=visibility_timeout_s,
+            executor=mock_executor_cls.return_value,
+            drain=mock.ANY,
+        )
+        mock_executor_cls.return_value.shutdown.assert_called_once_with(wait=True)
+        # streaming backends hold no more messages than the consumer works on
+        assert mock_get_backend.return_value.max_outstanding == 15
+
+    def test_listen_for_messages_with_backpressure(self, mock_get_backend, settings):
+        settings.TASKHAWK_CONSUMER_MAX_BYTES_IN_FLIGHT = 1024 * 1024
+
+        with mock.patch('taskhawk.consumer.Backpressure', autospec=True) as mock_backpressure_cls:
+            listen_for_messages(Priority.default, 3, loop_count=1)
+
+        mock_backpressure_cls.assert_called_once_with(max_bytes=1024 * 1024, max_rss_bytes=None)
+        mock_get_backend.return_value.fetch_and_process_messages.assert_called_once_with(
+            num_messages=3,
+            visibility_timeout=None,
+            drain=mock.ANY,
+            backpressure=mock_backpressure_cls.return_value,
+        )
+
+    def test_listen_for_messages_with_lease(self, mock_get_backend):
+        backend = mock_get_backend.return_value
+        backend.MANAGES_LEASES = False
+
+        lease_managers = []
+        backend.fetch_and_process_messages.side_effect = lambda **_: lease_managers.append(backend.lease_manager)
+
+        with mock.patch('taskhawk.consumer.LeaseManager', autospec=True) as mock_lease_manager_cls:
+            mock_lease_manager_cls.return_value.start.return_value = mock_lease_manager_cls.return_value
+            listen_for_messages(Priority.default, 3, loop_count=1, lease_s=20)
+
+        mock_lease_manager_cls.assert_called_once_with(backend, 20, 3600)
+        assert lease_managers == [mock_lease_manager_cls.return_value]
+        # messages are pulled with a lease sized visibility timeout
+        backend.fetch_and_process_messages.assert_called_once_with(
+            num_messages=3, visibility_timeout=20, drain=mock.ANY
+        )
+        mock_lease_manager_cls.return_value.stop.assert_called_once_with()
+        assert backend.lease_manager is None
+
+    def test_no_lease_for_backends_that_manage_leases(self, mock_get_backend):
+        backend = mock_get_backend.return_value
+        backend.MANAGES_LEASES = True
+
+        with mock.patch('taskhawk.consumer.LeaseManager', autospec=True) as mock_lease_manager_cls:
+            listen_for_messages(Priority.default, 3, loop_count=1, lease_s=20)
+
+        mock_lease_manager_cls.assert_not_called()
+
+    def test_listen_for_messages_adaptive_pull(self, mock_get_backend, settings):
+        settings.TASKHAWK_CONSUMER_ADAPTIVE_PULL = {'max_wait_s': 10}
+        backend = mock_get_backend.return_value
+        backend.MAX_PULL_MESSAGES = 10
+        backend.DEFAULT_VISIBILITY_TIMEOUT_S = 30
+        backend.pull_messages.side_effect = lambda num_messages, visibility_timeout, wait_time_s: [
+            mock.MagicMock() for _ in range(num_messages)
+        ]
+
+        listen_for_messages(Priority.default, 2, loop_count=3)
+
+        # full batches grow the batch size, and shorten the wait time since the queue isn't empty
+        assert backend.pull_messages.call_args_list == [
+            mock.call(2, None, wait_time_s=10),
+            mock.call(4, None, wait_time_s=5),
+            mock.call(8, None, wait_time_s=2),
+        ]
+        assert backend.process_queue_messages.call_count == 3
+        backend.fetch_and_process_messages.assert_not_called()
+
+    def test_adaptive_pull_with_concurrency_records_when_batch_is_done(self, mock_get_backend, settings):
+        settings.TASKHAWK_CONSUMER_ADAPTIVE_PULL = {}
+        backend = mock_get_backend.return_value
+        backend.MAX_PULL_MESSAGES = 10
+        backend.pull_messages.return_value = [mock.MagicMock(), mock.MagicMock()]
+        futures = [Future(), Future()]
+        backend.process_queue_messages.return_value = futures
+
+        with mock.patch('taskhawk.consumer.AdaptivePullController', autospec=True) as mock_controller_cls:
+            mock_controller_cls.return_value.batch_size = 2
+            listen_for_messages(Priority.default, 2, loop_count=1, concurrency=2)
+
+            controller = mock_controller_cls.return_value
+            controller.record.assert_not_called()
+            futures[0].set_result(None)
+            controller.record.assert_not_called()
+            futures[1].set_result(None)
+            controller.record.assert_called_once_with(2, 2, mock.ANY)
+
+    def test_adaptive_pull_is_ignored_when_prefetching(self, mock_get_backend, settings):
+        settings.TASKHAWK_CONSUMER_ADAPTIVE_PULL = {}
+        mock_get_backend.return_value.MAX_PULL_MESSAGES = 10
+
+        with mock.patch('taskhawk.consumer.Prefetcher', autospec=True) as mock_prefetcher_cls, mock.patch(
+            'taskhawk.consumer.logger', autospec=True
+        ) as mock_logger:
+            mock_prefetcher_cls.return_value.get.return_value = []
+            listen_for_messages(Priority.default, loop_count=1, prefetch=1)
+
+        mock_logger.warning.assert_called_once()
+        mock_get_backend.return_value.pull_messages.assert_not_called()
+        mock_get_backend.return_value.process_queue_messages.assert_called_once()
+
+    def test_listen_for_messages_shutdown_on_sigterm(self, mock_get_backend, settings):
+        settings.TASKHAWK_CONSUMER_HANDLE_SIGNALS = True
+        backend = mock_get_backend.return_value
+        backend.fetch_and_process_messages.side_effect = lambda **_: os.kill(os.getpid(), signal.SIGTERM)
+
+        listen_for_messages(Priority.default)
+
+        # stops after the current batch
+        backend.fetch_and_process_messages.assert_called_once()
+        backend.close.assert_called_once_with()
+
+    def test_listen_for_messages_leaves_signals_alone_by_default(self, mock_get_backend):
+        handlers = []
+        mock_get_backend.return_value.fetch_and_process_messages.side_effect = lambda **_: handlers.append(
+            signal.getsignal(signal.SIGTERM)
+        )
+
+        listen_for_messages(Priority.default, loop_count=1)
+
+        assert handlers == [signal.getsignal(signal.SIGTERM)]
+
+    def test_listen_for_messages_concurrency_setting(self, mock_get_backend, settings):
+        settings.TASKHAWK_CONSUMER_CONCURRENCY = 3
+
+        with mock.patch('taskhawk.consumer.BoundedExecutor', autospec=True) as mock_executor_cls:
+            listen_for_messages(Priority.default, loop_count=1)
+
+        mock_executor_cls.assert_called_once_with(3)
+
+    def test_listen_for_messages_with_prefetch(self, mock_get_backend):
+        queue_messages = [mock.MagicMock()]
+
+        with mock.patch('taskhawk.consumer.Prefetcher', autospec=True) as mock_prefetcher_cls:
+            mock_prefetcher_cls.return_value.get.return_value = queue_messages
+            listen_for_messages(Priority.default, 3, 4, loop_count=1, prefetch=2)
+
+        backend = mock_get_backend.return_value
+        mock_prefetcher_cls.assert_called_once_with(backend, 3, 4, 2, None)
+        mock_prefetcher_cls.return_value.start.assert_called_once_with()
+        backend.process_queue_messages.assert_called_once_with(
+            queue_messages,
+            executor=None,
+            drain=mock.ANY,
+            backpressure=None,
+            pulled_at=mock_prefetcher_cls.return_value.pulled_at,
+        )
+        backend.fetch_and_process_messages.assert_not_called()
+        mock_prefetcher_cls.return_value.stop.assert_called_once_with()
+        backend.close.assert_called_once_with()
+
+
+@mock.patch('taskhawk.consumer.get_consumer_backend', autospec=True)
+class TestListenForMessagesWeighted:
+    def test_listen_for_messages_weighted(self, mock_get_backend):
+        backends = {priority: mock.MagicMock(DEFAULT_VISIBILITY_TIMEOUT_S=30) for priority in Priority}
+        for priority, backend in backends.items():
+            backend.pull_messages.side_effect = lambda num_messages, visibility_timeout, p=priority: [p]
+        mock_get_backend.side_effect = lambda priority: backends[priority]
+
+        listen_for_messages_weighted({Priority.high: 2, Priority.bulk: 1}, num_messages=3, loop_count=6)
+
+        assert mock_get_backend.call_count == 2
+        processed = [
+            call.args[0][0]
+            for priority in (Priority.high, Priority.bulk)
+            for call in backends[priority].process_queue_messages.call_args_list
+        ]
+        # pollers race so the exact split varies, but bulk is never starved
+        assert len(processed) == 6
+        assert processed.count(Priority.bulk) >= 1
+        backends[Priority.high].pull_messages.assert_called_with(3, None)
+        for priority in (Priority.high, Priority.bulk):
+            backends[priority].close.assert_called_once_with()
+        backends[Priority.default].pull_messages.assert_not_called()
+
+    def test_weights_setting(self, mock_get_backend, settings):
+        settings.TASKHAWK_CONSUMER_PRIORITY_WEIGHTS = {'low': 1}
+        mock_get_backend.return_value.DEFAULT_VISIBILITY_TIMEOUT_S = 30
+        mock_get_backend.return_value.pull_messages.return_value = [mock.MagicMock()]
+
+        listen_for_messages_weighted(loop_count=1)
+
+        mock_get_backend.assert_called_once_with(priority=Priority.low)
+        mock_get_backend.return_value.process_queue_messages.assert_called_once_with(
+            mock_get_backend.return_value.pull_messages.return_value,
+            executor=None,
+            drain=mock.ANY,
+            backpressure=None,
+            pulled_at=mock.ANY,
+        )
+
+
+@mock.patch('taskhawk.consumer.get_consumer_backend', autospec=True)
+class TestListenForMessagesAsync:
+    def test_listen_for_messages_async(self, mock_get_backend):
+        queue_messages = [mock.MagicMock(), mock.MagicMock()]
+        backend = mock_get_backend.return_value
+        backend.pull_messages.return_value = queue_messages
+        processed = []
+
+        async def _process(queue_message, drain, backpressure, lease):
+            await asyncio.sleep(0)
+            processed.append(queue_message)
+
+        backend._process_queue_message_async.side_effect = _process
+        backend._acquire_leases.side_effect = lambda queue_messages, pulled_at: [None] * len(queue_messages)
+
+        asyncio.run(listen_for_messages_async(Priority.default, num_messages=10, loop_count=1, max_in_flight=5))
+
+        mock_get_backend.assert_called_once_with(priority=Priority.default)
+        backend.pull_messages.assert_called_once_with(5, None)
+        assert processed == queue_messages
+        # leased as soon as they're pulled, rather than once they start
+        backend._acquire_leases.assert_called_once_with(queue_messages, None)
+        backend.close.assert_called_once_with()
+
+    def test_drain_deadline(self, mock_get_backend):
+        backend = mock_get_backend.return_value
+        queue_message = mock.MagicMock()
+        backend.pull_messages.side_effect = [[queue_message], []]
+        shutdown_event = asyncio.Event()
+        cancelled = []
+
+        async def _process(queue_message, drain, backpressure, lease):
+            drain.begin(backend, queue_message)
+            shutdown_event.set()
+            try:
+                await asyncio.sleep(60)
+            except asyncio.CancelledError:
+                cancelled.append(queue_message)
+                raise
+
+        backend._process_queue_message_async.side_effect = _process
+        backend._acquire_leases.side_effect = lambda queue_messages, pulled_at: [None] * len(queue_messages)
+
+        asyncio.run(listen_for_messages_async(Priority.default, shutdown_event=shutdown_event, drain_timeout_s=0.1))
+
+        assert cancelled == [queue_message]
+        backend.nack_message.assert_called_once_with(queue_message)
+        backend.close.assert_called_once_with()
+
+    def test_caps_in_flight(self, mock_get_backend):
+        backend = mock_get_backend.return_value
+        backend.pull_messages.side_effect = lambda num_messages, visibility_timeout: [
+            mock.MagicMock() for _ in range(num_messages)
+        ]
+        max_seen = 0
+        running = 0
+
+        async def _process(queue_message, drain, backpressure, lease):
+            nonlocal max_seen, running
+            running += 1
+            max_seen = max(max_seen, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+
+        backend._process_queue_message_async.side_effect = _process
+        backend._acquire_leases.side_effect = lambda queue_messages, pulled_at: [None] * len(queue_messages)
+
+        asyncio.run(listen_for_messages_async(Priority.default, num_messages=3, loop_count=4, max_in_flight=4))
+
+        assert max_seen <= 4
+        assert backend._process_queue_message_async.call_count == sum(
+            c.args[0] for c in backend.pull_messages.call_args_list
+        )
+
+    def test_shutdown_event(self, mock_get_backend):
+        shutdown_event = asyncio.Event()
+        shutdown_event.set()
+
+        asyncio.run(listen_for_messages_async(Priority.default, shutdown_event=shutdown_event))
+
+        mock_get_backend.return_value.pull_messages.assert_not_called()
+
+
+class TestReplaceStuckThread:
+    def test_thread_pool(self):
+        executor = mock.MagicMock()
+        shutdown_event = threading.Event()
+
+        consumer._replace_stuck_thread(executor, shutdown_event, 123)
+
+        executor.abandon.assert_called_once_with(123)
+        assert not shutdown_event.is_set()
+
+    def test_shuts_down_when_unsupervised(self):
+        shutdown_event = threading.Event()
+
+        with mock.patch('taskhawk.consumer.os._exit', autospec=True) as mock_exit:
+            consumer._replace_stuck_thread(None, shutdown_event, 123)
+
+        mock_exit.assert_not_called()
+        assert shutdown_event.is_set()
+
+    def test_exits_when_supervised(self):
+        with mock.patch('taskhawk.consumer.os._exit', autospec=True) as mock_exit, mock.patch(
+            'logging.shutdown', autospec=True
+        ), mock.patch.object(consumer, '_supervised', True):
+            consumer._replace_stuck_thread(None, threading.Event(), 123)
+
+        mock_exit.assert_called_once_with(1)
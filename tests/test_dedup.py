@@ -0,0 +1,69 @@
+import time
+from unittest import mock
+
+import pytest
+
+from taskhawk.dedup import MemoryDedupCache, SQLiteDedupCache, build_dedup_cache
+
+
+def test_memory_cache_evicts_least_recent():
+    dedup_cache = MemoryDedupCache(max_size=2)
+
+    dedup_cache.add('a')
+    dedup_cache.add('b')
+    dedup_cache.add('a')
+    dedup_cache.add('c')
+
+    assert len(dedup_cache) == 2
+    assert dedup_cache.seen('a')
+    assert not dedup_cache.seen('b')
+    assert dedup_cache.seen('c')
+
+
+def test_memory_cache_expires():
+    dedup_cache = MemoryDedupCache(ttl_s=10)
+
+    with mock.patch('taskhawk.dedup.time.monotonic', return_value=100):
+        dedup_cache.add('a')
+        assert dedup_cache.seen('a')
+    with mock.patch('taskhawk.dedup.time.monotonic', return_value=110):
+        assert not dedup_cache.seen('a')
+    assert len(dedup_cache) == 0
+
+
+def test_sqlite_cache_is_shared(tmp_path):
+    path = str(tmp_path / 'dedup.db')
+    dedup_cache = SQLiteDedupCache(path, ttl_s=10)
+
+    dedup_cache.add('a')
+
+    # e.g. another worker process on the same host
+    other_cache = SQLiteDedupCache(path, ttl_s=10)
+    assert other_cache.seen('a')
+    assert not other_cache.seen('b')
+    with mock.patch('taskhawk.dedup.time.time', return_value=time.time() + 10):
+        assert not other_cache.seen('a')
+
+
+def test_sqlite_cache_prune(tmp_path):
+    dedup_cache = SQLiteDedupCache(str(tmp_path / 'dedup.db'), max_size=2)
+    now = time.time()
+    for offset, message_id in enumerate(['a', 'b', 'c']):
+        with mock.patch('taskhawk.dedup.time.time', return_value=now + offset):
+            dedup_cache.add(message_id)
+
+    with mock.patch('taskhawk.dedup.time.time', return_value=now + 3):
+        dedup_cache.prune()
+
+    assert [dedup_cache.seen(message_id) for message_id in ['a', 'b', 'c']] == [False, True, True]
+
+
+@pytest.mark.parametrize('config,cls', [(None, None), ({}, MemoryDedupCache), ({'path': 'dedup.db'}, SQLiteDedupCache)])
+def test_build_dedup_cache(tmp_path, config, cls):
+    if config and 'path' in config:
+        config = {'path': str(tmp_path / config['path'])}
+    dedup_cache = build_dedup_cache(config)
+    if cls is None:
+        assert dedup_cache is None
+    else:
+        assert isinstance(dedup_cache, cls)
@@ -0,0 +1,78 @@
+import os
+import signal
+import threading
+from unittest import mock
+
+from taskhawk.drain import Drain, handle_signals
+
+
+def test_handle_signals():
+    shutdown_event = threading.Event()
+    original_handler = signal.getsignal(signal.SIGTERM)
+
+    with handle_signals(shutdown_event):
+        os.kill(os.getpid(), signal.SIGTERM)
+        assert shutdown_event.wait(timeout=1)
+
+    assert signal.getsignal(signal.SIGTERM) is original_handler
+
+
+def test_begin_and_end():
+    shutdown_event = threading.Event()
+    drain = Drain(shutdown_event, None)
+    consumer_backend = mock.MagicMock()
+    queue_message = mock.MagicMock()
+
+    assert drain.begin(consumer_backend, queue_message)
+    assert drain.in_flight == 1
+    assert drain.end(queue_message)
+    assert drain.in_flight == 0
+
+    shutdown_event.set()
+    assert not drain.begin(consumer_backend, queue_message)
+
+
+def test_release_in_flight():
+    drain = Drain(threading.Event(), None)
+    consumer_backend = mock.MagicMock()
+    queue_messages = [mock.MagicMock(), mock.MagicMock()]
+    for queue_message in queue_messages:
+        drain.begin(consumer_backend, queue_message)
+
+    assert drain.release_in_flight() == queue_messages
+
+    consumer_backend.nack_message.assert_has_calls([mock.call(queue_message) for queue_message in queue_messages])
+    consumer_backend.flush.assert_called_once_with()
+    # so their leases don't undo the nacks
+    consumer_backend.lease_manager.release_message.assert_has_calls(
+        [mock.call(queue_message) for queue_message in queue_messages]
+    )
+    # outcome of released messages is ignored
+    assert not drain.end(queue_messages[0])
+
+
+def test_releases_in_flight_messages_at_deadline():
+    shutdown_event = threading.Event()
+    drain = Drain(shutdown_event, 0.1).start()
+    consumer_backend = mock.MagicMock()
+    queue_message = mock.MagicMock()
+    drain.begin(consumer_backend, queue_message)
+
+    shutdown_event.set()
+    drain._thread.join(timeout=5)
+
+    consumer_backend.nack_message.assert_called_once_with(queue_message)
+    assert drain.in_flight == 0
+
+
+def test_doesnt_release_once_drained():
+    shutdown_event = threading.Event()
+    drain = Drain(shutdown_event, 0.1).start()
+    consumer_backend = mock.MagicMock()
+    drain.begin(consumer_backend, mock.MagicMock())
+
+    drain.stop()
+    shutdown_event.set()
+    drain._thread.join(timeout=5)
+
+    consumer_backend.nack_message.assert_not_called()
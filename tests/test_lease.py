@@ -0,0 +1,155 @@
+import threading
+import time
+from unittest import mock
+
+import pytest
+
+from taskhawk import lease as lease_module
+from taskhawk.lease import Lease, LeaseManager, current_lease
+
+
+@pytest.fixture(name='consumer_backend')
+def _consumer_backend():
+    backend = mock.MagicMock()
+    backend.extend_visibility_timeouts.return_value = {}
+    return backend
+
+
+def test_extends_in_flight_messages_in_one_request(consumer_backend):
+    extended = threading.Event()
+    consumer_backend.extend_visibility_timeouts.side_effect = lambda *_: extended.set() or {}
+    lease_manager = LeaseManager(consumer_backend, 1).start()
+    queue_messages = [mock.MagicMock(), mock.MagicMock()]
+
+    leases = [lease_manager.acquire(queue_message) for queue_message in queue_messages]
+
+    assert extended.wait(timeout=2)
+    lease_manager.stop()
+    consumer_backend.extend_visibility_timeouts.assert_called_with(queue_messages, 1)
+    for lease in leases:
+        lease_manager.release(lease)
+
+
+def test_lease_starts_when_message_was_pulled(consumer_backend):
+    lease_manager = LeaseManager(consumer_backend, 60, 600)
+    lease = lease_manager.acquire(mock.MagicMock(), acquired_at=time.monotonic() - 45)
+
+    assert list(lease_manager._take_due()) == [60]
+    assert lease.deadline == pytest.approx(time.monotonic() + 555, abs=1)
+
+
+def test_released_leases_arent_extended(consumer_backend):
+    lease_manager = LeaseManager(consumer_backend, 60)
+    lease = lease_manager.acquire(mock.MagicMock())
+    lease_manager.release(lease)
+    lease.expires_at = 0
+
+    assert lease_manager._take_due() == {}
+    assert not lease.active
+
+
+def test_release_waits_for_extension_in_flight(consumer_backend):
+    lease_manager = LeaseManager(consumer_backend, 60)
+    lease = lease_manager.acquire(mock.MagicMock())
+    extending = threading.Event()
+    proceed = threading.Event()
+    events = []
+
+    def _extend(queue_messages, visibility_timeout_s):
+        extending.set()
+        proceed.wait(timeout=5)
+        events.append('extended')
+        return {}
+
+    consumer_backend.extend_visibility_timeouts.side_effect = _extend
+    extend_thread = threading.Thread(target=lease_manager._extend, args=([lease], 60))
+    extend_thread.start()
+    assert extending.wait(timeout=5)
+    release_thread = threading.Thread(target=lambda: (lease_manager.release(lease), events.append('released')))
+    release_thread.start()
+
+    # the release can't return before the extension landed, or a nack sent afterwards could be undone
+    release_thread.join(timeout=0.1)
+    assert events == []
+    proceed.set()
+    extend_thread.join(timeout=5)
+    release_thread.join(timeout=5)
+    assert events == ['extended', 'released']
+
+
+def test_released_lease_isnt_extended_once_due(consumer_backend):
+    lease_manager = LeaseManager(consumer_backend, 60)
+    lease = lease_manager.acquire(mock.MagicMock())
+    lease_manager.release(lease)
+
+    lease_manager._extend([lease], 60)
+
+    consumer_backend.extend_visibility_timeouts.assert_not_called()
+
+
+def test_release_message(consumer_backend):
+    lease_manager = LeaseManager(consumer_backend, 60)
+    queue_message = mock.MagicMock()
+    lease = lease_manager.acquire(queue_message)
+    other = lease_manager.acquire(mock.MagicMock())
+
+    lease_manager.release_message(queue_message)
+
+    assert not lease.active
+    assert other.active
+    assert list(lease_manager._leases.values()) == [other]
+
+
+def test_due_leases_are_coalesced(consumer_backend):
+    lease_manager = LeaseManager(consumer_backend, 60)
+    due = lease_manager.acquire(mock.MagicMock())
+    almost_due = lease_manager.acquire(mock.MagicMock())
+    not_due = lease_manager.acquire(mock.MagicMock())
+    now = lease_module.time.monotonic()
+    due.expires_at = now + 30
+    almost_due.expires_at = now + 40
+    not_due.expires_at = now + 60
+
+    assert lease_manager._take_due() == {60: [due, almost_due]}
+
+
+def test_stops_extending_after_max_lease(consumer_backend):
+    lease_manager = LeaseManager(consumer_backend, 60, max_lease_s=100)
+    lease = lease_manager.acquire(mock.MagicMock())
+    lease.expires_at = lease_module.time.monotonic()
+    lease.acquired_at -= 80
+
+    # last extension is up to the deadline, and the lease isn't tracked anymore
+    assert lease_manager._take_due() == {20: [lease]}
+    assert lease_manager._take_due() == {}
+
+
+def test_failed_extensions_are_retried(consumer_backend):
+    error = RuntimeError('fail')
+    consumer_backend.extend_visibility_timeouts.return_value = {1: error}
+    lease_manager = LeaseManager(consumer_backend, 60)
+    leases = [lease_manager.acquire(mock.MagicMock()) for _ in range(2)]
+
+    with mock.patch.object(lease_module.logger, 'warning') as logging_mock:
+        lease_manager._extend(leases, 60)
+
+    logging_mock.assert_called_once_with(
+        'Failed to extend visibility of message', exc_info=error, extra={'queue_message': leases[1].queue_message}
+    )
+    assert leases[1].expires_at < leases[0].expires_at
+
+
+def test_lease_extended():
+    lease = Lease(mock.MagicMock(), 10, None)
+    expires_at = lease.expires_at
+
+    lease.extended(60)
+
+    assert lease.expires_at > expires_at + 40
+    assert lease.deadline is None
+    assert current_lease() is None
+
+
+def test_lease_s_must_be_positive(consumer_backend):
+    with pytest.raises(ValueError):
+        LeaseManager(consumer_backend, 0)
@@ -0,0 +1,65 @@
+from unittest import mock
+
+import pytest
+
+from taskhawk.exceptions import ConfigurationError
+from taskhawk.limits import CONCURRENCY_RETRY_AFTER_S, TaskLimiter, TokenBucket, parse_rate_limit
+
+
+@pytest.mark.parametrize(
+    'rate_limit,expected',
+    [['100/s', (100, 1)], ['10/m', (10, 60)], ['5 / h', (5, 3600)]],
+)
+def test_parse_rate_limit(rate_limit, expected):
+    assert parse_rate_limit(rate_limit) == expected
+
+
+@pytest.mark.parametrize('rate_limit', ['100', '100/d', 'x/s', '0/s'])
+def test_parse_rate_limit_invalid(rate_limit):
+    with pytest.raises(ConfigurationError):
+        parse_rate_limit(rate_limit)
+
+
+@mock.patch('taskhawk.limits.time.monotonic')
+def test_token_bucket(mock_monotonic):
+    mock_monotonic.return_value = 100.0
+    bucket = TokenBucket(2, 2)
+
+    assert bucket.take() == 0
+    assert bucket.take() == 0
+    assert bucket.take() == pytest.approx(0.5)
+
+    mock_monotonic.return_value = 100.5
+    assert bucket.take() == 0
+    assert bucket.take() == pytest.approx(0.5)
+
+    # doesn't refill beyond capacity
+    mock_monotonic.return_value = 200.0
+    assert bucket.take() == 0
+    assert bucket.take() == 0
+    assert bucket.take() > 0
+
+
+def test_task_limiter_concurrency():
+    limiter = TaskLimiter(max_concurrency=2)
+
+    assert limiter.acquire() is None
+    assert limiter.acquire() is None
+    assert limiter.acquire() == CONCURRENCY_RETRY_AFTER_S
+
+    limiter.release()
+    assert limiter.acquire() is None
+
+
+@mock.patch('taskhawk.limits.time.monotonic', return_value=100.0)
+def test_task_limiter_rate_limit_releases_slot(_):
+    limiter = TaskLimiter(max_concurrency=1, rate_limit='1/m')
+
+    assert limiter.acquire() is None
+    limiter.release()
+    assert limiter.acquire() == pytest.approx(60)
+
+
+def test_task_limiter_invalid_concurrency():
+    with pytest.raises(ConfigurationError):
+        TaskLimiter(max_concurrency=0)
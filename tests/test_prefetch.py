@@ -0,0 +1,87 @@
+import threading
+from unittest import mock
+
+import pytest
+
+from taskhawk import prefetch
+from taskhawk.prefetch import Prefetcher
+
+
+@pytest.fixture(name='consumer_backend')
+def _consumer_backend():
+    backend = mock.MagicMock()
+    backend.DEFAULT_VISIBILITY_TIMEOUT_S = 30
+    backend.pull_messages.side_effect = lambda num_messages, visibility_timeout: [
+        mock.MagicMock() for _ in range(num_messages)
+    ]
+    return backend
+
+
+def test_get_returns_pulled_batches(consumer_backend):
+    prefetcher = Prefetcher(consumer_backend, 2, 10, depth=1).start()
+
+    first = prefetcher.get()
+    second = prefetcher.get()
+
+    assert len(first) == 2
+    assert len(second) == 2
+    assert first != second
+    consumer_backend.pull_messages.assert_called_with(2, 10)
+    prefetcher.stop()
+
+
+def test_pulls_ahead_up_to_depth(consumer_backend):
+    prefetcher = Prefetcher(consumer_backend, 1, None, depth=2).start()
+
+    prefetcher.get()
+    # one batch was handed out, and two more are buffered
+    for _ in range(50):
+        if consumer_backend.pull_messages.call_count == 3:
+            break
+        threading.Event().wait(0.01)
+    threading.Event().wait(0.05)
+
+    assert consumer_backend.pull_messages.call_count == 3
+    prefetcher.stop()
+
+
+def test_stop_nacks_buffered_messages(consumer_backend):
+    prefetcher = Prefetcher(consumer_backend, 2, None, depth=1).start()
+    prefetcher.get()
+    for _ in range(50):
+        if consumer_backend.pull_messages.call_count == 2:
+            break
+        threading.Event().wait(0.01)
+
+    prefetcher.stop()
+
+    assert consumer_backend.nack_message.call_count == 2
+    consumer_backend.flush.assert_called_once_with()
+    assert prefetcher.get() == []
+
+
+def test_doesnt_pull_ahead_when_batches_are_slow(consumer_backend):
+    prefetcher = Prefetcher(consumer_backend, 1, 10, depth=2)
+    prefetcher._batch_duration_s = 6
+
+    # expected wait of 6 seconds is more than half of the 10 second visibility timeout
+    assert not prefetcher._should_prefetch()
+
+    prefetcher._batch_duration_s = 2
+    assert prefetcher._should_prefetch()
+
+
+def test_drops_stale_batches(consumer_backend):
+    prefetcher = Prefetcher(consumer_backend, 1, 10, depth=1)
+    stale, fresh = [mock.MagicMock()], [mock.MagicMock()]
+    prefetcher._buffer.append((0.0, stale))
+    prefetcher._buffer.append((prefetch.time.monotonic(), fresh))
+
+    assert prefetcher.get() == fresh
+    consumer_backend.nack_message.assert_called_once_with(stale[0])
+    consumer_backend.flush.assert_called_once_with()
+
+
+def test_depth_must_be_positive(consumer_backend):
+    with pytest.raises(ValueError):
+        Prefetcher(consumer_backend, 1, None, depth=0)
@@ -0,0 +1,95 @@
+import importlib
+import os
+import threading
+from unittest import mock
+
+import pytest
+
+from taskhawk import prefork
+from taskhawk.models import Priority
+
+
+pytestmark = pytest.mark.skipif(not hasattr(os, 'fork'), reason="fork not available")
+
+
+@pytest.fixture(autouse=True)
+def prefork_settings(settings):
+    settings.TASKHAWK_CONSUMER_BACKEND = "tests.test_backends.test_base.MockBackend"
+    yield settings
+
+
+def test_forks_workers(tmp_path):
+    def listen(shutdown_event, **kwargs):
+        (tmp_path / str(os.getpid())).write_text(repr(kwargs))
+
+    with mock.patch('taskhawk.prefork.listen_for_messages', side_effect=listen), mock.patch.object(
+        prefork.gc, 'freeze'
+    ) as mock_freeze, mock.patch.object(
+        prefork.importlib, 'import_module', wraps=importlib.import_module
+    ) as mock_import_module:
+        prefork.listen_for_messages_prefork(
+            Priority.high, processes=3, num_messages=5, loop_count=1, drain_timeout_s=5, task_modules=['tests.tasks']
+        )
+
+    # once, rather than before every fork
+    mock_freeze.assert_called_once_with()
+    mock_import_module.assert_any_call('tests.tasks')
+    results = [p.read_text() for p in tmp_path.iterdir()]
+    assert len(results) == 3
+    assert set(results) == {
+        repr(
+            dict(
+                priority=Priority.high,
+                num_messages=5,
+                visibility_timeout_s=None,
+                loop_count=1,
+                concurrency=None,
+                prefetch=None,
+                lease_s=None,
+                drain_timeout_s=5,
+            )
+        )
+    }
+
+
+def test_restarts_crashed_workers(tmp_path):
+    marker = tmp_path / 'crashed'
+
+    def listen(shutdown_event, **kwargs):
+        if not marker.exists():
+            marker.write_text('')
+            raise RuntimeError('crash')
+        (tmp_path / 'done').write_text('')
+
+    with mock.patch('taskhawk.prefork.listen_for_messages', side_effect=listen), mock.patch.object(
+        prefork, 'RESTART_BACKOFF_S', 0
+    ):
+        prefork.listen_for_messages_prefork(Priority.default, processes=1)
+
+    assert (tmp_path / 'done').exists()
+
+
+def test_shutdown_stops_workers(tmp_path):
+    def listen(shutdown_event, **kwargs):
+        (tmp_path / f'started-{os.getpid()}').write_text('')
+        shutdown_event.wait()
+        (tmp_path / f'stopped-{os.getpid()}').write_text('')
+
+    shutdown_event = threading.Event()
+
+    def _stop_when_started():
+        while len(list(tmp_path.glob('started-*'))) < 2:
+            shutdown_event.wait(0.05)
+        shutdown_event.set()
+
+    threading.Thread(target=_stop_when_started, daemon=True).start()
+
+    with mock.patch('taskhawk.prefork.listen_for_messages', side_effect=listen):
+        prefork.listen_for_messages_prefork(Priority.default, processes=2, shutdown_event=shutdown_event)
+
+    assert len(list(tmp_path.glob('stopped-*'))) == 2
+
+
+def test_invalid_processes():
+    with pytest.raises(ValueError):
+        prefork.listen_for_messages_prefork(Priority.default, processes=0)
@@ -1,6 +1,8 @@
+from concurrent.futures import Future
 from unittest import mock
 
-from taskhawk.publisher import publish
+from taskhawk.models import Message, Priority
+from taskhawk.publisher import publish, publish_many
 
 
 @mock.patch('taskhawk.publisher.get_publisher_backend', autospec=True)
@@ -9,3 +11,37 @@ def test_publish(mock_get_publisher_backend, message):
 
     mock_get_publisher_backend.assert_called_once_with(priority=message.priority)
     mock_get_publisher_backend.return_value.publish.assert_called_once_with(message)
+
+
+def _future(result=None, error=None):
+    future = Future()
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+    return future
+
+
+@mock.patch('taskhawk.publisher.get_publisher_backend', autospec=True)
+def test_publish_many(mock_get_publisher_backend, message_data):
+    error = Exception()
+    backend = mock_get_publisher_backend.return_value
+    backend.publish_many.side_effect = lambda messages: [
+        _future(error=error) if message.args == [3] else _future('id') for message in messages
+    ]
+    consumed = []
+
+    def _messages():
+        for i in range(5):
+            consumed.append(i)
+            yield Message({**message_data, 'args': [i]})
+
+    messages = _messages()
+    result = publish_many(messages, chunk_size=2, max_in_flight=1)
+
+    assert consumed == [0, 1, 2, 3, 4]
+    assert result.dispatched == 4
+    assert not result.ok
+    assert [(message.args, exc) for message, exc in result.failed] == [([3], error)]
+    assert [len(call[0][0]) for call in backend.publish_many.call_args_list] == [2, 2, 1]
+    mock_get_publisher_backend.assert_called_with(priority=Priority.default)
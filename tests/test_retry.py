@@ -0,0 +1,40 @@
+from unittest import mock
+
+import pytest
+
+from taskhawk.retry import ATTEMPT_HEADER, RETRY_AT_HEADER, Backoff, delivery_attempt
+
+
+@pytest.mark.parametrize('attempt,delay_s', [(1, 2), (2, 4), (5, 32), (12, 3600), (1000, 3600)])
+def test_backoff_delay(attempt, delay_s):
+    assert Backoff(base=2, max=3600, jitter=False).delay(attempt) == delay_s
+
+
+def test_backoff_jitter():
+    backoff = Backoff(base=2, max=3600)
+
+    with mock.patch('taskhawk.retry.random.uniform', return_value=20.4) as uniform:
+        assert backoff.delay(5) == 20
+
+    uniform.assert_called_once_with(16, 32)
+
+
+def test_backoff_invalid():
+    with pytest.raises(ValueError):
+        Backoff(base=1)
+
+
+@pytest.mark.parametrize(
+    'headers,provider_attempt,attempt',
+    [
+        ({}, None, 1),
+        ({}, 3, 3),
+        ({ATTEMPT_HEADER: '4'}, 2, 6),
+        ({ATTEMPT_HEADER: 'bad'}, None, 1),
+        # the first delivery of a re-published message was spent deferring it
+        ({ATTEMPT_HEADER: '4', RETRY_AT_HEADER: '0'}, 2, 5),
+        ({ATTEMPT_HEADER: '4', RETRY_AT_HEADER: '0'}, None, 5),
+    ],
+)
+def test_delivery_attempt(headers, provider_attempt, attempt):
+    assert delivery_attempt(headers, provider_attempt) == attempt
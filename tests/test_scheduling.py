@@ -0,0 +1,85 @@
+import collections
+import threading
+from unittest import mock
+
+import pytest
+
+from taskhawk.models import Priority
+from taskhawk.scheduling import QueuePoller, WeightedScheduler, parse_weights
+
+
+def test_serves_in_proportion_to_weights():
+    scheduler = WeightedScheduler({Priority.high: 3, Priority.bulk: 1})
+
+    picks = [scheduler.next([Priority.high, Priority.bulk]) for _ in range(8)]
+
+    assert collections.Counter(picks) == {Priority.high: 6, Priority.bulk: 2}
+    # spread out rather than in bursts
+    assert picks[:4].count(Priority.bulk) == 1
+
+
+def test_ties_go_to_higher_priority():
+    scheduler = WeightedScheduler({Priority.bulk: 1, Priority.high: 1})
+
+    assert scheduler.next([Priority.bulk, Priority.high]) == Priority.high
+    assert scheduler.next([Priority.bulk, Priority.high]) == Priority.bulk
+
+
+def test_only_ready_queues_are_served():
+    scheduler = WeightedScheduler({Priority.high: 8, Priority.bulk: 1})
+
+    assert [scheduler.next([Priority.bulk]) for _ in range(3)] == [Priority.bulk] * 3
+    # bulk didn't build up a debt while high was idle, nor high credit
+    assert scheduler.next([Priority.high, Priority.bulk]) == Priority.high
+    assert scheduler.next([]) is None
+
+
+def test_weights_must_be_positive():
+    with pytest.raises(ValueError):
+        WeightedScheduler({Priority.high: 0})
+    with pytest.raises(ValueError):
+        WeightedScheduler({})
+
+
+def test_parse_weights():
+    assert parse_weights({'high': 2, Priority.low: '1'}) == {Priority.high: 2, Priority.low: 1}
+
+
+class TestQueuePoller:
+    def test_holds_one_batch(self):
+        backend = mock.MagicMock()
+        backend.pull_messages.side_effect = lambda num_messages, visibility_timeout: [mock.MagicMock()]
+        ready = threading.Condition()
+        poller = QueuePoller(Priority.high, backend, 1, 10, ready).start()
+
+        with ready:
+            assert ready.wait_for(lambda: poller.has_batch, timeout=1)
+            batch = poller.take()
+            assert len(batch) == 1
+            assert ready.wait_for(lambda: poller.has_batch, timeout=1)
+
+        assert backend.pull_messages.call_count == 2
+        backend.pull_messages.assert_called_with(1, 10)
+
+        poller.stop()
+        backend.nack_message.assert_called_once()
+        backend.flush.assert_called_once_with()
+
+    def test_drops_stale_batch(self):
+        backend = mock.MagicMock()
+        queue_message = mock.MagicMock()
+        backend.pull_messages.side_effect = lambda num_messages, visibility_timeout: (
+            [queue_message] if backend.pull_messages.call_count == 1 else []
+        )
+        released = threading.Event()
+        backend.nack_message.side_effect = lambda _: released.set()
+        ready = threading.Condition()
+        poller = QueuePoller(Priority.bulk, backend, 1, 1, ready).start()
+
+        # never taken, so it outlives its visibility timeout
+        assert released.wait(timeout=3)
+
+        backend.nack_message.assert_called_once_with(queue_message)
+        with ready:
+            assert not poller.has_batch
+        poller.stop()
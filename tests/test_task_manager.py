@@ -1,3 +1,5 @@
+import asyncio
+import threading
 from typing import Optional
 from unittest import mock
 import uuid
@@ -5,8 +7,8 @@ import uuid
 import pytest
 
 import taskhawk
-from taskhawk.task_manager import _ALL_TASKS, Task, task, AsyncInvocation
-from taskhawk.models import Priority
+from taskhawk.task_manager import _ALL_TASKS, BatchItem, Task, task, AsyncInvocation
+from taskhawk.models import Message, Priority
 from taskhawk.exceptions import ConfigurationError, TaskNotFound
 from .tasks import send_email
 
@@ -18,6 +20,7 @@ def test_task_decorator():
 
     assert f.task.name == 'tests.test_task_manager.f'
     assert callable(f.dispatch)
+    assert callable(f.dispatch_many)
     assert callable(f.with_headers)
     assert callable(f.with_priority)
     assert 'tests.test_task_manager.f' in _ALL_TASKS
@@ -46,6 +49,78 @@ def test_task_decorator_custom_name_conflict():
         make_tasks()
 
 
+def test_task_decorator_limits():
+    @task(max_concurrency=2, rate_limit='10/m', name='test_task_decorator_limits')
+    def f():
+        pass
+
+    assert f.task.limiter is not None
+    assert f.task.limiter.acquire() is None
+
+
+def test_task_decorator_invalid_rate_limit():
+    with pytest.raises(ConfigurationError):
+
+        @task(rate_limit='10/day', name='test_task_decorator_invalid_rate_limit')
+        def f():
+            pass
+
+
+def test_task_decorator_timeout():
+    @task(timeout=30, name='test_task_decorator_timeout')
+    def f():
+        pass
+
+    assert f.task.timeout == 30
+
+    with pytest.raises(ConfigurationError):
+
+        @task(timeout=0, name='test_task_decorator_timeout_invalid')
+        def g():
+            pass
+
+
+def test_task_decorator_max_attempts():
+    @task(max_attempts=5, name='test_task_decorator_max_attempts')
+    def f():
+        pass
+
+    assert f.task.max_attempts == 5
+
+    with pytest.raises(ConfigurationError):
+
+        @task(max_attempts=0, name='test_task_decorator_max_attempts_invalid')
+        def g():
+            pass
+
+
+def test_task_decorator_batch():
+    @task(batch_size=10, batch_window_ms=200, name='test_task_decorator_batch')
+    def f(items):
+        pass
+
+    assert f.task.batch_size == 10
+    assert f.task.batch_window_ms == 200
+
+    with pytest.raises(ConfigurationError):
+
+        @task(batch_size=0, name='test_task_decorator_batch_invalid')
+        def g(items):
+            pass
+
+    with pytest.raises(ConfigurationError):
+
+        @task(batch_size=10, timeout=30, name='test_task_decorator_batch_timeout')
+        def h(items):
+            pass
+
+    with pytest.raises(ConfigurationError):
+
+        @task(batch_window_ms=200, name='test_task_decorator_batch_window')
+        def i(items):
+            pass
+
+
 def test_task_decorator_priority():
     @task(priority=Priority.high, name='test_task_decorator_priority')
     def f():
@@ -132,6 +207,26 @@ def test_async_invocation_dispatch_default_headers(mock_message_new, mock_publis
     mock_publish.assert_called_once_with(mock_message_new.return_value)
 
 
+@mock.patch('taskhawk.task_manager.publish_many', autospec=True)
+def test_async_invocation_dispatch_many(mock_publish_many, invocation):
+    invocation = invocation.with_priority(Priority.high).with_headers(request_id='1234')
+
+    def _items():
+        yield ('example@email.com', 'Hello!')
+        yield 'other@email.com'
+
+    result = invocation.dispatch_many(_items(), chunk_size=10, max_in_flight=2)
+
+    assert result == mock_publish_many.return_value
+    mock_publish_many.assert_called_once_with(mock.ANY, chunk_size=10, max_in_flight=2)
+    messages = list(mock_publish_many.call_args[0][0])
+    assert [message.args for message in messages] == [('example@email.com', 'Hello!'), ('other@email.com',)]
+    assert all(message.priority == Priority.high for message in messages)
+    assert all(message.headers == {'request_id': '1234'} for message in messages)
+    assert all(message.task_name == invocation._task.name for message in messages)
+    assert messages[0].id != messages[1].id
+
+
 class TestTask:
     @staticmethod
     def f(a, b, c=1):
@@ -217,6 +312,12 @@ class TestTask:
         mock_dispatch.assert_called_once()
         assert mock_dispatch.call_args[0][1:] == (1, 2)
 
+    @mock.patch('taskhawk.task_manager.AsyncInvocation.dispatch_many', autospec=True)
+    def test_dispatch_many(self, mock_dispatch_many):
+        task_obj = Task(TestTask.f, Priority.default, 'name')
+        assert task_obj.dispatch_many([(1, 2)]) == mock_dispatch_many.return_value
+        mock_dispatch_many.assert_called_once_with(mock.ANY, [(1, 2)], chunk_size=500, max_in_flight=8)
+
     def test_call(self, message):
         _f = mock.MagicMock()
 
@@ -250,6 +351,99 @@ class TestTask:
         task_obj.call(message)
         _f.assert_called_once_with(*message.args, message.metadata, **message.kwargs)
 
+    def test_call_coroutine(self, message):
+        _f = mock.MagicMock()
+
+        @task(name='test_call_coroutine')
+        async def f(to: str, subject: str, from_email: str = None):
+            await asyncio.sleep(0)
+            _f(to, subject, from_email=from_email)
+
+        task_obj = f.task
+        assert task_obj.is_async
+        task_obj.call(message)
+        _f.assert_called_once_with(*message.args, **message.kwargs)
+
+    def test_call_coroutine_from_event_loop(self, message):
+        _f = mock.MagicMock()
+
+        @task(name='test_call_coroutine_from_event_loop')
+        async def f(to: str, subject: str, from_email: str = None):
+            await asyncio.sleep(0)
+            _f(to, subject, from_email=from_email)
+
+        async def _dispatch_sync():
+            f.task.call(message)
+
+        asyncio.run(_dispatch_sync())
+        _f.assert_called_once_with(*message.args, **message.kwargs)
+
+    def test_call_async_coroutine(self, message):
+        _f = mock.MagicMock()
+
+        @task(name='test_call_async_coroutine')
+        async def f(to: str, subject: str, metadata, from_email: str = None):
+            _f(to, subject, metadata, from_email=from_email)
+
+        asyncio.run(f.task.call_async(message))
+        _f.assert_called_once_with(*message.args, message.metadata, **message.kwargs)
+
+    def test_call_async_sync_function(self, message):
+        _f = mock.MagicMock()
+        main_thread = threading.current_thread()
+
+        @task(name='test_call_async_sync_function')
+        def f(to: str, subject: str, from_email: str = None):
+            assert threading.current_thread() is not main_thread
+            _f(to, subject, from_email=from_email)
+
+        assert not f.task.is_async
+        asyncio.run(f.task.call_async(message))
+        _f.assert_called_once_with(*message.args, **message.kwargs)
+
+    def test_call_batch(self, message, message_data):
+        _f = mock.MagicMock()
+        error = Exception()
+        other_message = Message({**message_data, 'args': ['other@email.com', 'Hi!']})
+
+        @task(batch_size=10, name='test_call_batch')
+        def f(items):
+            _f(items)
+            return {1: error}
+
+        assert f.task.call_batch([message, other_message]) == {1: error}
+        _f.assert_called_once_with(
+            [
+                BatchItem(message.args, message.kwargs, message.metadata, message.headers),
+                BatchItem(other_message.args, other_message.kwargs, other_message.metadata, other_message.headers),
+            ]
+        )
+
+    def test_call_batch_failure(self, message):
+        error = Exception()
+
+        @task(batch_size=10, name='test_call_batch_failure')
+        def f(items):
+            raise error
+
+        assert f.task.call_batch([message, message]) == {0: error, 1: error}
+
+    def test_call_batch_task(self, message):
+        _f = mock.MagicMock()
+        error = Exception()
+
+        @task(batch_size=10, name='test_call_batch_task')
+        async def f(items):
+            _f(items)
+            return {0: error} if _f.call_count > 1 else None
+
+        f.task.call(message)
+        _f.assert_called_once_with([BatchItem(message.args, message.kwargs, message.metadata, message.headers)])
+
+        with pytest.raises(Exception) as e:
+            asyncio.run(f.task.call_async(message))
+        assert e.value is error
+
     def test_find_by_name(self):
         assert Task.find_by_name('tests.tasks.send_email') == send_email.task
 
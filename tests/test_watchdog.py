@@ -0,0 +1,53 @@
+import threading
+from unittest import mock
+
+from taskhawk import watchdog as watchdog_module
+from taskhawk.watchdog import Watchdog
+
+
+timeout_hook = mock.MagicMock()
+
+
+def test_expired_task_is_released(settings):
+    settings.TASKHAWK_TASK_TIMEOUT_HOOK = 'tests.test_watchdog.timeout_hook'
+    timeout_hook.reset_mock()
+    consumer_backend = mock.MagicMock()
+    lease = mock.MagicMock()
+    expired = threading.Event()
+    on_timeout = mock.MagicMock(side_effect=lambda _: expired.set())
+    watchdog = Watchdog(on_timeout).start()
+    queue_message = mock.MagicMock()
+
+    with mock.patch.object(watchdog_module.logger, 'error') as logging_mock:
+        watch = watchdog.watch(consumer_backend, queue_message, lease)
+        watchdog.set_timeout(watch, 'tests.tasks.send_email', 'message-id', 0.1)
+        assert expired.wait(timeout=2)
+    watchdog.stop()
+
+    assert watch.timed_out
+    on_timeout.assert_called_once_with(threading.get_ident())
+    consumer_backend.lease_manager.release.assert_called_once_with(lease)
+    consumer_backend.nack_message.assert_called_once_with(queue_message)
+    consumer_backend.flush.assert_called_once_with()
+    timeout_hook.assert_called_once_with(task_name='tests.tasks.send_email', message_id='message-id', timeout_s=0.1)
+    logging_mock.assert_called_once()
+    # stack trace of the stuck thread
+    assert 'test_expired_task_is_released' in logging_mock.call_args[1]['extra']['stack']
+
+
+def test_finished_task_is_not_released():
+    consumer_backend = mock.MagicMock()
+    on_timeout = mock.MagicMock()
+    watchdog = Watchdog(on_timeout).start()
+
+    watch = watchdog.watch(consumer_backend, mock.MagicMock())
+    watchdog.set_timeout(watch, 'tests.tasks.send_email', 'message-id', 0.2)
+    watchdog.unwatch(watch)
+    # no timeout set
+    watchdog.watch(consumer_backend, mock.MagicMock())
+    threading.Event().wait(0.4)
+    watchdog.stop()
+
+    assert not watch.timed_out
+    on_timeout.assert_not_called()
+    consumer_backend.nack_message.assert_not_called()